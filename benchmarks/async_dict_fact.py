@@ -0,0 +1,63 @@
+"""Convergence of DictFact versus wall-clock time: single process,
+synchronous data-parallel workers (n_jobs) and asynchronous (Hogwild)
+workers sharing the dictionary. The test objective is computed by the
+callback, on dictionary snapshots."""
+import time
+
+import numpy as np
+
+from modl.decomposition.dict_fact import DictFact
+
+n_samples = 4000
+n_features = 2000
+n_components = 20
+n_jobs = 4
+reduction = 8
+batch_size = 20
+n_epochs = 2
+verbose = 20
+
+rng = np.random.RandomState(0)
+components = rng.randn(n_components, n_features)
+X = rng.randn(n_samples + 500, n_components).dot(components)
+X += 0.1 * rng.randn(*X.shape)
+X, X_test = X[:n_samples], X[n_samples:]
+
+
+class Trace(object):
+    def __init__(self):
+        self.times = []
+        self.scores = []
+
+    def __call__(self, estimator):
+        self.times.append(estimator.time_)
+        self.scores.append(estimator.score(X_test))
+
+
+configs = [('single process', dict(n_jobs=1)),
+           ('synchronous', dict(n_jobs=n_jobs)),
+           ('asynchronous', dict(n_jobs=n_jobs, asynchronous=True))]
+results = []
+for name, params in configs:
+    trace = Trace()
+    dict_fact = DictFact(n_components=n_components, reduction=reduction,
+                         batch_size=batch_size, n_epochs=n_epochs,
+                         code_alpha=1e-2, subset_order='block',
+                         random_state=0, verbose=verbose, callback=trace,
+                         **params)
+    t0 = time.perf_counter()
+    dict_fact.fit(X)
+    total = time.perf_counter() - t0
+    trace(dict_fact)
+    results.append((name, total, trace))
+
+print('mode            total (s)  final objective')
+for name, total, trace in results:
+    print('%-14s  %9.2f  %15.4f' % (name, total, trace.scores[-1]))
+
+print()
+print('Objective versus time (s)')
+for name, _, trace in results:
+    print(name)
+    for this_time, score in zip(trace.times, trace.scores):
+        print('  %8.2f  %10.4f' % (this_time, score))
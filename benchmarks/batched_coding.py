@@ -0,0 +1,38 @@
+"""Coding a minibatch sharing a single Gram matrix: per-sample coordinate
+descent versus batched accelerated proximal gradient (BLAS-3)."""
+import itertools
+import time
+
+import numpy as np
+
+from modl.decomposition.dict_fact_fast import _enet_regression_single_gram, \
+    _enet_regression_batched
+
+n_features = 1000
+code_l1_ratio = 1
+tol = 1e-3
+
+rng = np.random.RandomState(0)
+
+print('code_alpha  n_components  batch_size  CD (ms)  batched (ms)  '
+      'max code diff')
+for code_alpha, n_components in itertools.product([0.1, 1], [64, 256]):
+    components = rng.randn(n_components, n_features)
+    components /= np.sqrt(np.sum(components ** 2, axis=1))[:, np.newaxis]
+    G = components.dot(components.T)
+    for batch_size in [10, 100, 1000]:
+        X = rng.randn(batch_size, n_features)
+        Dx = X.dot(components.T)
+        sample_indices = np.arange(batch_size)
+        codes = []
+        timings = []
+        for func in [_enet_regression_single_gram, _enet_regression_batched]:
+            code = np.zeros((batch_size, n_components))
+            t0 = time.perf_counter()
+            func(G, Dx, X, code, sample_indices, code_l1_ratio, code_alpha,
+                 False, tol, 1000)
+            timings.append((time.perf_counter() - t0) * 1e3)
+            codes.append(code)
+        print('%10.1f  %12i  %10i  %7.1f  %12.1f  %13.2e' % (
+            code_alpha, n_components, batch_size, timings[0], timings[1],
+            np.max(np.abs(codes[0] - codes[1]))))
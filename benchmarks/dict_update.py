@@ -0,0 +1,89 @@
+"""Variational dictionary update on a feature subset, on one thread: the
+fused nogil kernel (_update_dict_variational) versus the Python loop over
+atoms with BLAS ger rank-one updates on gathered copies of the subset
+columns, which it replaced. The Python path performs two rank-one updates
+of the whole (n_components, len_subset) block per atom, the kernel a single
+one with the change of the atom, skipping its unchanged entries (zeros of
+sparse atoms). Atoms are first updated once, to reach the sparsity of
+learning with l1_ratio > 0."""
+import itertools
+import time
+
+import numpy as np
+import scipy.linalg
+
+from modl.decomposition.dict_fact_fast import _update_dict_variational
+from modl.utils.math.enet import enet_norm, enet_projection, enet_scale
+
+n_features = 20000
+n_repeat = 5
+
+
+def update_dict_python(components, gradient, C, comp_norm, subset, order,
+                       l1_ratio):
+    """Implementation replaced by _update_dict_variational"""
+    ger, = scipy.linalg.get_blas_funcs(('ger',), (C, components))
+    len_subset = subset.shape[0]
+    components_subset = components[:, subset]
+    atom_temp = np.zeros(len_subset, dtype=components.dtype)
+    gradient_subset = gradient[:, subset]
+    gradient_subset -= C.dot(components_subset)
+    for k in order:
+        comp_norm[k] += enet_norm(components_subset[k], l1_ratio)
+        gradient_subset = ger(1.0, C[k], components_subset[k],
+                              a=gradient_subset, overwrite_a=True)
+        if C[k, k] > 1e-20:
+            components_subset[k] = gradient_subset[k] / C[k, k]
+        enet_projection(components_subset[k], atom_temp, comp_norm[k],
+                        l1_ratio)
+        components_subset[k] = atom_temp
+        comp_norm[k] -= enet_norm(components_subset[k], l1_ratio)
+        gradient_subset = ger(-1.0, C[k], components_subset[k],
+                              a=gradient_subset, overwrite_a=True)
+    components[:, subset] = components_subset
+
+
+rng = np.random.RandomState(0)
+
+print('n_components  reduction  l1_ratio  python (ms)  kernel (ms)  '
+      'speed-up  max diff')
+for n_components, reduction, l1_ratio in itertools.product(
+        [20, 100], [1, 4, 12], [0.5, 1]):
+    code = rng.randn(200, n_components)
+    C = code.T.dot(code) / 200
+    B = code.T.dot(rng.randn(200, n_features)) / 200
+    components = rng.randn(n_components, n_features)
+    for k in range(n_components):
+        enet_scale(components[k], l1_ratio=l1_ratio, radius=1)
+    comp_norm = np.zeros(n_components)
+    _update_dict_variational(components, np.asfortranarray(B), C, comp_norm,
+                             np.arange(n_features), np.arange(n_components),
+                             l1_ratio, False)
+    # Rounding leaves slightly negative budgets for a full update
+    np.maximum(comp_norm, 0, out=comp_norm)
+    subset = np.sort(rng.permutation(n_features)[:n_features // reduction])
+    order = rng.permutation(n_components)
+
+    results = []
+    timings = []
+    for func in ['python', 'kernel']:
+        times = []
+        for _ in range(n_repeat):
+            this_components = components.copy()
+            gradient = np.asfortranarray(B)
+            this_comp_norm = comp_norm.copy()
+            t0 = time.perf_counter()
+            if func == 'python':
+                update_dict_python(this_components, gradient, C,
+                                   this_comp_norm, subset, order, l1_ratio)
+            else:
+                _update_dict_variational(this_components, gradient, C,
+                                         this_comp_norm, subset, order,
+                                         l1_ratio, False)
+            times.append(time.perf_counter() - t0)
+        results.append(this_components)
+        timings.append(np.median(times) * 1e3)
+    print('%12i  %9i  %8.1f  %11.2f  %11.2f  %8.2f  %8.1e' % (
+        n_components, reduction, l1_ratio, timings[0], timings[1],
+        timings[0] / timings[1],
+        np.max(np.abs(results[0] - results[1]))))
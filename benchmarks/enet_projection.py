@@ -0,0 +1,28 @@
+"""Projection on the elastic-net ball: quickselect threshold search versus
+Condat's algorithm, for atom sizes up to a full brain."""
+import time
+
+import numpy as np
+
+from modl.utils.math.enet import enet_projection
+
+sizes = [100, 1000, 10000, 100000, 1000000]
+l1_ratios = [0.1, 0.5, 1]
+radius = 1
+n_repeat = 10
+
+rng = np.random.RandomState(0)
+
+print('size      l1_ratio  quickselect (ms)  condat (ms)')
+for size in sizes:
+    v = rng.randn(size)
+    out = np.empty(size)
+    for l1_ratio in l1_ratios:
+        timings = []
+        for condat in [False, True]:
+            t0 = time.perf_counter()
+            for _ in range(n_repeat):
+                enet_projection(v, out, radius, l1_ratio, condat)
+            timings.append((time.perf_counter() - t0) / n_repeat * 1e3)
+        print('%8i  %8.1f  %16.3f  %11.3f' % ((size, l1_ratio)
+                                             + tuple(timings)))
@@ -0,0 +1,56 @@
+"""Sparse coding of a batch with the OpenMP (prange) kernels versus the
+previous dispatch of batch slices to a ThreadPoolExecutor."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+import numpy as np
+from sklearn.utils import gen_batches
+
+from modl.decomposition.dict_fact_fast import _enet_regression_single_gram
+from modl.utils import get_sub_slice
+
+n_components = 100
+n_features = 400
+n_threads = 4
+code_alpha = 0.1
+n_repeat = 5
+
+rng = np.random.RandomState(0)
+components = rng.randn(n_components, n_features)
+G = components.dot(components.T)
+
+pool = ThreadPoolExecutor(n_threads)
+
+
+def thread_pool_coding(G, Dx, X, code, sample_indices):
+    batch_size = X.shape[0]
+    size_job = ceil(batch_size / n_threads)
+    batches = list(gen_batches(batch_size, size_job))
+    par_func = lambda batch: _enet_regression_single_gram(
+        G, Dx[batch], X[batch], code,
+        get_sub_slice(sample_indices, batch),
+        1, code_alpha, False, 1e-2, 100)
+    list(pool.map(par_func, batches))
+
+
+def openmp_coding(G, Dx, X, code, sample_indices):
+    _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                 1, code_alpha, False, 1e-2, 100, n_threads)
+
+
+print('batch_size  thread pool (ms)  OpenMP (ms)')
+for batch_size in [10, 30, 100, 300, 1000]:
+    X = rng.randn(batch_size, n_features)
+    Dx = X.dot(components.T)
+    sample_indices = np.arange(batch_size)
+    timings = []
+    for func in [thread_pool_coding, openmp_coding]:
+        this_time = 0
+        for _ in range(n_repeat):
+            code = np.ones((batch_size, n_components))
+            t0 = time.perf_counter()
+            func(G, Dx, X, code, sample_indices)
+            this_time += time.perf_counter() - t0
+        timings.append(this_time / n_repeat * 1e3)
+    print('%10i  %16.2f  %11.2f' % ((batch_size, ) + tuple(timings)))
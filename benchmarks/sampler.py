@@ -0,0 +1,30 @@
+"""Per-call cost of Sampler.yield_subset, with and without a preallocated
+output buffer. Cost should scale with the subset size (n_features /
+reduction), not with n_features."""
+import time
+
+import numpy as np
+
+from modl.utils.randomkit import Sampler
+
+n_calls = 200
+
+print('n_features  reduction  len_subset  time/call (us)  '
+      'time/call with out (us)')
+for n_features in [10000, 100000, 1000000]:
+    for reduction in [1, 4, 12, 100]:
+        sampler = Sampler(n_features, rand_size=False, replacement=True,
+                          random_seed=0)
+        t0 = time.perf_counter()
+        for _ in range(n_calls):
+            sampler.yield_subset(reduction)
+        this_time = (time.perf_counter() - t0) / n_calls
+
+        out = np.empty(n_features, dtype='l')
+        t0 = time.perf_counter()
+        for _ in range(n_calls):
+            sampler.yield_subset(reduction, out)
+        this_time_out = (time.perf_counter() - t0) / n_calls
+        print('%10i  %9i  %10i  %14.1f  %23.1f' % (
+            n_features, reduction, n_features // reduction,
+            this_time * 1e6, this_time_out * 1e6))
@@ -0,0 +1,39 @@
+"""Time spent gathering X[:, subset], components_[:, subset] and
+gradient_[:, subset] for the different Sampler orders, as done in
+DictFact._compute_code and DictFact._update_dict, and computing Dx."""
+import time
+
+import numpy as np
+
+from modl.decomposition.dict_fact import _check_contiguous
+from modl.utils.randomkit import Sampler
+
+batch_size = 20
+n_components = 64
+reduction = 12
+n_calls = 50
+
+rng = np.random.RandomState(0)
+
+print('n_features  order    gather + Dx time (ms)')
+for n_features in [100000, 200000]:
+    X = rng.randn(batch_size, n_features)
+    components = rng.randn(n_components, n_features)
+    gradient = np.asfortranarray(rng.randn(n_components, n_features))
+    for order in ['random', 'sorted', 'block']:
+        sampler = Sampler(n_features, rand_size=True, replacement=True,
+                          random_seed=0, order=order)
+        out = np.empty(n_features, dtype='l')
+        this_time = 0
+        for _ in range(n_calls):
+            subset = sampler.yield_subset(reduction, out)
+            t0 = time.perf_counter()
+            if order != 'random':
+                subset = _check_contiguous(subset)
+            X_subset = X[:, subset]
+            components_subset = components[:, subset]
+            gradient_subset = gradient[:, subset]
+            X_subset.dot(components_subset.T)
+            this_time += time.perf_counter() - t0
+        print('%10i  %-7s  %21.3f' % (n_features, order,
+                                      this_time / n_calls * 1e3))
@@ -0,0 +1,54 @@
+"""Coordinate descent passes needed to encode a test set from scratch, and
+warm started from the codes obtained on a slightly perturbed dictionary
+(as when re-scoring a test set along dictionary learning)."""
+import time
+
+import numpy as np
+
+from modl.decomposition.dict_fact import Coder
+from modl.decomposition.dict_fact_fast import _enet_regression_single_gram
+
+n_samples = 1000
+n_features = 400
+n_components = 100
+code_alpha = 0.1
+tol = 1e-4
+max_iter = 1000
+
+rng = np.random.RandomState(0)
+components = rng.randn(n_components, n_features)
+components /= np.sqrt(np.sum(components ** 2, axis=1))[:, np.newaxis]
+X = rng.randn(n_samples, n_features)
+sample_indices = np.arange(n_samples)
+
+previous_code = np.ones((n_samples, n_components))
+G = components.dot(components.T)
+Dx = X.dot(components.T)
+_enet_regression_single_gram(G, Dx, X, previous_code, sample_indices,
+                             1, code_alpha, False, tol, max_iter)
+
+print('perturbation  cold passes  warm passes  cold (ms)  warm (ms)')
+for perturbation in [0, 1e-3, 1e-2, 1e-1]:
+    this_components = components + perturbation * rng.randn(n_components,
+                                                             n_features)
+    G = this_components.dot(this_components.T)
+    Dx = X.dot(this_components.T)
+    results = []
+    for code_init in [np.ones((n_samples, n_components)), previous_code]:
+        code = code_init.copy()
+        n_iter = np.zeros(n_samples, dtype='i')
+        t0 = time.perf_counter()
+        _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                     1, code_alpha, False, tol, max_iter,
+                                     1, n_iter)
+        results += [n_iter.mean(), (time.perf_counter() - t0) * 1e3]
+    print('%12.0e  %11.1f  %11.1f  %9.1f  %9.1f' % (
+        perturbation, results[0], results[2], results[1], results[3]))
+
+# Repeated transforms through the Coder code cache
+coder = Coder(components, code_alpha=code_alpha, tol=tol,
+              max_iter=max_iter, cache_size=n_samples)
+for label in ['first transform', 'cached transform']:
+    t0 = time.perf_counter()
+    coder.transform(X, sample_ids=sample_indices)
+    print('Coder %s: %.1f ms' % (label, (time.perf_counter() - t0) * 1e3))
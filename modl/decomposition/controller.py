@@ -0,0 +1,161 @@
+"""Automatic choice of the reduction and batch size of DictFact batches"""
+from collections import OrderedDict
+
+import numpy as np
+
+# Number of reductions tried between 1 and the reduction set by the user
+N_REDUCTIONS = 4
+
+
+class ReductionController(object):
+    def __init__(self, reduction, batch_size, adapt_reduction=True,
+                 adapt_batch_size=False, window=5, n_exploit=10):
+        """
+        Choose the reduction (and batch size) of batches to maximize the
+        decrease of the surrogate objective per second.
+
+        During an exploration cycle, candidate settings are tried in turn
+        for one batch each, in rounds of rotated order, so that the decay of
+        decreases along learning does not favor any of them. After window
+        rounds, the setting with the largest rate is used for n_exploit
+        windows of window batches, after which a new cycle starts, as the
+        best setting changes along learning.
+
+        Parameters
+        ----------
+        reduction: float
+            Largest reduction to try
+        batch_size: int
+            Initial batch size
+        adapt_reduction: boolean
+            Try reductions geometrically spaced between 1 and reduction
+        adapt_batch_size: boolean
+            Also try batch_size / 2 and 2 * batch_size
+        window: int
+            Number of batches over which the rate of a setting is measured
+        n_exploit: int
+            Number of windows using the best setting between cycles
+
+        Attributes
+        ----------
+        self.candidates_: list of (float, int)
+            Settings (reduction, batch_size) that are tried
+        self.reduction: float
+            Current reduction
+        self.batch_size: int
+            Current batch size
+        self.history_: list of OrderedDict
+            One record per candidate at the end of exploration cycles, and
+            per window in between, with keys 'n_iter', 'phase' ('explore'
+            or 'exploit'), 'reduction', 'batch_size', 'n_batches',
+            'decrease' (of the surrogate objective), 'code_time'
+            (computation of Dx, G and codes), 'dict_time' (statistics and
+            dictionary updates), 'io_time' (time spent out of batches, e.g.
+            loading data) and 'rate' (decrease per second)
+        self.choices_: list of OrderedDict
+            Setting chosen at the end of each exploration cycle, with keys
+            'n_iter', 'reduction', 'batch_size' and 'rate'
+        """
+        if adapt_reduction and reduction > 1:
+            reductions = np.geomspace(1, reduction, N_REDUCTIONS)[::-1]
+            reductions[0] = reduction
+        else:
+            reductions = [reduction]
+        if adapt_batch_size:
+            batch_sizes = [batch_size, max(1, batch_size // 2),
+                           2 * batch_size]
+        else:
+            batch_sizes = [batch_size]
+        self.candidates_ = [(float(this_reduction), this_batch_size)
+                            for this_reduction in reductions
+                            for this_batch_size in batch_sizes]
+        self.window = window
+        self.n_exploit = n_exploit
+
+        self.history_ = []
+        self.choices_ = []
+        self._start_cycle()
+
+    def _start_cycle(self):
+        self._phase = 'explore'
+        self._n_batches = 0
+        self._stats = [self._new_stats() for _ in self.candidates_]
+        self._current = 0
+        self._set(self.candidates_[0])
+
+    def _set(self, candidate):
+        self.reduction, self.batch_size = candidate
+
+    @staticmethod
+    def _new_stats():
+        return OrderedDict([('n_batches', 0), ('decrease', 0.),
+                            ('code_time', 0.), ('dict_time', 0.),
+                            ('io_time', 0.)])
+
+    def _log(self, n_iter, candidate, stats):
+        """Append the record of stats measured with candidate to history_
+        and return the rate"""
+        total_time = (stats['code_time'] + stats['dict_time']
+                      + stats['io_time'])
+        rate = stats['decrease'] / total_time if total_time > 0 else 0.
+        record = OrderedDict([('n_iter', n_iter),
+                              ('phase', self._phase),
+                              ('reduction', candidate[0]),
+                              ('batch_size', candidate[1])])
+        record.update(stats)
+        record['rate'] = rate
+        self.history_.append(record)
+        return rate
+
+    def record(self, n_iter, decrease, code_time, dict_time, io_time):
+        """Account for a batch of the current setting, which decreased the
+        surrogate objective by decrease, and set the setting of the next
+        batch
+
+        Parameters
+        ----------
+        n_iter: int
+            Number of samples seen so far
+        decrease: float
+            Decrease of the surrogate objective in the dictionary update
+        code_time: float
+            Time spent computing Dx, G and codes
+        dict_time: float
+            Time spent updating statistics and the dictionary
+        io_time: float
+            Time spent since the previous batch
+        """
+        stats = self._stats[self._current]
+        stats['n_batches'] += 1
+        stats['decrease'] += decrease
+        stats['code_time'] += code_time
+        stats['dict_time'] += dict_time
+        stats['io_time'] += io_time
+        self._n_batches += 1
+        n_candidates = len(self.candidates_)
+
+        if self._phase == 'explore':
+            if self._n_batches < self.window * n_candidates:
+                n_rounds, position = divmod(self._n_batches, n_candidates)
+                self._current = (position + n_rounds) % n_candidates
+                self._set(self.candidates_[self._current])
+                return
+            rates = [self._log(n_iter, candidate, stats)
+                     for candidate, stats in zip(self.candidates_,
+                                                 self._stats)]
+            best = int(np.argmax(rates))
+            self._set(self.candidates_[best])
+            self.choices_.append(
+                OrderedDict([('n_iter', n_iter),
+                             ('reduction', self.reduction),
+                             ('batch_size', self.batch_size),
+                             ('rate', rates[best])]))
+            self._phase = 'exploit'
+            self._n_batches = 0
+            self._current = best
+            self._stats[best] = self._new_stats()
+        elif self._n_batches % self.window == 0:
+            self._log(n_iter, self.candidates_[self._current], stats)
+            self._stats[self._current] = self._new_stats()
+            if self._n_batches >= self.window * self.n_exploit:
+                self._start_cycle()
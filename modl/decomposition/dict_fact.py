@@ -1,24 +1,55 @@
 import atexit
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-from math import log, ceil
+from math import log
 from tempfile import TemporaryFile
 
 import numpy as np
-import scipy
+import scipy.sparse as sp
 import time
+from scipy.linalg import cho_factor, cho_solve
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils import check_array, check_random_state, gen_batches
+from sklearn.utils.extmath import row_norms, safe_sparse_dot
 from sklearn.utils.validation import check_is_fitted
 
 from modl.utils import get_sub_slice
 from modl.utils.randomkit import RandomState
 from modl.utils.randomkit import Sampler
-from .dict_fact_fast import _enet_regression_multi_gram, \
-    _enet_regression_single_gram, _update_G_average, _batch_weight
-from ..utils.math.enet import enet_norm, enet_projection, enet_scale
+from .dict_fact_fast import _enet_regression_single_gram, _batch_weight, \
+    _update_dict_variational, _enet_regression_batched, \
+    _enet_regression_multi_gram_average
+from .controller import ReductionController
+from .parallel import fit_asynchronous, fit_data_parallel
+from ..utils.math.enet import enet_norm_rows, enet_projection_rows, \
+    enet_scale_rows
 
 MAX_INT = np.iinfo(np.int64).max
 
+# Per-sample statistics, saved incrementally in checkpoints. sample_n_iter_,
+# from which updated rows are found, is written last
+SAMPLE_STATS = ['code_', 'Dx_average_', 'G_average_', 'sample_n_iter_']
+CHECKPOINT_ARRAYS = ['components_', 'C_', 'B_', 'gradient_', 'comp_norm_',
+                     'G_', 'sq_norm_'] + SAMPLE_STATS
+
+# Random states of random_state and feature_sampler_, saved in checkpoints
+CHECKPOINT_STATE = ['random_state_key', 'sampler_box',
+                    'sampler_random_state_key']
+
+# Attributes of the surrogate objective tracking, saved in checkpoints
+SURROGATE_STATE = ['code_penalty_', 'surrogate_', 'surrogate_weight_',
+                   'surrogate_change_', 'surrogate_history_', 'converged_']
+
+# Phases of a batch timed in DictFact.profile_
+PROFILE_PHASES = ['subset', 'Dx_G', 'code', 'stats', 'dict', 'callback']
+# Edges (in seconds) of the bins of per-batch latency histograms
+PROFILE_BIN_EDGES = np.logspace(-6, 2, 33)
+_profile_lock = threading.Lock()
+
 
 class CodingMixin(TransformerMixin):
     def _set_coding_params(self,
@@ -29,7 +60,9 @@ class CodingMixin(TransformerMixin):
                            max_iter=100,
                            code_pos=False,
                            random_state=None,
-                           n_threads=1
+                           n_threads=1,
+                           code_solver='cd',
+                           sparse_comp_threshold=0
                            ):
         self.n_components = n_components
         self.code_l1_ratio = code_l1_ratio
@@ -38,80 +71,212 @@ class CodingMixin(TransformerMixin):
         self.random_state = random_state
         self.tol = tol
         self.max_iter = max_iter
+        self.code_solver = code_solver
+        self.sparse_comp_threshold = sparse_comp_threshold
 
         self.n_threads = n_threads
 
         if self.n_threads > 1:
             self._pool = ThreadPoolExecutor(n_threads)
 
-    def transform(self, X):
+    def transform(self, X, code_init=None, sample_ids=None, out=None,
+                  memory_budget=None):
         """
         Compute the codes associated to input matrix X, decomposing it onto
         the dictionary
 
         Parameters
         ----------
-        X: ndarray, shape = (n_samples, n_features)
+        X: ndarray or CSR matrix, shape = (n_samples, n_features)
+            Input matrix, possibly memory-mapped
+        code_init: ndarray, shape = (n_samples, n_components), optional
+            Initial codes for the elastic-net solver. Warm starting from a
+            close solution (e.g. a previous transform of the same samples)
+            reduces the number of solver iterations
+        sample_ids: sequence, shape = (n_samples), optional
+            Identifiers of the samples of X, used to warm start the solver
+            from known codes when code_init is None (see subclasses)
+        out: ndarray, shape = (n_samples, n_components), optional
+            Array in which to write the codes, e.g. a np.memmap
+        memory_budget: float, optional
+            Memory (in MB) that may be used for temporary arrays. If set, X
+            is processed in chunks of rows so that temporaries fit in this
+            budget. Otherwise X is processed at once
 
         Returns
         -------
         code: ndarray, shape = (n_samples, n_components)
+            out if provided
         """
         check_is_fitted(self, 'components_')
 
         dtype = self.components_.dtype
-        X = check_array(X, order='C', dtype=dtype.type)
-        if X.flags['WRITEABLE'] is False:
+        if memory_budget is None:
+            X = check_array(X, accept_sparse='csr', order='C',
+                            dtype=dtype.type)
+        n_samples, n_features = X.shape
+        if code_init is not None and code_init.shape != (n_samples,
+                                                         self.n_components):
+            raise ValueError('code_init should have shape (%i, %i), '
+                             'got %s' % (n_samples, self.n_components,
+                                         code_init.shape))
+        if sample_ids is not None and len(sample_ids) != n_samples:
+            raise ValueError('sample_ids should have length %i, got %i'
+                             % (n_samples, len(sample_ids)))
+        if out is None:
+            out = np.empty((n_samples, self.n_components), dtype=dtype)
+        elif out.shape != (n_samples, self.n_components):
+            raise ValueError('out should have shape (%i, %i), got %s'
+                             % (n_samples, self.n_components, out.shape))
+        G = self._get_gram()
+        batch_size = _budget_batch_size(memory_budget, n_samples, n_features,
+                                        self.n_components, dtype)
+        for batch in gen_batches(n_samples, batch_size):
+            out[batch] = self._transform(
+                X[batch], G,
+                code_init[batch] if code_init is not None else None,
+                sample_ids[batch] if sample_ids is not None else None)
+        return out
+
+    def _transform(self, X, G, code_init, sample_ids):
+        """Compute the codes of X, using G as Gram matrix"""
+        dtype = self.components_.dtype
+        X = check_array(X, accept_sparse='csr', order='C', dtype=dtype.type)
+        if not sp.issparse(X) and X.flags['WRITEABLE'] is False:
             X = X.copy()
         n_samples, n_features = X.shape
-        if not hasattr(self, 'G_agg') or self.G_agg != 'full':
-            G = self.components_.dot(self.components_.T)
+        Dx = _dot_components(X, self._get_components())
+        if code_init is not None:
+            code = check_array(code_init, order='C', dtype=dtype.type,
+                               copy=True)
+        elif sample_ids is not None:
+            code = self._warm_code(sample_ids, dtype)
         else:
-            G = self.G_
-        Dx = X.dot(self.components_.T)
-        code = np.ones((n_samples, self.n_components), dtype=dtype)
+            code = np.ones((n_samples, self.n_components), dtype=dtype)
         sample_indices = np.arange(n_samples)
-        size_job = ceil(n_samples / self.n_threads)
-        batches = list(gen_batches(n_samples, size_job))
-
-        par_func = lambda batch: _enet_regression_single_gram(
-            G, Dx[batch], X[batch], code,
-            get_sub_slice(sample_indices, batch),
-            self.code_l1_ratio, self.code_alpha, self.code_pos,
-            self.tol, self.max_iter)
-        if self.n_threads > 1:
-            res = self._pool.map(par_func, batches)
-            _ = list(res)
+
+        # G and Dx are computed from the whole dictionary and samples
+        self._single_gram_regression(G, Dx, _solver_rows(X), code,
+                                     sample_indices, screen=True)
+
+        if sample_ids is not None:
+            self._store_code(sample_ids, code)
+
+        return code
+
+    def _get_gram(self):
+        """Gram matrix of the dictionary used in transform"""
+        if not hasattr(self, 'G_agg') or self.G_agg != 'full':
+            return _gram(self._get_components())
         else:
-            _enet_regression_single_gram(
+            return self.G_
+
+    def _get_components(self):
+        """Dictionary to use in products: components_, or its CSC copy
+        components_sparse_ if the density of components_ is below
+        sparse_comp_threshold. The copy is rebuilt when components_ is
+        replaced"""
+        if self.sparse_comp_threshold <= 0:
+            return self.components_
+        if getattr(self, '_sparse_source', None) is not self.components_:
+            self._init_sparse_components()
+        if self.components_sparse_ is None:
+            return self.components_
+        return self.components_sparse_
+
+    def _init_sparse_components(self):
+        """Count non-zero entries of components_ and build its CSC copy if
+        it is sparse enough"""
+        self.comp_nnz_ = np.count_nonzero(self.components_, axis=0)
+        self._sparse_source = self.components_
+        if (np.sum(self.comp_nnz_)
+                < self.sparse_comp_threshold * self.components_.size):
+            self.components_sparse_ = sp.csc_matrix(self.components_)
+        else:
+            self.components_sparse_ = None
+
+    def _warm_code(self, sample_ids, dtype):
+        """Initial codes for samples identified by sample_ids"""
+        return np.ones((len(sample_ids), self.n_components), dtype=dtype)
+
+    def _store_code(self, sample_ids, code):
+        """Record the codes computed for samples identified by sample_ids"""
+        pass
+
+    def _single_gram_regression(self, G, Dx, X, code, sample_indices,
+                                screen=False):
+        """Compute code[sample_indices] for samples X sharing the Gram
+        matrix G, with the solver selected by code_solver. Coordinate
+        descent uses gap safe screening if screen, which requires G and Dx
+        to be computed from the whole dictionary and samples X"""
+        if self.code_solver not in ['cd', 'batched']:
+            raise ValueError("code_solver should be 'cd' or 'batched'")
+        if self.code_solver == 'batched' and self.code_l1_ratio != 0:
+            _enet_regression_batched(
                 G, Dx, X, code,
                 sample_indices,
                 self.code_l1_ratio, self.code_alpha, self.code_pos,
                 self.tol, self.max_iter)
+        else:
+            _enet_regression_single_gram(
+                G, Dx, X, code,
+                sample_indices,
+                self.code_l1_ratio, self.code_alpha, self.code_pos,
+                self.tol, self.max_iter, self.n_threads, screen=screen)
 
-        return code
-
-    def score(self, X):
+    def score(self, X, sample_ids=None, memory_budget=None):
         """
         Objective function value on test data X
 
         Parameters
         ----------
-        X: ndarray, shape=(n_samples, n_features)
-            Input matrix
+        X: ndarray or CSR matrix, shape=(n_samples, n_features)
+            Input matrix, possibly memory-mapped
+        sample_ids: sequence, shape = (n_samples), optional
+            Identifiers of the samples of X, passed to transform
+        memory_budget: float, optional
+            Memory (in MB) that may be used for temporary arrays. If set,
+            codes and residuals are computed on chunks of rows of X so that
+            they fit in this budget
         Returns
         -------
         score: float, positive
         """
         check_is_fitted(self, 'components_')
 
-        code = self.transform(X)
-        loss = np.sum((X - code.dot(self.components_)) ** 2) / 2
-        norm1_code = np.sum(np.abs(code))
-        norm2_code = np.sum(code ** 2)
+        dtype = self.components_.dtype
+        if memory_budget is None:
+            X = check_array(X, accept_sparse='csr', dtype=dtype.type)
+        n_samples, n_features = X.shape
+        batch_size = _budget_batch_size(memory_budget, n_samples, n_features,
+                                        self.n_components, dtype)
+        loss = 0
+        norm1_code = 0
+        norm2_code = 0
+        for batch in gen_batches(n_samples, batch_size):
+            this_X = check_array(X[batch], accept_sparse='csr',
+                                 dtype=dtype.type)
+            code = self.transform(
+                this_X,
+                sample_ids=sample_ids[batch] if sample_ids is not None
+                else None)
+            components = self._get_components()
+            if sp.issparse(this_X):
+                # Expand the residual norm so that no dense (n_samples,
+                # n_features) array is formed
+                Dx = _dot_components(this_X, components)
+                G = _gram(components)
+                loss += (np.sum(row_norms(this_X, squared=True))
+                         - 2 * np.sum(code * Dx)
+                         + np.sum(code.dot(G) * code)) / 2
+            else:
+                loss += np.sum((this_X - safe_sparse_dot(
+                    code, components, dense_output=True)) ** 2) / 2
+            norm1_code += np.sum(np.abs(code))
+            norm2_code += np.sum(code ** 2)
         regul = self.code_alpha * (norm1_code * self.code_l1_ratio
                                    + (1 - self.code_l1_ratio) * norm2_code / 2)
-        return (loss + regul) / X.shape[0]
+        return (loss + regul) / n_samples
 
     def __getstate__(self):
         state = dict(self.__dict__)
@@ -150,6 +315,20 @@ class DictFact(CodingMixin, BaseEstimator):
                  n_threads=1,
                  rand_size=True,
                  replacement=True,
+                 subset_order='random',
+                 code_solver='cd',
+                 G_average_storage='full',
+                 sample_capacity=None,
+                 trace_file=None,
+                 n_jobs=1,
+                 asynchronous=False,
+                 comp_projection='quickselect',
+                 sparse_comp_threshold=0,
+                 adaptive_reduction=False,
+                 adaptive_batch_size=False,
+                 n_iter_no_change=None,
+                 surrogate_tol=1e-4,
+                 background_callback=False,
                  ):
         """
         Estimator to perform matrix factorization by streaming samples and
@@ -215,10 +394,86 @@ class DictFact(CodingMixin, BaseEstimator):
             Tolerance for the elastic-net solver
         max_iter: int, positive
             Maximum iteration for the elastic-net solver
+        code_solver: str in ['cd', 'batched']
+            Solver for the code when samples share a single Gram matrix
+            (G_agg != 'average'). 'cd' runs coordinate descent sample per
+            sample, 'batched' runs accelerated proximal gradient over the
+            whole batch with BLAS-3 operations, which is faster for large
+            batches and many components
         rand_size: boolean
             Whether the masks should have fixed size
         replacement: boolean
             Whether to compute random or cycling masks
+        subset_order: str in ['random', 'sorted', 'block']
+            Order of the features in masks. 'sorted' masks make column
+            gathers cache-friendly, 'block' masks are contiguous runs of
+            features, accessed through views when possible
+        G_average_storage: str in ['full', 'packed', 'half']
+            Layout of G_average_ when G_agg == 'average'. 'packed' only
+            stores the upper triangle of each Gram matrix, 'half' stores it
+            in float16, dividing disk footprint and I/O by 2 and 4
+            (approximately) with respect to 'full'. Computations are
+            performed in the dtype of the data
+        sample_capacity: int or None
+            If set, run in streaming mode: samples are identified by
+            arbitrary hashable ids given as sample_indices to partial_fit,
+            and per-sample statistics (code_, Dx_average_, G_average_,
+            sample_n_iter_) are kept for at most sample_capacity samples.
+            Their arrays grow as new samples are seen, and the statistics of
+            the least recently seen samples are discarded once the capacity
+            is reached. n_samples is then optional in prepare. Should be
+            at least batch_size, or 2 * batch_size if adaptive_batch_size
+        trace_file: str or None
+            If set, path of a JSONL file to which the time spent in each
+            phase (see profile_) is appended after every batch
+        n_jobs: int
+            Number of worker processes used by fit. If larger than 1, samples
+            are split in n_jobs shards, and at each step every worker codes a
+            batch of batch_size samples of its shard against a shared-memory
+            copy of the dictionary. Their contributions to C_ and B_ are
+            merged to update the dictionary (see modl.decomposition.parallel).
+            Requires Python >= 3.8
+        asynchronous: bool
+            If True and n_jobs > 1, workers do not wait for each other: each
+            one fits its shard with its own feature subsets, updating a
+            shared dictionary, C_ and B_ without locks. Requires
+            optimizer='variational'. Updates rarely conflict for large
+            reductions, in particular with subset_order='block'
+        comp_projection: str in ['quickselect', 'condat']
+            Search of the threshold when projecting atoms on the
+            elastic-net ball. 'condat' uses Condat's algorithm, which runs
+            in linear time and is faster for atoms with many features
+        sparse_comp_threshold: float in [0, 1]
+            If the fraction of non-zero entries of components_ falls below
+            this threshold (e.g. with comp_l1_ratio=1), Dx and Gram
+            matrices are computed from a CSC copy of components_, updated
+            on the features of each subset. 0 disables sparse computations.
+            Workers of n_jobs > 1 always use dense computations
+        adaptive_reduction: bool
+            If True, reduction is the largest reduction used: the reduction
+            of batches is chosen among values between 1 and reduction, so
+            as to maximize the decrease of the surrogate objective per
+            second, including the time spent out of partial_fit (e.g. in
+            loading data). See modl.decomposition.controller. Requires
+            optimizer='variational', ignored if n_jobs > 1
+        adaptive_batch_size: bool
+            If True, the batch size is also chosen among batch_size / 2,
+            batch_size and 2 * batch_size. Batches given to partial_fit are
+            split with the batch size chosen at the beginning of the call
+        n_iter_no_change: int or None
+            If not None, fit stops when surrogate_ plateaus: when its
+            values over the last n_iter_no_change batches lie within
+            surrogate_tol (relatively) of each other. Ignored if n_jobs > 1
+        surrogate_tol: float
+            Relative range of surrogate_ over n_iter_no_change batches
+            below which fit stops
+        background_callback: bool
+            If True, callback is called in a background thread with a
+            snapshot of the estimator, holding a copy of components_ taken
+            at the verbose iteration, so that scoring does not stall
+            learning. The time of the snapshot is stored in its
+            snapshot_time_ attribute. fit waits for pending callbacks
+            before returning, see join_callbacks
 
         Attributes
         ----------
@@ -238,15 +493,72 @@ class DictFact(CodingMixin, BaseEstimator):
             Current estimate of D^T X
         self.G_average_: ndarray, shape =
         (n_samples, n_components, n_components)
-            Averaged previously seen subsampled Gram matrix. Memory-mapped
+            Averaged previously seen subsampled Gram matrix. Memory-mapped.
+            With packed storage, shape is
+            (n_samples, n_components * (n_components + 1) / 2)
         self.n_iter_: int
             Number of seen samples
         self.sample_n_iter_: int
             Number of time each sample has been seen
+        self.labels_: ndarray, shape = (n_samples)
+            Index of the sample whose statistics are held in each row of
+            code_, Dx_average_ and G_average_. As shuffle leaves rows in
+            place, this is np.arange(n_samples). In streaming mode, rows
+            are mapped to sample ids by sample_slots_
         self.verbose_iter_: int
             List of verbose iteration
         self.feature_sampler_: Sampler
             Generator of masks
+        self.subset_buffer_: ndarray, shape = (n_features)
+            Preallocated buffer in which masks are drawn
+        self.components_sparse_: CSC matrix or None
+            Copy of components_, when sparse_comp_threshold is reached
+        self.comp_nnz_: ndarray, shape = (n_features)
+            Number of non-zero entries of each column of components_, if
+            sparse_comp_threshold > 0
+        self.surrogate_: float
+            Exponential moving average (over about one pass on the data,
+            normalized by surrogate_weight_) of the surrogate objective
+            1 / 2 tr(D^T D C) - tr(D^T B) + sum(sq_norm_) + code_penalty_,
+            i.e. the objective on seen samples with the codes computed when
+            they were seen. All terms but code_penalty_ are separable over
+            features, and are estimated at each batch on its subset. Only
+            tracked if n_iter_no_change is set or reduction_controller_
+            exists, and left to 0 otherwise
+        self.sq_norm_: ndarray, shape = (n_features)
+            Average of 1 / 2 x_j^2 for each feature j, with the weights of
+            C_ and B_
+        self.code_penalty_: float
+            Average of code penalties, with the weights of C_ and B_
+        self.surrogate_weight_: float
+            Sum of the weights of the moving average surrogate_, which
+            grows to 1, so that early batches are averaged uniformly
+        self.surrogate_history_: list of float
+            Values of surrogate_ at the last n_iter_no_change + 1 batches
+            (2 if n_iter_no_change is None)
+        self.surrogate_change_: float
+            Relative decrease of surrogate_ over surrogate_history_
+        self.converged_: bool
+            Whether the values of surrogate_history_ (once full) lie within
+            surrogate_tol (relatively) of each other
+        self.reduction_controller_: ReductionController or None
+            Controller choosing the reduction and batch size, if
+            adaptive_reduction or adaptive_batch_size. Its history_ and
+            choices_ attributes record its measures and choices
+        self.sample_slots_: OrderedDict
+            In streaming mode, rows of per-sample statistics used by each
+            sample id, from least to most recently seen
+        self.time_: float
+            Time spent in fitting batches, callbacks excluded
+        self.profile_: OrderedDict
+            Time spent in each phase of batches: 'subset' (mask sampling),
+            'Dx_G' (computation of Dx and G), 'code' (regression, including
+            the G_average_ update), 'stats' (C_, B_ and gradient_ updates),
+            'dict' (dictionary update) and 'callback'. Each phase maps to a
+            dict with keys 'total' (seconds), 'count' (number of batches)
+            and 'histogram' (counts of per-batch latencies in the bins of
+            PROFILE_BIN_EDGES, plus one bin below and one above). With
+            n_threads > 1, 'stats' and 'dict' overlap.
         """
 
         self.batch_size = batch_size
@@ -265,7 +577,9 @@ class DictFact(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_solver=code_solver,
+                                sparse_comp_threshold=sparse_comp_threshold)
 
         self.comp_l1_ratio = comp_l1_ratio
         self.comp_pos = comp_pos
@@ -282,6 +596,18 @@ class DictFact(CodingMixin, BaseEstimator):
 
         self.rand_size = rand_size
         self.replacement = replacement
+        self.subset_order = subset_order
+        self.G_average_storage = G_average_storage
+        self.sample_capacity = sample_capacity
+        self.trace_file = trace_file
+        self.n_jobs = n_jobs
+        self.asynchronous = asynchronous
+        self.comp_projection = comp_projection
+        self.adaptive_reduction = adaptive_reduction
+        self.adaptive_batch_size = adaptive_batch_size
+        self.n_iter_no_change = n_iter_no_change
+        self.surrogate_tol = surrogate_tol
+        self.background_callback = background_callback
 
     def fit(self, X):
         """
@@ -290,24 +616,54 @@ class DictFact(CodingMixin, BaseEstimator):
         1 / 2 || X - D A ||_2 + (1 - r) || A ||_2 / 2 + r || A ||_1
         Parameters
         ----------
-        X:  ndarray, shape= (n_samples, n_features)
+        X:  ndarray or CSR matrix, shape= (n_samples, n_features)
 
         Returns
         -------
         self
         """
-        X = check_array(X, order='C', dtype=[np.float32, np.float64])
+        X = check_array(X, accept_sparse='csr', order='C',
+                        dtype=[np.float32, np.float64])
         if self.dict_init is None:
             dict_init = X
         else:
             dict_init = check_array(self.dict_init,
                                     dtype=X.dtype.type)
-        self.prepare(n_samples=X.shape[0], X=dict_init)
-        # Main loop
-        for _ in range(self.n_epochs):
-            self.partial_fit(X)
-            permutation = self.shuffle()
-            X = X[permutation]
+        n_samples = X.shape[0]
+        if self.n_jobs > 1:
+            if self.sample_capacity is not None:
+                raise ValueError('n_jobs > 1 is not supported in streaming '
+                                 'mode')
+            if self.asynchronous and self.optimizer != 'variational':
+                raise ValueError("asynchronous fit requires "
+                                 "optimizer='variational'")
+            # Workers update the per-sample statistics of their shard in
+            # shared memory, which are copied back at the end
+            self.prepare(n_samples=n_samples, X=dict_init)
+            if self.asynchronous:
+                fit_asynchronous(self, X)
+            else:
+                fit_data_parallel(self, X)
+            self.join_callbacks()
+            return self
+        self.prepare(n_samples=n_samples, X=dict_init)
+        # Main loop: X and statistics stay in place, batches are read
+        # through a permutation of the samples
+        permutation = np.arange(n_samples)
+        for i in range(self.n_epochs):
+            if i >= 1:
+                permutation = self.shuffle(n_samples)
+            for batch in self._gen_batches(n_samples):
+                these_sample_indices = permutation[batch]
+                self._single_batch_fit(X[these_sample_indices],
+                                       these_sample_indices)
+                if self.converged_:
+                    break
+            if self.converged_:
+                if self.verbose:
+                    print('Converged at iteration %i' % self.n_iter_)
+                break
+        self.join_callbacks()
         return self
 
     def partial_fit(self, X, sample_indices=None):
@@ -316,19 +672,25 @@ class DictFact(CodingMixin, BaseEstimator):
 
         Parameters
         ----------
-        X: ndarray, shape (n_samples, n_features)
+        X: ndarray or CSR matrix, shape (n_samples, n_features)
             Input data
         sample_indices:
             Indices for each row of X. If None, consider that row i index is i
-            (useful when providing the whole data to the function)
+            (useful when providing the whole data to the function). In
+            streaming mode (sample_capacity is set), sequence of hashable
+            sample ids, which must be provided
         Returns
         -------
         self
         """
-        X = check_array(X, dtype=[np.float32, np.float64], order='C')
+        X = check_array(X, accept_sparse='csr', dtype=[np.float32, np.float64],
+                        order='C')
 
         n_samples, n_features = X.shape
-        batches = gen_batches(n_samples, self.batch_size)
+        if self.sample_capacity is not None and sample_indices is None:
+            raise ValueError('sample_indices should be provided in streaming '
+                             'mode')
+        batches = gen_batches(n_samples, self._get_batch_size())
 
         for batch in batches:
             this_X = X[batch]
@@ -352,30 +714,212 @@ class DictFact(CodingMixin, BaseEstimator):
         G_agg = params.pop('G_agg', None)
         if G_agg == 'full' and self.G_agg != 'full':
             if hasattr(self, 'components_'):
-                self.G_ = self.components_.dot(self.components_.T)
+                self.G_ = _gram(self._get_components())
             self.G_agg = 'full'
         BaseEstimator.set_params(self, **params)
 
-    def shuffle(self):
+    def shuffle(self, n_samples=None):
         """
-        Shuffle regression statistics, code_,
-        G_average_ and Dx_average_ and return the permutation used
+        Draw a random order of the samples for the next epoch. Regression
+        statistics (code_, G_average_ and Dx_average_) are indexed by sample
+        and stay in place: rows X[permutation[batch]] should be given to
+        partial_fit along with sample_indices=permutation[batch].
+
+        Parameters
+        ----------
+        n_samples: int, optional
+            Number of samples, defaults to the number of rows of code_
 
         Returns
         -------
         permutation: ndarray, shape = (n_samples)
-            Permutation used in shuffling regression statistics
+            Order in which to visit samples
         """
+        if n_samples is None:
+            n_samples = self.code_.shape[0]
+        return self.random_state.permutation(n_samples)
 
-        random_seed = self.random_state.randint(MAX_INT)
-        random_state = RandomState(random_seed)
-        list = [self.code_]
-        if self.G_agg == 'average':
-            list.append(self.G_average_)
-        list.append(self.Dx_average_)
-        perm = random_state.shuffle_with_trace(list)
-        self.labels_ = self.labels_[perm]
-        return perm
+    def save_checkpoint(self, path):
+        """
+        Save the state of the estimator in directory path, from which
+        learning can be resumed with load_checkpoint.
+
+        State arrays are written as .npy files, along with a JSON manifest
+        holding parameters, counters, the states of random_state and
+        feature_sampler_ and the names of the files. Successive checkpoints
+        alternate between two sets of files and the manifest is replaced
+        last, so that an interrupted save leaves the previous checkpoint
+        intact. If the files to overwrite hold the checkpoint before the
+        previous one, with the same shapes, only the rows of per-sample
+        statistics (code_, Dx_average_, G_average_) of samples seen since
+        are written.
+
+        Parameters
+        ----------
+        path: str
+            Checkpoint directory, created if needed
+        """
+        check_is_fitted(self, 'components_')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        arrays = OrderedDict()
+        for name in CHECKPOINT_ARRAYS:
+            if hasattr(self, name):
+                array = getattr(self, name)
+                arrays[name] = {'shape': list(array.shape),
+                                'dtype': array.dtype.str}
+
+        manifest_file = os.path.join(path, 'manifest.json')
+        generation = 0
+        previous = None
+        # Files of the checkpoint before the previous one, overwritten
+        replaced = None
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                current = json.load(f)
+            generation = current['generation'] + 1
+            previous = {'arrays': current['arrays'],
+                        'files': current['files']}
+            replaced = current['previous']
+        files = {name: '%s.%i.npy' % (name, generation % 2)
+                 for name in list(arrays) + CHECKPOINT_STATE}
+        files['sample_slots'] = 'sample_slots.%i.pkl' % (generation % 2)
+        updated = None
+        if (self.sample_capacity is None and replaced is not None
+                and replaced['arrays'] == arrays
+                and all(replaced['files'][name] == files[name]
+                        for name in SAMPLE_STATS)):
+            saved_sample_n_iter = np.load(
+                os.path.join(path, files['sample_n_iter_']), mmap_mode='r')
+            updated = np.nonzero(saved_sample_n_iter
+                                 != self.sample_n_iter_)[0]
+            del saved_sample_n_iter
+
+        for name in arrays:
+            array = getattr(self, name)
+            filename = os.path.join(path, files[name])
+            if (isinstance(array, np.memmap) and array.mode == 'r+'
+                    and array.filename == os.path.abspath(filename)):
+                # Restored in place from these files
+                array.flush()
+            elif (updated is not None and name in SAMPLE_STATS
+                  and name != 'sample_n_iter_'):
+                saved = np.lib.format.open_memmap(filename, mode='r+')
+                saved[updated] = array[updated]
+                saved.flush()
+                del saved
+            else:
+                _save_array(filename, array)
+
+        rs_state = self.random_state.get_state()
+        box, lim_inf, lim_sup, sampler_rs_state = \
+            self.feature_sampler_.get_state()
+        for name, array in zip(CHECKPOINT_STATE,
+                               [rs_state[1], box, sampler_rs_state[0]]):
+            _save_array(os.path.join(path, files[name]), array)
+        if self.sample_capacity is not None:
+            filename = os.path.join(path, files['sample_slots'])
+            with open(filename + '.tmp', 'wb') as f:
+                pickle.dump(self.sample_slots_, f)
+            os.replace(filename + '.tmp', filename)
+
+        params = self.get_params()
+        for param in ['dict_init', 'callback', 'random_state']:
+            params[param] = None
+        manifest = {'params': params,
+                    'arrays': arrays,
+                    'files': files,
+                    'generation': generation,
+                    'previous': previous,
+                    'n_iter_': self.n_iter_,
+                    'time_': self.time_,
+                    'surrogate': [getattr(self, name)
+                                  for name in SURROGATE_STATE],
+                    'random_state': rs_state[2:],
+                    'sampler': [lim_inf, lim_sup, sampler_rs_state[1:]]}
+        if hasattr(self, 'verbose_iter_'):
+            manifest['verbose_iter_'] = self.verbose_iter_
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, default=_to_json)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    @classmethod
+    def load_checkpoint(cls, path, mmap_mode='c'):
+        """
+        Restore an estimator saved with save_checkpoint.
+
+        Parameters
+        ----------
+        path: str
+            Checkpoint directory
+        mmap_mode: str in ['c', 'r+'] or None
+            State arrays are memory-mapped from the checkpoint files, without
+            copy. With 'c', modifications are kept in memory and the files
+            are left untouched. With 'r+', learning updates the checkpoint
+            in place (which is then consistent only after save_checkpoint).
+            With None, arrays are loaded in memory
+
+        Returns
+        -------
+        estimator: DictFact
+            callback and dict_init are not restored
+        """
+        if mmap_mode not in ['c', 'r+', None]:
+            raise ValueError("mmap_mode should be 'c', 'r+' or None")
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        files = manifest['files']
+        estimator = cls(**manifest['params'])
+        for name in manifest['arrays']:
+            setattr(estimator, name,
+                    np.load(os.path.join(path, files[name]),
+                            mmap_mode=mmap_mode))
+        estimator.n_iter_ = manifest['n_iter_']
+        estimator.time_ = manifest['time_']
+        estimator.labels_ = np.arange(estimator.code_.shape[0])
+        estimator._init_surrogate()
+        if not hasattr(estimator, 'sq_norm_'):
+            estimator.sq_norm_ = np.zeros_like(estimator.components_[0])
+        if 'surrogate' in manifest:
+            for name, value in zip(SURROGATE_STATE, manifest['surrogate']):
+                setattr(estimator, name, value)
+        if 'verbose_iter_' in manifest:
+            estimator.verbose_iter_ = manifest['verbose_iter_']
+
+        estimator.random_state = np.random.RandomState()
+        key = np.load(os.path.join(path, files['random_state_key']))
+        estimator.random_state.set_state(('MT19937', key)
+                                         + tuple(manifest['random_state']))
+        n_features = estimator.components_.shape[1]
+        estimator.feature_sampler_ = Sampler(n_features, estimator.rand_size,
+                                             estimator.replacement, 0,
+                                             order=estimator.subset_order)
+        lim_inf, lim_sup, sampler_rs_state = manifest['sampler']
+        box = np.load(os.path.join(path, files['sampler_box']))
+        key = np.load(os.path.join(path, files['sampler_random_state_key']))
+        estimator.feature_sampler_.set_state(
+            (box, lim_inf, lim_sup, [key] + sampler_rs_state))
+        estimator.subset_buffer_ = np.empty(n_features, dtype='l')
+        estimator._init_profile()
+        estimator._init_controller()
+        if estimator.sample_capacity is not None:
+            with open(os.path.join(path, files['sample_slots']), 'rb') as f:
+                estimator.sample_slots_ = pickle.load(f)
+        return estimator
+
+    def _warm_code(self, sample_ids, dtype):
+        """Start from the codes of training samples: sample_ids are indices
+        of rows in the training set, as sample_indices in partial_fit"""
+        if not hasattr(self, 'code_'):
+            return CodingMixin._warm_code(self, sample_ids, dtype)
+        if self.sample_capacity is None:
+            return self.code_[np.asarray(sample_ids)].astype(dtype)
+        code = CodingMixin._warm_code(self, sample_ids, dtype)
+        for ii, sample_id in enumerate(sample_ids):
+            slot = self.sample_slots_.get(sample_id)
+            if slot is not None:
+                code[ii] = self.code_[slot]
+        return code
 
     def prepare(self, n_samples=None, n_features=None,
                 dtype=None, X=None):
@@ -385,12 +929,13 @@ class DictFact(CodingMixin, BaseEstimator):
         Parameters
         ----------
         n_samples: int,
-
+            Optional in streaming mode, where it only sets the initial number
+            of allocated sample slots
         n_features: int,
 
         dtype: dtype in np.float32, np.float64
              to use in the estimator. Override X.dtype if provided
-        X: ndarray, shape (> n_components, n_features)
+        X: ndarray or CSR matrix, shape (> n_components, n_features)
             Array to use to determine shape and types, and init dictionary if
             provided
 
@@ -399,7 +944,8 @@ class DictFact(CodingMixin, BaseEstimator):
         self
         """
         if X is not None:
-            X = check_array(X, order='C', dtype=[np.float32, np.float64])
+            X = check_array(X, accept_sparse='csr', order='C',
+                            dtype=[np.float32, np.float64])
             if dtype is None:
                 dtype = X.dtype
             # Transpose to fit usual column streaming
@@ -412,7 +958,8 @@ class DictFact(CodingMixin, BaseEstimator):
                 if n_features != X.shape[1]:
                     raise ValueError('n_features and X does not match')
         else:
-            if n_features is None or n_samples is None:
+            if n_features is None or (n_samples is None
+                                      and self.sample_capacity is None):
                 raise ValueError('Either provide'
                                  'shape or data to function prepare.')
             if dtype is None:
@@ -426,23 +973,37 @@ class DictFact(CodingMixin, BaseEstimator):
             self.G_agg = 'full'
             self.Dx_agg = 'full'
 
+        if self.sample_capacity is not None:
+            # Largest batch size the controller may choose
+            max_batch_size = (2 * self.batch_size if self.adaptive_batch_size
+                              else self.batch_size)
+            if self.sample_capacity < max_batch_size:
+                raise ValueError('sample_capacity should be larger than '
+                                 'batch_size, or 2 * batch_size with '
+                                 'adaptive_batch_size')
+            if n_samples is None:
+                n_samples = self.batch_size
+            n_samples = min(n_samples, self.sample_capacity)
+            self.sample_slots_ = OrderedDict()
+
+        if self.comp_projection not in ['quickselect', 'condat']:
+            raise ValueError("comp_projection should be 'quickselect' or "
+                             "'condat'")
+        if ((self.adaptive_reduction or self.adaptive_batch_size)
+                and self.optimizer != 'variational'):
+            raise ValueError("adaptive_reduction and adaptive_batch_size "
+                             "require optimizer='variational'")
+
         # Regression statistics
-        if self.G_agg == 'average':
-            with TemporaryFile() as self.G_average_mmap_:
-                self.G_average_mmap_ = TemporaryFile()
-                self.G_average_ = np.memmap(self.G_average_mmap_, mode='w+',
-                                            shape=(n_samples,
-                                                   self.n_components,
-                                                   self.n_components),
-                                            dtype=dtype)
-            atexit.register(self._exit)
-        self.Dx_average_ = np.zeros((n_samples, self.n_components),
-                                    dtype=dtype)
+        if (self.G_agg == 'average' and self.G_average_storage
+                not in ['full', 'packed', 'half']):
+            raise ValueError("G_average_storage should be 'full', "
+                             "'packed' or 'half'")
+        self._init_sample_stats(n_samples, dtype)
         # Dictionary statistics
         self.C_ = np.zeros((self.n_components, self.n_components), dtype=dtype)
         self.B_ = np.zeros((self.n_components, n_features), dtype=dtype)
-        self.gradient_ = np.zeros((self.n_components, n_features), dtype=dtype,
-                                  order='F')
+        self._init_update_buffers(n_features, dtype)
 
         self.random_state = check_random_state(self.random_state)
         if X is None:
@@ -454,86 +1015,431 @@ class DictFact(CodingMixin, BaseEstimator):
         else:
             random_idx = self.random_state.permutation(this_n_samples)[
                          :self.n_components]
-            self.components_ = check_array(X[random_idx], dtype=dtype.type,
+            components = X[random_idx]
+            if sp.issparse(components):
+                components = components.toarray()
+            self.components_ = check_array(components, dtype=dtype.type,
                                            copy=True)
         if self.comp_pos:
             self.components_[self.components_ <= 0] = \
                 - self.components_[self.components_ <= 0]
-        for i in range(self.n_components):
-            enet_scale(self.components_[i],
-                       l1_ratio=self.comp_l1_ratio,
-                       radius=1)
+        enet_scale_rows(self.components_, self.comp_l1_ratio, 1,
+                        self.n_threads)
 
         self.code_ = np.ones((n_samples, self.n_components), dtype=dtype)
-
         self.labels_ = np.arange(n_samples)
 
         self.comp_norm_ = np.zeros(self.n_components, dtype=dtype)
 
         if self.G_agg == 'full':
-            self.G_ = self.components_.dot(self.components_.T)
+            self.G_ = _gram(self._get_components())
 
         self.n_iter_ = 0
+        self._init_sampler(n_features)
+        if self.sample_capacity is not None:
+            n_samples = self.sample_capacity
+        self._init_verbose(n_samples)
+        self.time_ = 0
+        self._init_profile()
+        self._init_controller()
+        self._init_surrogate()
+        return self
+
+    def _init_sample_stats(self, n_samples, dtype):
+        """Allocate the per-sample statistics used in coding, besides code_:
+        Dx_average_, G_average_ and sample_n_iter_"""
+        if self.G_agg == 'average':
+            self._init_G_average(n_samples, dtype)
+            atexit.register(self._exit)
+        self.Dx_average_ = np.zeros((n_samples, self.n_components),
+                                    dtype=dtype)
         self.sample_n_iter_ = np.zeros(n_samples, dtype='int')
+
+    def _init_update_buffers(self, n_features, dtype):
+        """Allocate the arrays used in dictionary updates, besides C_ and
+        B_"""
+        self.sq_norm_ = np.zeros(n_features, dtype=dtype)
+        self.gradient_ = np.zeros((self.n_components, n_features), dtype=dtype,
+                                  order='F')
+
+    def _init_sampler(self, n_features):
+        """Seed the Sampler of feature subsets from random_state"""
         self.random_state = check_random_state(self.random_state)
         random_seed = self.random_state.randint(MAX_INT)
         self.feature_sampler_ = Sampler(n_features, self.rand_size,
-                                        self.replacement, random_seed)
+                                        self.replacement, random_seed,
+                                        order=self.subset_order)
+        self.subset_buffer_ = np.empty(n_features, dtype='l')
+
+    def _init_G_average(self, n_samples, dtype):
+        """Allocate G_average_ for n_samples in a memory-mapped temporary
+        file"""
+        if self.G_average_storage == 'full':
+            G_average_shape = (n_samples, self.n_components,
+                               self.n_components)
+        else:
+            G_average_shape = (n_samples, self.n_components
+                               * (self.n_components + 1) // 2)
+        if self.G_average_storage == 'half':
+            G_average_dtype = np.float16
+        else:
+            G_average_dtype = dtype
+        with TemporaryFile() as self.G_average_mmap_:
+            self.G_average_mmap_ = TemporaryFile()
+            self.G_average_ = np.memmap(self.G_average_mmap_, mode='w+',
+                                        shape=G_average_shape,
+                                        dtype=G_average_dtype)
+
+    def _get_slots(self, sample_ids):
+        """Rows of per-sample statistics to use for sample_ids in streaming
+        mode. Unseen samples are given new rows, allocated by doubling the
+        statistics arrays up to sample_capacity, or the rows of the least
+        recently seen samples, whose statistics are reset"""
+        # Samples of the batch are moved to the end of sample_slots_ as they
+        # are seen: as long as they fit, evicted rows are never rows already
+        # given to the batch
+        if len(set(sample_ids)) > self.sample_capacity:
+            raise ValueError('Batch of %i distinct samples does not fit in '
+                             'sample_capacity=%i'
+                             % (len(set(sample_ids)), self.sample_capacity))
+        slots = np.empty(len(sample_ids), dtype='int')
+        fresh = []
+        for ii, sample_id in enumerate(sample_ids):
+            slot = self.sample_slots_.get(sample_id)
+            if slot is None:
+                if len(self.sample_slots_) < self.sample_capacity:
+                    slot = len(self.sample_slots_)
+                else:
+                    _, slot = self.sample_slots_.popitem(last=False)
+                self.sample_slots_[sample_id] = slot
+                fresh.append(slot)
+            else:
+                self.sample_slots_.move_to_end(sample_id)
+            slots[ii] = slot
+        n_slots = self.code_.shape[0]
+        if len(self.sample_slots_) > n_slots:
+            self._grow_sample_stats(min(max(2 * n_slots,
+                                            len(self.sample_slots_)),
+                                        self.sample_capacity))
+        self.code_[fresh] = 1
+        self.Dx_average_[fresh] = 0
+        self.sample_n_iter_[fresh] = 0
+        return slots
+
+    def _grow_sample_stats(self, n_slots):
+        """Reallocate per-sample statistics with n_slots rows"""
+        n_old_slots = self.code_.shape[0]
+        dtype = self.components_.dtype
+        code = np.ones((n_slots, self.n_components), dtype=dtype)
+        code[:n_old_slots] = self.code_
+        self.code_ = code
+        Dx_average = np.zeros((n_slots, self.n_components), dtype=dtype)
+        Dx_average[:n_old_slots] = self.Dx_average_
+        self.Dx_average_ = Dx_average
+        sample_n_iter = np.zeros(n_slots, dtype='int')
+        sample_n_iter[:n_old_slots] = self.sample_n_iter_
+        self.sample_n_iter_ = sample_n_iter
+        self.labels_ = np.arange(n_slots)
+        if self.G_agg == 'average':
+            G_average = self.G_average_
+            # None if restored from a checkpoint
+            G_average_mmap = getattr(self, 'G_average_mmap_', None)
+            self._init_G_average(n_slots, dtype)
+            self.G_average_[:n_old_slots] = G_average
+            del G_average
+            if G_average_mmap is not None:
+                G_average_mmap.close()
+
+    def _init_verbose(self, n_samples):
         if self.verbose:
             log_lim = log(n_samples * self.n_epochs / self.batch_size, 10)
             self.verbose_iter_ = (np.logspace(0, log_lim, self.verbose,
                                               base=10) - 1) * self.batch_size
             self.verbose_iter_ = self.verbose_iter_.tolist()
-        self.time_ = 0
-        return self
+
+    def _init_profile(self):
+        self.profile_ = OrderedDict(
+            (phase, {'total': 0., 'count': 0,
+                     'histogram': np.zeros(len(PROFILE_BIN_EDGES) + 1,
+                                           dtype='int')})
+            for phase in PROFILE_PHASES)
+        self._batch_times = OrderedDict()
+
+    def _init_surrogate(self):
+        self.code_penalty_ = 0.
+        self.surrogate_ = 0.
+        self.surrogate_weight_ = 0.
+        self.surrogate_change_ = None
+        self.surrogate_history_ = []
+        self.converged_ = False
+
+    def _tracks_surrogate(self):
+        """Whether surrogate_ is needed, for stopping on plateaus or by
+        reduction_controller_"""
+        return (self.n_iter_no_change is not None
+                or getattr(self, 'reduction_controller_', None) is not None)
+
+    def _update_surrogate(self, X, code, subset, w):
+        """Update surrogate_ and check for convergence after a batch of
+        samples X with codes code, features subset and weight w"""
+        t0 = time.perf_counter()
+        batch_size, n_features = X.shape
+        if sp.issparse(X):
+            sq_norm = np.asarray(X.multiply(X).sum(axis=0)).ravel()
+        else:
+            sq_norm = np.sum(X ** 2, axis=0)
+        sq_norm /= 2 * batch_size
+        penalty = self.code_alpha * (self.code_l1_ratio * np.sum(np.abs(code))
+                                     + (1 - self.code_l1_ratio)
+                                     * np.sum(code ** 2) / 2) / batch_size
+        if self.optimizer == 'variational':
+            self.sq_norm_ *= 1 - w
+            self.sq_norm_ += w * sq_norm
+            self.code_penalty_ *= 1 - w
+            self.code_penalty_ += w * penalty
+        else:
+            self.sq_norm_[:] = sq_norm
+            self.code_penalty_ = penalty
+        # Per-feature terms are non-negative and small: their sum is
+        # estimated from subset with a moderate variance. Batches are
+        # weighted by the fraction of features they see
+        sq_norm_subset = self.sq_norm_[subset]
+        len_subset = sq_norm_subset.shape[0]
+        if len_subset > 0:
+            surrogate = float((self._subset_surrogate
+                               + np.sum(sq_norm_subset))
+                              * n_features / len_subset + self.code_penalty_)
+            alpha = min(1., batch_size / (self.code_.shape[0] + 1)
+                        * len_subset * self._get_reduction() / n_features)
+            weight = (1 - alpha) * self.surrogate_weight_ + alpha
+            self.surrogate_ = ((1 - alpha) * self.surrogate_weight_
+                               * self.surrogate_ + alpha * surrogate) / weight
+            self.surrogate_weight_ = weight
+
+            if self.n_iter_no_change is None:
+                history_size = 2
+            else:
+                history_size = self.n_iter_no_change + 1
+            self.surrogate_history_.append(self.surrogate_)
+            del self.surrogate_history_[:-history_size]
+            if len(self.surrogate_history_) > 1:
+                first = self.surrogate_history_[0]
+                self.surrogate_change_ = ((first - self.surrogate_)
+                                          / abs(self.surrogate_))
+                spread = (max(self.surrogate_history_)
+                          - min(self.surrogate_history_))
+                self.converged_ = (
+                    self.n_iter_no_change is not None
+                    and len(self.surrogate_history_) == history_size
+                    and spread < self.surrogate_tol * abs(self.surrogate_))
+        self._add_time('stats', t0)
+
+    def _init_controller(self):
+        """Create reduction_controller_ if the reduction or batch size are
+        adaptive"""
+        if self.adaptive_reduction or self.adaptive_batch_size:
+            self.reduction_controller_ = ReductionController(
+                self.reduction, self.batch_size,
+                adapt_reduction=self.adaptive_reduction,
+                adapt_batch_size=self.adaptive_batch_size)
+        else:
+            self.reduction_controller_ = None
+        self._batch_end = None
+
+    def _get_reduction(self):
+        """Reduction of the next batch"""
+        controller = getattr(self, 'reduction_controller_', None)
+        if controller is None:
+            return self.reduction
+        return controller.reduction
+
+    def _get_batch_size(self):
+        """Size of the next batch"""
+        controller = getattr(self, 'reduction_controller_', None)
+        if controller is None:
+            return self.batch_size
+        return controller.batch_size
+
+    def _gen_batches(self, n_samples):
+        """Slices of batches over n_samples, of which the size may change
+        between batches"""
+        start = 0
+        while start < n_samples:
+            stop = min(start + self._get_batch_size(), n_samples)
+            yield slice(start, stop)
+            start = stop
+
+    def _control(self, batch_times, t_start):
+        """Report the time and surrogate decrease of the batch that started
+        at t_start to reduction_controller_"""
+        if self._batch_end is None:
+            io_time = 0
+        else:
+            io_time = t_start - self._batch_end
+        code_time = sum(batch_times.get(phase, 0)
+                        for phase in ['subset', 'Dx_G', 'code'])
+        dict_time = sum(batch_times.get(phase, 0)
+                        for phase in ['stats', 'dict'])
+        self.reduction_controller_.record(self.n_iter_,
+                                          self._surrogate_decrease,
+                                          code_time, dict_time, io_time)
+        self._batch_end = time.perf_counter()
+
+    def _add_time(self, phase, t0):
+        """Add the time elapsed since t0 to phase for the current batch and
+        return the current time"""
+        t1 = time.perf_counter()
+        with _profile_lock:
+            self._batch_times[phase] = (self._batch_times.get(phase, 0)
+                                        + t1 - t0)
+        return t1
+
+    def _record_batch_times(self, batch_size):
+        """Accumulate the times of the current batch in profile_, and write
+        them to trace_file"""
+        for phase, this_time in self._batch_times.items():
+            profile = self.profile_[phase]
+            profile['total'] += this_time
+            profile['count'] += 1
+            profile['histogram'][np.searchsorted(PROFILE_BIN_EDGES,
+                                                 this_time)] += 1
+        if self.trace_file is not None:
+            if getattr(self, '_trace', None) is None:
+                # Line buffered
+                self._trace = open(self.trace_file, 'a', buffering=1)
+            record = OrderedDict([('n_iter', self.n_iter_),
+                                  ('batch_size', batch_size),
+                                  ('reduction', self._get_reduction()),
+                                  ('surrogate', self.surrogate_)])
+            record.update(self._batch_times)
+            self._trace.write(json.dumps(record) + '\n')
+        self._batch_times = OrderedDict()
 
     def _callback(self):
         if self.callback is not None:
-            self.callback(self)
-
-    def _single_batch_fit(self, X, sample_indices):
-        """Fit a single batch X: compute code, update statistics, update the
-        dictionary"""
+            if self.background_callback:
+                self._background(self.callback, self._snapshot())
+            else:
+                self.callback(self)
+
+    def _snapshot(self):
+        """Shallow copy of the estimator holding a copy of the arrays
+        modified in place by learning (components_, and G_ if
+        G_agg == 'full'), so that it can be scored while learning goes on.
+        Other statistics are shared and should not be relied upon"""
+        snapshot = object.__new__(self.__class__)
+        snapshot.__dict__ = dict(self.__dict__)
+        snapshot.components_ = self.components_.copy()
+        if self.G_agg == 'full':
+            snapshot.G_ = self.G_.copy()
+        # components_sparse_ is replaced, not modified, by updates
+        if getattr(self, '_sparse_source', None) is self.components_:
+            snapshot._sparse_source = snapshot.components_
+        snapshot.snapshot_time_ = time.perf_counter()
+        snapshot._callback_pool = None
+        snapshot._callback_futures = []
+        return snapshot
+
+    def _background(self, func, *args):
+        """Call func(*args) in the callback thread, after raising the
+        exceptions of finished calls"""
+        if getattr(self, '_callback_pool', None) is None:
+            self._callback_pool = ThreadPoolExecutor(1)
+            self._callback_futures = []
+        futures = []
+        for future in self._callback_futures:
+            if future.done():
+                future.result()
+            else:
+                futures.append(future)
+        futures.append(self._callback_pool.submit(func, *args))
+        self._callback_futures = futures
+
+    def join_callbacks(self):
+        """Wait for the callbacks running in background (see
+        background_callback), raising their exceptions. Useful after
+        partial_fit, as fit calls it before returning"""
+        futures = getattr(self, '_callback_futures', [])
+        self._callback_futures = []
+        for future in futures:
+            future.result()
+
+    def _check_verbose(self):
+        """Print progress and call callback at verbose iterations"""
         if (self.verbose and self.verbose_iter_
             and self.n_iter_ >= self.verbose_iter_[0]):
             print('Iteration %i' % self.n_iter_)
             self.verbose_iter_ = self.verbose_iter_[1:]
+            t0 = time.perf_counter()
             self._callback()
-        if X.flags['WRITEABLE'] is False:
+            self._add_time('callback', t0)
+
+    def _draw_subset(self):
+        """Draw the subset of features seen by the next batch"""
+        t0 = time.perf_counter()
+        subset = self.feature_sampler_.yield_subset(self._get_reduction(),
+                                                    self.subset_buffer_)
+        if self.subset_order != 'random':
+            subset = _check_contiguous(subset)
+        self._add_time('subset', t0)
+        return subset
+
+    def _code_batch(self, X, sample_indices, subset):
+        """Update per-sample counters and compute the code of batch X, of
+        which rows are samples sample_indices"""
+        self.sample_n_iter_[sample_indices] += 1
+        this_sample_n_iter = self.sample_n_iter_[sample_indices]
+        w_sample = np.power(this_sample_n_iter, -self.sample_learning_rate). \
+            astype(self.components_.dtype)
+        self._compute_code(X, sample_indices, w_sample, subset)
+        return self.code_[sample_indices]
+
+    def _single_batch_fit(self, X, sample_indices):
+        """Fit a single batch X: compute code, update statistics, update the
+        dictionary"""
+        t_start = time.perf_counter()
+        self._check_verbose()
+        if not sp.issparse(X) and X.flags['WRITEABLE'] is False:
             X = X.copy()
         t0 = time.perf_counter()
+        if self.sample_capacity is not None:
+            sample_indices = self._get_slots(sample_indices)
 
-        subset = self.feature_sampler_.yield_subset(self.reduction)
+        subset = self._draw_subset()
         batch_size = X.shape[0]
 
         self.n_iter_ += batch_size
-        self.sample_n_iter_[sample_indices] += 1
-        this_sample_n_iter = self.sample_n_iter_[sample_indices]
-        w_sample = np.power(this_sample_n_iter, -self.sample_learning_rate). \
-            astype(self.components_.dtype)
         w = _batch_weight(self.n_iter_, batch_size,
                           self.learning_rate, 0)
-        self._compute_code(X, sample_indices, w_sample, subset)
-
-        this_code = self.code_[sample_indices]
+        this_code = self._code_batch(X, sample_indices, subset)
 
         if self.n_threads == 1:
             self._update_stat_and_dict(subset, X, this_code, w)
         else:
             self._update_stat_and_dict_parallel(subset, X,
                                                 this_code, w)
+        if self._tracks_surrogate():
+            self._update_surrogate(X, this_code, subset, w)
         self.time_ += time.perf_counter() - t0
+        batch_times = self._batch_times
+        self._record_batch_times(batch_size)
+        if getattr(self, 'reduction_controller_', None) is not None:
+            self._control(batch_times, t_start)
 
     def _update_stat_and_dict(self, subset, X, code, w):
         """For multi-threading"""
         self._update_C(code, w)
         self._update_B(X, code, w)
+        t0 = time.perf_counter()
         self.gradient_[:, subset] = self.B_[:, subset]
+        self._add_time('stats', t0)
         self._update_dict(subset, w)
 
     def _update_stat_and_dict_parallel(self, subset, X, this_code, w):
         """For multi-threading"""
+        t0 = time.perf_counter()
         self.gradient_[:, subset] = self.B_[:, subset]
+        self._add_time('stats', t0)
         dict_thread = self._pool.submit(self._update_stat_partial_and_dict,
                                         subset, X, this_code, w)
         B_thread = self._pool.submit(self._update_B, X,
@@ -545,53 +1451,61 @@ class DictFact(CodingMixin, BaseEstimator):
         """For multi-threading"""
         self._update_C(code, w)
         # Gradient update
+        t0 = time.perf_counter()
         batch_size = X.shape[0]
         X_subset = X[:, subset]
         if self.optimizer == 'variational':
             self.gradient_[:, subset] *= 1 - w
-            self.gradient_[:, subset] += w * code.T.dot(X_subset) / batch_size
+            self.gradient_[:, subset] += w * safe_sparse_dot(
+                code.T, X_subset) / batch_size
         else:
-            self.gradient_[:, subset] = code.T.dot(X_subset) / batch_size
+            self.gradient_[:, subset] = safe_sparse_dot(
+                code.T, X_subset) / batch_size
+        self._add_time('stats', t0)
 
         self._update_dict(subset, w)
 
     def _update_B(self, X, code, w):
         """Update B statistics (for updating D)"""
+        t0 = time.perf_counter()
         batch_size = X.shape[0]
         if self.optimizer == 'variational':
             self.B_ *= 1 - w
-            self.B_ += w * code.T.dot(X) / batch_size
+            self.B_ += w * safe_sparse_dot(code.T, X) / batch_size
         else:
-            self.B_ = code.T.dot(X) / batch_size
+            self.B_ = safe_sparse_dot(code.T, X) / batch_size
+        self._add_time('stats', t0)
 
     def _update_C(self, this_code, w):
         """Update C statistics (for updating D)"""
+        t0 = time.perf_counter()
         batch_size = this_code.shape[0]
         if self.optimizer == 'variational':
             self.C_ *= 1 - w
             self.C_ += w * this_code.T.dot(this_code) / batch_size
         else:
             self.C_ = this_code.T.dot(this_code) / batch_size
+        self._add_time('stats', t0)
 
     def _compute_code(self, X, sample_indices,
                       w_sample, subset):
         """Update regression statistics if
         necessary and compute code from X[:, subset]"""
+        t0 = time.perf_counter()
         batch_size, n_features = X.shape
-        reduction = self.reduction
-
-        if self.n_threads > 1:
-            size_job = ceil(batch_size / self.n_threads)
-            batches = list(gen_batches(batch_size, size_job))
+        reduction = self._get_reduction()
+        # CSR columns are selected without densifying rows, and Dx is
+        # computed with sparse-dense products
 
+        components = self._get_components()
         if self.Dx_agg != 'full' or self.G_agg != 'full':
-            components_subset = self.components_[:, subset]
+            components_subset = components[:, subset]
 
         if self.Dx_agg == 'full':
-            Dx = X.dot(self.components_.T)
+            Dx = _dot_components(X, components)
         else:
             X_subset = X[:, subset]
-            Dx = X_subset.dot(components_subset.T) * reduction
+            Dx = _dot_components(X_subset, components_subset) * reduction
             self.Dx_average_[sample_indices] \
                 *= 1 - w_sample[:, np.newaxis]
             self.Dx_average_[sample_indices] \
@@ -600,124 +1514,233 @@ class DictFact(CodingMixin, BaseEstimator):
                 Dx = self.Dx_average_[sample_indices]
 
         if self.G_agg != 'full':
-            G = components_subset.dot(components_subset.T) * reduction
-            if self.G_agg == 'average':
-                G_average = np.array(self.G_average_[sample_indices],
-                                     copy=True)
-                if self.n_threads > 1:
-                    par_func = lambda batch: _update_G_average(
-                        G_average[batch],
-                        G,
-                        w_sample[batch],
-                    )
-                    res = self._pool.map(par_func, batches)
-                    _ = list(res)
-                else:
-                    _update_G_average(G_average, G, w_sample)
-                self.G_average_[sample_indices] = G_average
+            G = _gram(components_subset) * reduction
         else:
             G = self.G_
-        if self.n_threads > 1:
-            if self.G_agg == 'average':
-                par_func = lambda batch: _enet_regression_multi_gram(
-                    G_average[batch], Dx[batch], X[batch], self.code_,
-                    get_sub_slice(sample_indices, batch),
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
+        t0 = self._add_time('Dx_G', t0)
+        if self.G_agg == 'average':
+            G_average = np.array(self.G_average_[sample_indices], copy=True)
+            packed = self.G_average_storage != 'full'
+            if self.G_average_storage == 'half':
+                # float16 is handled as uint16 in Cython
+                G_average_buffer = G_average.view(np.uint16)
             else:
-                par_func = lambda batch: _enet_regression_single_gram(
-                    G, Dx[batch], X[batch], self.code_,
-                    get_sub_slice(sample_indices, batch),
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
-            res = self._pool.map(par_func, batches)
-            _ = list(res)
+                G_average_buffer = G_average
+            _enet_regression_multi_gram_average(
+                G_average_buffer.reshape((batch_size, -1)), packed,
+                G, w_sample, Dx, _solver_rows(X), self.code_,
+                sample_indices,
+                self.code_l1_ratio, self.code_alpha, self.code_pos,
+                self.tol, self.max_iter, self.n_threads)
+            self.G_average_[sample_indices] = G_average
         else:
-            if self.G_agg == 'average':
-                _enet_regression_multi_gram(
-                    G_average, Dx, X, self.code_,
-                    sample_indices,
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
-            else:
-                _enet_regression_single_gram(
-                    G, Dx, X, self.code_,
-                    sample_indices,
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
+            # Subsampled or averaged G and Dx do not match the norm of X,
+            # on which gap safe screening relies. Asynchronous workers may
+            # see a G_ lagging behind the dictionary used for Dx
+            screen = (self.Dx_agg == 'full' and self.G_agg == 'full'
+                      and reduction == 1 and not self.asynchronous)
+            self._single_gram_regression(G, Dx, _solver_rows(X), self.code_,
+                                         sample_indices, screen=screen)
+        self._add_time('code', t0)
 
     def _update_dict(self, subset, w):
         """Dictionary update part
 
         Parameters
         ----------
-        subset: ndarray,
+        subset: ndarray or slice,
             Subset of features to update.
 
         """
-        ger, = scipy.linalg.get_blas_funcs(('ger',), (self.C_,
-                                                      self.components_))
-        len_subset = subset.shape[0]
+        t0 = time.perf_counter()
         n_components, n_features = self.components_.shape
-        components_subset = self.components_[:, subset]
-        atom_temp = np.zeros(len_subset, dtype=self.components_.dtype)
-        gradient_subset = self.gradient_[:, subset]
-
-        if self.G_agg == 'full' and len_subset < n_features / 2.:
-            self.G_ -= components_subset.dot(components_subset.T)
-
-        gradient_subset -= self.C_.dot(components_subset)
-
-        order = self.random_state.permutation(n_components)
+        if isinstance(subset, slice):
+            len_subset = subset.stop - subset.start
+        else:
+            len_subset = subset.shape[0]
+        update_G = self.G_agg == 'full' and len_subset < n_features / 2.
+        if update_G:
+            # Contribution of subset to G_, before the update
+            self.G_ -= _gram(self._get_components()[:, subset])
+        track_surrogate = self._tracks_surrogate()
+        controller = getattr(self, 'reduction_controller_', None)
+        if track_surrogate:
+            # gradient_[:, subset] holds the updated B_[:, subset] (B_ may
+            # still be written by another thread) and is modified by the
+            # update
+            B_subset = np.array(self.gradient_[:, subset])
+        if controller is not None:
+            surrogate = _surrogate(self.components_[:, subset], self.C_,
+                                   B_subset)
 
         if self.optimizer == 'variational':
-            for k in order:
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] += subset_norm
-                gradient_subset = ger(1.0, self.C_[k], components_subset[k],
-                                      a=gradient_subset, overwrite_a=True)
-                if self.C_[k, k] > 1e-20:
-                    components_subset[k] = gradient_subset[k] / self.C_[k, k]
-                # Else do not update
-                if self.comp_pos:
-                    components_subset[components_subset < 0] = 0
-                enet_projection(components_subset[k],
-                                atom_temp,
-                                self.comp_norm_[k], self.comp_l1_ratio)
-                components_subset[k] = atom_temp
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] -= subset_norm
-                gradient_subset = ger(-1.0, self.C_[k], components_subset[k],
-                                      a=gradient_subset, overwrite_a=True)
+            if isinstance(subset, slice):
+                subset = np.arange(subset.start, subset.stop)
+            order = self.random_state.permutation(n_components)
+            # Works in place on components_ and gradient_
+            _update_dict_variational(self.components_, self.gradient_,
+                                     self.C_, self.comp_norm_,
+                                     subset, order,
+                                     self.comp_l1_ratio, self.comp_pos,
+                                     self.n_threads,
+                                     self.comp_projection == 'condat')
         else:
-            for k in order:
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] += subset_norm
-            components_subset += w * self.step_size * gradient_subset
-            for k in range(self.n_components):
-                enet_projection(components_subset[k],
-                                atom_temp,
-                                self.comp_norm_[k], self.comp_l1_ratio)
-                components_subset[k] = atom_temp
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] -= subset_norm
-        self.components_[:, subset] = components_subset
+            components_subset = self.components_[:, subset]
+            gradient_subset = self.gradient_[:, subset]
+
+            gradient_subset -= self.C_.dot(components_subset)
 
+            self.comp_norm_ += enet_norm_rows(components_subset,
+                                              self.comp_l1_ratio,
+                                              self.n_threads)
+            components_subset += w * self.step_size * gradient_subset
+            projected = np.empty_like(components_subset)
+            enet_projection_rows(components_subset, projected,
+                                 self.comp_norm_, self.comp_l1_ratio,
+                                 self.n_threads,
+                                 self.comp_projection == 'condat')
+            components_subset = projected
+            self.comp_norm_ -= enet_norm_rows(components_subset,
+                                              self.comp_l1_ratio,
+                                              self.n_threads)
+            self.components_[:, subset] = components_subset
+
+        if track_surrogate:
+            # Dictionary terms of the surrogate on subset, from which
+            # surrogate_ is estimated
+            self._subset_surrogate = _surrogate(self.components_[:, subset],
+                                                self.C_, B_subset)
+        if controller is not None:
+            self._surrogate_decrease = surrogate - self._subset_surrogate
+        self._update_sparse_components(subset)
         if self.G_agg == 'full':
-            if len_subset < n_features / 2.:
-                self.G_ += components_subset.dot(components_subset.T)
+            components = self._get_components()
+            if update_G:
+                self.G_ += _gram(components[:, subset])
             else:
-                self.G_[:] = self.components_.dot(self.components_.T)
+                self.G_[:] = _gram(components)
+        self._add_time('dict', t0)
+
+    def _update_sparse_components(self, subset):
+        """Update comp_nnz_ and components_sparse_ after an update of the
+        features in subset"""
+        if self.sparse_comp_threshold <= 0:
+            return
+        if getattr(self, '_sparse_source', None) is not self.components_:
+            self._init_sparse_components()
+            return
+        if isinstance(subset, slice):
+            subset = np.arange(subset.start, subset.stop)
+        components_subset = self.components_[:, subset]
+        self.comp_nnz_[subset] = np.count_nonzero(components_subset, axis=0)
+        if (np.sum(self.comp_nnz_)
+                >= self.sparse_comp_threshold * self.components_.size):
+            self.components_sparse_ = None
+        elif self.components_sparse_ is None:
+            self.components_sparse_ = sp.csc_matrix(self.components_)
+        else:
+            self.components_sparse_ = _replace_columns(
+                self.components_sparse_, subset, components_subset)
 
     def _exit(self):
         """Useful to delete G_average_ memorymap when the algorithm is
          interrupted/completed"""
         if hasattr(self, 'G_average_mmap_'):
             self.G_average_mmap_.close()
+        if getattr(self, '_trace', None) is not None:
+            self._trace.close()
+            self._trace = None
+
+    def __getstate__(self):
+        state = CodingMixin.__getstate__(self)
+        state.pop('_trace', None)
+        state.pop('_callback_pool', None)
+        state.pop('_callback_futures', None)
+        return state
+
+
+def _budget_batch_size(memory_budget, n_samples, n_features, n_components,
+                       dtype):
+    """Number of rows that can be coded at once within memory_budget (in MB),
+    accounting for a copy of the input rows, their residuals, Dx and code"""
+    if memory_budget is None:
+        return max(n_samples, 1)
+    row_size = 2 * (n_features + n_components) * np.dtype(dtype).itemsize
+    return max(int(memory_budget * 2 ** 20 // row_size), 1)
+
+
+def _save_array(filename, array):
+    """Write array to the .npy file filename, replacing it atomically so
+    that memory maps of the previous file stay valid"""
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(filename + '.tmp', filename)
+
+
+def _to_json(obj):
+    """Convert numpy scalars and arrays for json.dump"""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _solver_rows(X):
+    """Rows of X to give to the elastic-net solvers, which only use them
+    through their squared norm (to scale the duality gap tolerance). Sparse
+    X is replaced by the column of its row norms, computed in O(nnz)."""
+    if sp.issparse(X):
+        return np.ascontiguousarray(row_norms(X)[:, np.newaxis],
+                                    dtype=X.dtype)
+    return X
+
+
+def _dot_components(X, components):
+    """C-contiguous X.dot(components.T), for ndarray or sparse operands"""
+    return np.ascontiguousarray(safe_sparse_dot(X, components.T,
+                                                dense_output=True))
+
+
+def _surrogate(components, C, B):
+    """Dictionary terms of the surrogate objective,
+    1 / 2 tr(D^T D C) - tr(D^T B), which are separable over features"""
+    return (0.5 * np.sum(components * C.dot(components))
+            - np.sum(components * B))
+
+
+def _gram(components):
+    """Dense Gram matrix of the rows of components (ndarray or sparse)"""
+    G = components.dot(components.T)
+    if sp.issparse(G):
+        G = G.toarray(order='C')
+    return G
+
+
+def _replace_columns(matrix, columns, values):
+    """Return the CSC matrix with columns (distinct indices) replaced by the
+    columns of the dense array values, in time linear in the number of
+    non-zero entries"""
+    n_rows, n_cols = matrix.shape
+    replaced = np.zeros(n_cols, dtype='bool')
+    replaced[columns] = True
+    entry_cols = np.repeat(np.arange(n_cols), np.diff(matrix.indptr))
+    kept = ~replaced[entry_cols]
+    new_rows, new_cols = np.nonzero(values)
+    data = np.concatenate([matrix.data[kept], values[new_rows, new_cols]])
+    rows = np.concatenate([matrix.indices[kept], new_rows])
+    cols = np.concatenate([entry_cols[kept], np.asarray(columns)[new_cols]])
+    return sp.csc_matrix((data, (rows, cols)), shape=(n_rows, n_cols))
+
+
+def _check_contiguous(subset):
+    """Return a slice equivalent to the sorted subset if it is a contiguous
+    run of features, so that column accesses are views instead of fancy-index
+    copies. Return subset otherwise."""
+    len_subset = subset.shape[0]
+    if len_subset > 0:
+        start = subset[0]
+        if subset[len_subset - 1] - start + 1 == len_subset:
+            return slice(start, start + len_subset)
+    return subset
 
 
 class Coder(CodingMixin, BaseEstimator):
@@ -728,8 +1751,43 @@ class Coder(CodingMixin, BaseEstimator):
                  max_iter=100,
                  code_pos=False,
                  random_state=None,
-                 n_threads=1
+                 n_threads=1,
+                 code_solver='cd',
+                 cache_size=0,
+                 sparse_comp_threshold=0
                  ):
+        """
+        Estimator to compute the codes of samples on a fixed dictionary.
+
+        Parameters
+        ----------
+        dictionary: ndarray, shape = (n_components, n_features)
+            Dictionary onto which samples are decomposed
+        cache_size: int, positive
+            Number of codes kept in memory, keyed by the sample_ids passed
+            to transform, and used to warm start the solver when the same
+            samples are transformed again. Least recently used codes are
+            evicted first. 0 disables the cache
+        sparse_comp_threshold: float in [0, 1]
+            If the fraction of non-zero entries of the dictionary is below
+            this threshold, Dx and the Gram matrix are computed from a CSC
+            copy of it
+
+        Other parameters are described in DictFact.
+
+        Attributes
+        ----------
+        self.code_cache_: OrderedDict
+            Cached codes, from least to most recently used
+        self.G_: ndarray, shape = (n_components, n_components)
+            Gram matrix of the dictionary, recomputed when components_ is
+            replaced
+        self.ridge_factor_: tuple
+            Cholesky factorization of G_ + code_alpha * I, as returned by
+            scipy.linalg.cho_factor, used when code_l1_ratio == 0 and
+            recomputed when components_ is replaced or code_alpha changes.
+            In-place modifications of components_ are not detected.
+        """
         self._set_coding_params(dictionary.shape[0],
                                 code_l1_ratio=code_l1_ratio,
                                 code_alpha=code_alpha,
@@ -737,8 +1795,54 @@ class Coder(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_solver=code_solver,
+                                sparse_comp_threshold=sparse_comp_threshold)
         self.components_ = dictionary
+        self.cache_size = cache_size
+        self.code_cache_ = OrderedDict()
 
     def fit(self, X=None):
+        self._get_gram()
         return self
+
+    def _get_gram(self):
+        if getattr(self, '_gram_components', None) is not self.components_:
+            self.G_ = _gram(self._get_components())
+            self._gram_components = self.components_
+            self.ridge_factor_ = None
+        if self.code_l1_ratio == 0 and (self.ridge_factor_ is None or
+                                        self._ridge_alpha != self.code_alpha):
+            G = self.G_.copy()
+            G.flat[::self.n_components + 1] += self.code_alpha
+            self.ridge_factor_ = cho_factor(G)
+            self._ridge_alpha = self.code_alpha
+        return self.G_
+
+    def _single_gram_regression(self, G, Dx, X, code, sample_indices,
+                                screen=False):
+        if self.code_l1_ratio == 0:
+            # G is self.G_, factorized in _get_gram: solve for all samples
+            # at once
+            code[sample_indices] = cho_solve(self.ridge_factor_, Dx.T).T
+        else:
+            CodingMixin._single_gram_regression(self, G, Dx, X, code,
+                                                sample_indices, screen=screen)
+
+    def _warm_code(self, sample_ids, dtype):
+        code = CodingMixin._warm_code(self, sample_ids, dtype)
+        for ii, sample_id in enumerate(sample_ids):
+            this_code = self.code_cache_.get(sample_id)
+            if this_code is not None:
+                code[ii] = this_code
+                self.code_cache_.move_to_end(sample_id)
+        return code
+
+    def _store_code(self, sample_ids, code):
+        if self.cache_size <= 0:
+            return
+        for sample_id, this_code in zip(sample_ids, code):
+            self.code_cache_[sample_id] = this_code.copy()
+            self.code_cache_.move_to_end(sample_id)
+        while len(self.code_cache_) > self.cache_size:
+            self.code_cache_.popitem(last=False)
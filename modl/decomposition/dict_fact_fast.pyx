@@ -11,24 +11,47 @@ cdef int ONE = 1
 
 from cython cimport floating
 
-from scipy.linalg.cython_blas cimport saxpy, daxpy, sdot, ddot, sasum, dasum, dgemv, sgemv
+from scipy.linalg.cython_blas cimport saxpy, daxpy, sdot, ddot, sasum, dasum, dgemv, sgemv, \
+    dgemm, sgemm
 from scipy.linalg.cython_lapack cimport dposv, sposv
 
-from libc.math cimport pow, fabs
+from libc.math cimport pow, fabs, sqrt
+
+from modl.utils.math.enet cimport _enet_projection_parallel
 
 cimport numpy as np
 import numpy as np
 
 from cython cimport view
+from cython.parallel cimport parallel, prange, threadid
+
+cdef extern from "numpy/halffloat.h":
+    ctypedef unsigned short npy_half
+    float npy_half_to_float(npy_half h) nogil
+    npy_half npy_float_to_half(float f) nogil
+
+# Storage types for averaged Gram matrices: npy_half holds float16 data
+# (viewed as uint16)
+ctypedef fused packed_t:
+    float
+    double
+    npy_half
 
 ctypedef void (*POSV)(char * UPLO, int* N,
                           int* NRHS, floating* A, int* LDA,
-                          floating *B, int* LDB, int* INFO)
+                          floating *B, int* LDB, int* INFO) nogil
 ctypedef floating (*DOT)(int* N, floating* X, int* incX, floating* Y,
                          int* incY) nogil
 ctypedef void (*AXPY)(int* N, floating* alpha, floating* X, int* incX,
                       floating* Y, int* incY) nogil
 ctypedef floating (*ASUM)(int* N, floating* X, int* incX) nogil
+ctypedef void (*GEMV)(char* trans, int* M, int* N, floating* alpha,
+                      floating* A, int* lda, floating* X, int* incX,
+                      floating* beta, floating* Y, int* incY) nogil
+ctypedef void (*GEMM)(char* transA, char* transB, int* M, int* N, int* K,
+                      floating* alpha, floating* A, int* lda,
+                      floating* B, int* ldb, floating* beta,
+                      floating* C, int* ldc) nogil
 
 
 def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
@@ -39,12 +62,14 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
                                 bint positive,
                                 floating tol,
                                 int max_iter,
+                                int n_threads=1,
                                 ):
     '''
     Perform elastic net regression: for all i in indices,
-    find code[i] s.t code[i].dot(G[i]) = Dx[ii], where i = indices[ii].
-    G and code are the arrays containing the values for all samples,
-    while Dx and X should already be subscripted.
+    find code[i] s.t code[i].dot(G[ii]) = Dx[ii], where i = indices[ii].
+    code is the array containing the values for all samples,
+    while G, Dx and X should already be subscripted. Samples are solved in
+    parallel over n_threads OpenMP threads.
 
     Parameters
     ----------
@@ -56,22 +81,20 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
     l1_ratio: floating, enet-regression parameter
     alpha: floating, enet-regression paramater
     positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads
     '''
     cdef int batch_size = indices.shape[0]
     cdef int n_components = code.shape[1]
-    cdef int i, j, info, ii
+    cdef int i, j, info, ii, tid
     cdef floating* G_ptr = <floating*> &G[0, 0, 0]
     cdef floating* code_ptr = <floating*> &code[0, 0]
     cdef POSV posv
     cdef str format
 
 
-    cdef floating[:] this_code
-    cdef floating[::1] this_Dx
-    cdef floating[:] this_X
-    cdef floating[:, ::1] this_G
-    cdef floating[:] H
-    cdef floating[:] XtA
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
+    cdef int[:, ::1] coordinates
 
     if floating is float:
         posv = sposv
@@ -81,38 +104,165 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
         format = 'd'
 
     if l1_ratio == 0:
-        for ii in range(batch_size):
-            i = indices[ii]
-            code[i, :] = Dx[ii, :]
-            for j in range(n_components):
-                G[ii, j, j] += alpha
-            posv(&UP, &n_components, &ONE,
-                G_ptr + ii * n_components ** 2,
-                &n_components,
-                code_ptr + i * n_components, &n_components,
-                &info)
-            for j in range(n_components):
-                G[ii, j, j] -= alpha
+        with nogil:
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='static'):
+                i = indices[ii]
+                for j in range(n_components):
+                    code[i, j] = Dx[ii, j]
+                    G[ii, j, j] += alpha
+                info = 0
+                posv(&UP, &n_components, &ONE,
+                    G_ptr + ii * n_components ** 2,
+                    &n_components,
+                    code_ptr + i * n_components, &n_components,
+                    &info)
+                for j in range(n_components):
+                    G[ii, j, j] -= alpha
     else:
-        H = view.array((n_components, ), sizeof(floating),
+        # Per-thread scratch buffers
+        H = view.array((n_threads, n_components), sizeof(floating),
                        format=format, mode='c')
-        XtA = view.array((n_components, ), sizeof(floating),
+        XtA = view.array((n_threads, n_components), sizeof(floating),
                          format=format, mode='c')
-        with nogil:
-            for ii in range(batch_size):
+        coordinates = view.array((n_threads, n_components), sizeof(int),
+                                 format='i', mode='c')
+        with nogil, parallel(num_threads=n_threads):
+            for ii in prange(batch_size, schedule='dynamic'):
+                tid = threadid()
                 i = indices[ii]
-                this_G = G[ii, :, :]
-                this_Dx = Dx[ii, :]
-                this_X = X[ii, :]
-                this_code = code[i, :]
                 enet_coordinate_descent_gram(
-                    this_code,
+                    code[i],
                     alpha * l1_ratio,
                     alpha * (1 - l1_ratio),
-                    this_G, this_Dx, this_X, H, XtA, max_iter, tol,
-                    positive)
+                    G[ii], Dx[ii], X[ii], H[tid], XtA[tid],
+                    coordinates[tid], max_iter, tol, positive, False)
     return np.asarray(code)
 
+def _enet_regression_multi_gram_average(packed_t[:, ::1] G_average,
+                                        bint packed,
+                                        floating[:, ::1] G,
+                                        floating[:] w_sample,
+                                        floating[:, ::1] Dx,
+                                        floating[:, ::1] X,
+                                        floating[: , ::1] code,
+                                        long[:] indices,
+                                        floating l1_ratio, floating alpha,
+                                        bint positive,
+                                        floating tol,
+                                        int max_iter,
+                                        int n_threads=1,
+                                        ):
+    '''
+    Update the averaged Gram matrices of a batch and perform elastic net
+    regression with them, in a single pass: for all i in indices,
+    G_average[ii] = (1 - w_sample[ii]) * G_average[ii] + w_sample[ii] * G,
+    then find code[i] s.t code[i].dot(G_average[ii]) = Dx[ii], where
+    i = indices[ii]. Each averaged Gram matrix is blended into a per-thread
+    buffer, written back and used by the solver while in cache. Samples are
+    solved in parallel over n_threads OpenMP threads.
+
+    Parameters
+    ----------
+    G_average: array, shape (batch_size x n_packed)
+        Averaged Gram matrices, updated in place. If packed, each row holds
+        the upper triangle of a matrix, packed row by row
+        (n_packed = n_components * (n_components + 1) / 2), otherwise the
+        flattened matrix (n_packed = n_components ** 2). Storage may be in
+        reduced precision (float16 viewed as uint16)
+    packed: bint, layout of G_average
+    G: array, shape (n_components x n_components)
+    w_sample: array, shape (batch_size)
+    Dx: array, shape (batch_size x n_components)
+    X: array, shape (batch_size x n_features)
+    code: array, shape (n_samples x n_components)
+    indices: array, shape (batch_size)
+    l1_ratio: floating, enet-regression parameter
+    alpha: floating, enet-regression paramater
+    positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads
+    '''
+    cdef int batch_size = indices.shape[0]
+    cdef int n_components = code.shape[1]
+    cdef int i, j, p, q, idx, info, ii, tid
+    cdef floating w, value
+    cdef POSV posv
+    cdef str format
+
+    cdef floating[:, :, ::1] G_full
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
+    cdef int[:, ::1] coordinates
+
+    if floating is float:
+        posv = sposv
+        format = 'f'
+    else:
+        posv = dposv
+        format = 'd'
+
+    # Per-thread scratch buffers
+    G_full = view.array((n_threads, n_components, n_components),
+                        sizeof(floating), format=format, mode='c')
+    H = view.array((n_threads, n_components), sizeof(floating),
+                   format=format, mode='c')
+    XtA = view.array((n_threads, n_components), sizeof(floating),
+                     format=format, mode='c')
+    coordinates = view.array((n_threads, n_components), sizeof(int),
+                             format='i', mode='c')
+    with nogil, parallel(num_threads=n_threads):
+        for ii in prange(batch_size, schedule='dynamic'):
+            tid = threadid()
+            i = indices[ii]
+            w = w_sample[ii]
+            idx = 0
+            for p in range(n_components):
+                if packed:
+                    q = p
+                else:
+                    q = 0
+                while q < n_components:
+                    value = (1 - w) * _load(G_average[ii, idx]) + w * G[p, q]
+                    _store(&G_average[ii, idx], value)
+                    G_full[tid, p, q] = value
+                    G_full[tid, q, p] = value
+                    idx = idx + 1
+                    q = q + 1
+            if l1_ratio == 0:
+                for j in range(n_components):
+                    code[i, j] = Dx[ii, j]
+                    G_full[tid, j, j] += alpha
+                info = 0
+                posv(&UP, &n_components, &ONE,
+                     &G_full[tid, 0, 0], &n_components,
+                     &code[i, 0], &n_components,
+                     &info)
+            else:
+                enet_coordinate_descent_gram(
+                    code[i],
+                    alpha * l1_ratio,
+                    alpha * (1 - l1_ratio),
+                    G_full[tid], Dx[ii], X[ii], H[tid], XtA[tid],
+                    coordinates[tid], max_iter, tol, positive, False)
+    return np.asarray(code)
+
+
+cdef inline double _load(packed_t value) nogil:
+    """Read a stored Gram matrix value"""
+    if packed_t is npy_half:
+        return npy_half_to_float(value)
+    else:
+        return value
+
+
+cdef inline void _store(packed_t* ptr, double value) nogil:
+    """Write a Gram matrix value in the storage type"""
+    if packed_t is npy_half:
+        ptr[0] = npy_float_to_half(value)
+    else:
+        ptr[0] = value
+
+
 def _batch_weight(long count, long batch_size,
            double learning_rate, double offset):
     cdef long i
@@ -130,12 +280,17 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
                                 floating l1_ratio, floating alpha,
                                 bint positive,
                                 floating tol,
-                                int max_iter):
+                                int max_iter,
+                                int n_threads=1,
+                                int[:] n_iter=None,
+                                bint screen=False):
     '''
     Perform elastic net regression: for all i in indices,
     find code[i] s.t code[i].dot(G) = Dx[ii], where i = indices[ii].
-    G and code are the arrays containing the values for all samples,
-    while Dx and X should already be subscripted.
+    code is the array containing the values for all samples,
+    while Dx and X should already be subscripted. code[indices] is used as
+    initialization for coordinate descent. Samples are solved in
+    parallel over n_threads OpenMP threads.
 
     Parameters
     ----------
@@ -147,23 +302,29 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
     l1_ratio: floating, enet-regression parameter
     alpha: floating, enet-regression paramater
     positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads
+    n_iter: array, shape (batch_size), optional
+        If provided, filled with the number of coordinate descent passes
+        performed for each sample (0 for ridge regression)
+    screen: bint
+        Use gap safe screening. Requires G, Dx and X to come from the same
+        problem, i.e. G = D D^T and Dx = X D^T, with neither subsampled nor
+        averaged
     '''
     cdef int batch_size = indices.shape[0]
-    cdef int i, j, info, ii
+    cdef int i, j, info, ii, tid, this_n_iter
     cdef int n_components = G.shape[0]
     cdef int n_features = X.shape[1]
     cdef floating* G_ptr = <floating*> &G[0, 0]
     cdef floating* Dx_ptr = <floating*> &Dx[0, 0]
     cdef POSV posv
     cdef str format
-    cdef floating[:] this_code
-    cdef floating[::1] this_Dx
-    cdef floating[:] this_X
     cdef floating[:, ::1] G_copy
     cdef floating[:, ::1] code_copy
 
-    cdef floating[:] H
-    cdef floating[:] XtA
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
+    cdef int[:, ::1] coordinates
 
     if floating is float:
         posv = sposv
@@ -196,37 +357,309 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
         for ii in range(batch_size):
             i = indices[ii]
             code[i, :] = Dx[ii, :]
+        if n_iter is not None:
+            n_iter[:] = 0
     else:
-        H = view.array((n_components, ), sizeof(floating),
-                   format=format, mode='c')
-        XtA = view.array((n_components, ), sizeof(floating),
-                     format=format, mode='c')
-        with nogil:
-            for ii in range(batch_size):
+        # Per-thread scratch buffers
+        H = view.array((n_threads, n_components), sizeof(floating),
+                       format=format, mode='c')
+        XtA = view.array((n_threads, n_components), sizeof(floating),
+                         format=format, mode='c')
+        coordinates = view.array((n_threads, n_components), sizeof(int),
+                                 format='i', mode='c')
+        with nogil, parallel(num_threads=n_threads):
+            for ii in prange(batch_size, schedule='dynamic'):
+                tid = threadid()
                 i = indices[ii]
-                this_Dx = Dx[ii, :]
-                this_X = X[ii, :]
-                this_code = code[i, :]
-                enet_coordinate_descent_gram(
-                    this_code,
+                this_n_iter = enet_coordinate_descent_gram(
+                    code[i],
                     alpha * l1_ratio,
                     alpha * (1 - l1_ratio),
-                    G, this_Dx, this_X, H, XtA, max_iter, tol,
-                    positive)
+                    G, Dx[ii], X[ii], H[tid], XtA[tid],
+                    coordinates[tid], max_iter, tol, positive, screen)
+                if n_iter is not None:
+                    n_iter[ii] = this_n_iter
     return np.asarray(code)
 
-def _update_G_average(floating[:, :, ::1] G_average,
-                              floating[:, ::1] G,
-                              floating[:] w_sample):
-    cdef int batch_size = w_sample.shape[0]
-    cdef int n_components = G_average.shape[1]
-    cdef int ii, i, k, p, q
-    for ii in range(batch_size):
-        for p in range(n_components):
-            for q in range(n_components):
-                G_average[ii, p, q] *= (1 - w_sample[ii])
-                G_average[ii, p, q] += G[p, q] * w_sample[ii]
-    return G_average
+def _enet_regression_batched(floating[:, ::1] G, floating[:, ::1] Dx,
+                             floating[:, ::1] X,
+                             floating[:, ::1] code,
+                             long[:] indices,
+                             floating l1_ratio, floating alpha,
+                             bint positive,
+                             floating tol,
+                             int max_iter,
+                             int check_every=10):
+    '''
+    Perform elastic net regression on a whole batch sharing a single Gram
+    matrix, using accelerated proximal gradient (FISTA) over the
+    (batch_size, n_components) code block. Gradients are computed with
+    GEMM. Iterations stop when the duality gap of every sample, computed as
+    in the coordinate descent solver, is below tol * ||X[ii]||^2.
+
+    Parameters
+    ----------
+    G: array, shape (n_components x n_components)
+    Dx: array, shape (batch_size x n_components)
+    X: array, shape (batch_size x n_features)
+    code: array, shape (n_samples x n_components)
+        code[indices] is used as initialization and overwritten
+    indices: array, shape (batch_size)
+    l1_ratio: floating, enet-regression parameter
+    alpha: floating, enet-regression paramater
+    positive: bint, enet-regression parameter
+    check_every: int, number of iterations between duality gap checks
+    '''
+    cdef int batch_size = indices.shape[0]
+    cdef int n_components = G.shape[0]
+    cdef int n_features = X.shape[1]
+    cdef int i, ii, j, n_iter
+    cdef floating l1_reg = alpha * l1_ratio
+    cdef floating l2_reg = alpha * (1 - l1_ratio)
+    cdef floating lipschitz, thresh, t_new, momentum, v, restart
+    cdef floating q_dot_w, w_H, w_norm2, w_norm1, dual_norm_XtA, XtA
+    cdef floating R_norm2, const, gap, y_norm2
+    cdef bint converged
+    cdef floating one = 1
+    cdef floating zero = 0
+    cdef GEMM gemm
+    cdef DOT dot
+    cdef str format
+
+    if floating is float:
+        gemm = sgemm
+        dot = sdot
+        format = 'f'
+    else:
+        gemm = dgemm
+        dot = ddot
+        format = 'd'
+
+    if batch_size == 0:
+        return np.asarray(code)
+
+    cdef floating[:, ::1] A = view.array((batch_size, n_components),
+                                         sizeof(floating),
+                                         format=format, mode='c')
+    cdef floating[:, ::1] Y = view.array((batch_size, n_components),
+                                         sizeof(floating),
+                                         format=format, mode='c')
+    cdef floating[:, ::1] H = view.array((batch_size, n_components),
+                                         sizeof(floating),
+                                         format=format, mode='c')
+    cdef floating[:] X_norm2 = view.array((batch_size, ), sizeof(floating),
+                                          format=format, mode='c')
+    cdef floating[:] T = view.array((batch_size, ), sizeof(floating),
+                                    format=format, mode='c')
+    cdef floating* G_ptr = &G[0, 0]
+    cdef floating* A_ptr = &A[0, 0]
+    cdef floating* Y_ptr = &Y[0, 0]
+    cdef floating* H_ptr = &H[0, 0]
+
+    lipschitz = np.linalg.eigvalsh(np.asarray(G)).max() + l2_reg
+    if lipschitz <= 0:
+        return np.asarray(code)
+    thresh = l1_reg / lipschitz
+
+    with nogil:
+        for ii in range(batch_size):
+            i = indices[ii]
+            for j in range(n_components):
+                A[ii, j] = code[i, j]
+                Y[ii, j] = code[i, j]
+            X_norm2[ii] = dot(&n_features, &X[ii, 0], &ONE, &X[ii, 0], &ONE)
+            T[ii] = 1
+        for n_iter in range(max_iter):
+            # H = Y.dot(G) (G is symmetric)
+            gemm(&NTRANS, &NTRANS, &n_components, &batch_size,
+                 &n_components, &one, G_ptr, &n_components,
+                 Y_ptr, &n_components, &zero, H_ptr, &n_components)
+            for ii in range(batch_size):
+                restart = 0
+                for j in range(n_components):
+                    # Proximal gradient step, stored in H
+                    v = Y[ii, j] - (H[ii, j] + l2_reg * Y[ii, j]
+                                    - Dx[ii, j]) / lipschitz
+                    if positive and v < 0:
+                        v = 0
+                    else:
+                        v = fsign(v) * fmax(fabs(v) - thresh, 0)
+                    H[ii, j] = v
+                    restart += (Y[ii, j] - v) * (v - A[ii, j])
+                # Gradient-based adaptive restart of the momentum
+                if restart > 0:
+                    T[ii] = 1
+                t_new = (1 + sqrt(1 + 4 * T[ii] * T[ii])) / 2
+                momentum = (T[ii] - 1) / t_new
+                T[ii] = t_new
+                for j in range(n_components):
+                    # Extrapolation
+                    v = H[ii, j]
+                    Y[ii, j] = v + momentum * (v - A[ii, j])
+                    A[ii, j] = v
+            if (n_iter + 1) % check_every == 0 or n_iter == max_iter - 1:
+                # Duality gap at A, for every sample
+                gemm(&NTRANS, &NTRANS, &n_components, &batch_size,
+                     &n_components, &one, G_ptr, &n_components,
+                     A_ptr, &n_components, &zero, H_ptr, &n_components)
+                converged = True
+                for ii in range(batch_size):
+                    y_norm2 = X_norm2[ii]
+                    q_dot_w = 0
+                    w_H = 0
+                    w_norm2 = 0
+                    w_norm1 = 0
+                    dual_norm_XtA = 0
+                    for j in range(n_components):
+                        q_dot_w += Dx[ii, j] * A[ii, j]
+                        w_H += H[ii, j] * A[ii, j]
+                        w_norm2 += A[ii, j] * A[ii, j]
+                        w_norm1 += fabs(A[ii, j])
+                        XtA = Dx[ii, j] - H[ii, j] - l2_reg * A[ii, j]
+                        if not positive:
+                            XtA = fabs(XtA)
+                        if XtA > dual_norm_XtA:
+                            dual_norm_XtA = XtA
+                    R_norm2 = y_norm2 + w_H - 2 * q_dot_w
+                    if dual_norm_XtA > l1_reg:
+                        const = l1_reg / dual_norm_XtA
+                        gap = 0.5 * (R_norm2 + R_norm2 * const ** 2)
+                    else:
+                        const = 1
+                        gap = R_norm2
+                    gap += (l1_reg * w_norm1 - const * y_norm2
+                            + const * q_dot_w
+                            + 0.5 * l2_reg * (1 + const ** 2) * w_norm2)
+                    if gap >= tol * y_norm2:
+                        converged = False
+                        break
+                if converged:
+                    break
+        for ii in range(batch_size):
+            i = indices[ii]
+            for j in range(n_components):
+                code[i, j] = A[ii, j]
+    return np.asarray(code)
+
+
+def _update_dict_variational(floating[:, ::1] components,
+                             floating[::1, :] gradient,
+                             floating[:, ::1] C,
+                             floating[:] comp_norm,
+                             long[:] subset,
+                             long[:] order,
+                             floating l1_ratio,
+                             bint positive,
+                             int n_threads=1,
+                             bint condat=False):
+    '''
+    Perform a block coordinate descent pass over the atoms of the dictionary,
+    restricted to the features in subset, directly on components and
+    gradient (no gather/scatter of the column subset).
+
+    Atoms are updated in sequence, but the rank-one updates of gradient
+    and the norms of each atom are split over n_threads chunks of columns,
+    and projections use a parallel threshold search.
+
+    Parameters
+    ----------
+    components: array, shape (n_components, n_features)
+    gradient: array, shape (n_components, n_features), Fortran-ordered
+        gradient[:, subset] should hold B[:, subset]
+    C: array, shape (n_components, n_components)
+    comp_norm: array, shape (n_components)
+        Norm of each atom restricted to the features outside subset, updated
+        in place
+    subset: array, shape (len_subset)
+    order: array, shape (n_components)
+        Order in which atoms are updated
+    l1_ratio: floating, ratio of l1 in the dictionary constraint
+    positive: bint, learn a positive dictionary
+    n_threads: int, number of threads
+    condat: bint, project atoms with Condat's algorithm
+    '''
+    cdef int len_subset = subset.shape[0]
+    cdef int n_components = C.shape[0]
+    cdef int n_features = components.shape[1]
+    cdef int j, jj, k, kk
+    cdef floating norm, C_kk, this_atom, v_abs, delta
+    cdef floating one = 1
+    cdef floating m_one = -1
+    cdef floating* C_ptr = &C[0, 0]
+    cdef floating* components_ptr = &components[0, 0]
+    cdef floating* gradient_ptr = &gradient[0, 0]
+    cdef floating[:] atom
+    cdef floating[:] atom_old
+    cdef floating[:] atom_temp
+    cdef AXPY axpy
+    cdef GEMV gemv
+    cdef str format
+
+    if floating is float:
+        axpy = saxpy
+        gemv = sgemv
+        format = 'f'
+    else:
+        axpy = daxpy
+        gemv = dgemv
+        format = 'd'
+
+    if len_subset == 0:
+        return
+    atom = view.array((len_subset, ), sizeof(floating),
+                      format=format, mode='c')
+    atom_old = view.array((len_subset, ), sizeof(floating),
+                          format=format, mode='c')
+    atom_temp = view.array((len_subset, ), sizeof(floating),
+                           format=format, mode='c')
+    with nogil:
+        # gradient[:, subset] -= C.dot(components[:, subset])
+        for jj in prange(len_subset, num_threads=n_threads,
+                         schedule='static'):
+            j = subset[jj]
+            gemv(&TRANS, &n_components, &n_components, &m_one,
+                 C_ptr, &n_components,
+                 components_ptr + j, &n_features,
+                 &one, gradient_ptr + j * n_components, &ONE)
+        for kk in range(n_components):
+            k = order[kk]
+            C_kk = C[k, k]
+            # Only row k of gradient[:, subset] + C[k] x components[k, subset]
+            # is needed to update atom k
+            norm = 0
+            for jj in prange(len_subset, num_threads=n_threads,
+                             schedule='static'):
+                j = subset[jj]
+                this_atom = components[k, j]
+                atom_old[jj] = this_atom
+                v_abs = fabs(this_atom)
+                norm += v_abs * (l1_ratio + (1 - l1_ratio) * v_abs)
+                if C_kk > 1e-20:
+                    atom[jj] = (gradient[k, j] + C_kk * this_atom) / C_kk
+                else:
+                    # Do not update
+                    atom[jj] = this_atom
+                if positive and atom[jj] < 0:
+                    atom[jj] = 0
+            comp_norm[k] += norm
+            _enet_projection_parallel(atom, atom_temp, comp_norm[k],
+                                      l1_ratio, n_threads, condat)
+            # gradient[:, subset] -= C[k] x (new - old atom), a single
+            # rank-one update skipping the unchanged entries (e.g. zeros of
+            # sparse atoms)
+            norm = 0
+            for jj in prange(len_subset, num_threads=n_threads,
+                             schedule='static'):
+                j = subset[jj]
+                this_atom = atom_temp[jj]
+                components[k, j] = this_atom
+                v_abs = fabs(this_atom)
+                norm += v_abs * (l1_ratio + (1 - l1_ratio) * v_abs)
+                delta = atom_old[jj] - this_atom
+                if delta != 0:
+                    axpy(&n_components, &delta, C_ptr + k * n_components,
+                         &ONE, gradient_ptr + j * n_components, &ONE)
+            comp_norm[k] -= norm
 
 
 # Shamelessly copied from sklearn (no .pxd in sources :-( )
@@ -268,13 +701,71 @@ cdef floating max(int n, floating* a) nogil:
             m = d
     return m
 
-cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating beta,
+cdef void _cd_sweep(floating[::1] w, floating alpha, floating beta,
+                    floating[:, ::1] Q,
+                    floating[::1] q,
+                    floating[::1] H,
+                    int* coordinates, int n_coordinates,
+                    bint positive, floating* d_w_max,
+                    floating* w_max) nogil:
+    """One pass of coordinate descent over the coordinates listed in
+    coordinates, keeping H = Q w up to date. The largest coordinate update
+    and the largest coordinate are stored in d_w_max and w_max"""
+    cdef AXPY axpy
+    if floating is float:
+        axpy = saxpy
+    else:
+        axpy = daxpy
+
+    cdef int n_features = Q.shape[0]
+    cdef floating* Q_ptr = &Q[0, 0]
+    cdef floating* H_ptr = &H[0]
+    cdef floating tmp, w_ii, mw_ii, d_w_ii
+    cdef int ii, f_iter
+
+    w_max[0] = 0.0
+    d_w_max[0] = 0.0
+    for f_iter in range(n_coordinates):  # Loop over coordinates
+        ii = coordinates[f_iter]
+
+        w_ii = w[ii]  # Store previous value
+        if w_ii != 0.0:
+            # H -= w_ii * Q[ii]
+            mw_ii = -w[ii]
+            axpy(&n_features, &mw_ii, Q_ptr + ii * n_features, &ONE,
+                 H_ptr, &ONE)
+
+        tmp = q[ii] - H[ii]
+
+        if positive and tmp < 0:
+            w[ii] = 0.0
+        else:
+            w[ii] = fsign(tmp) * fmax(fabs(tmp) - alpha, 0) \
+                / (Q[ii, ii] + beta)
+
+        if w[ii] != 0.0:
+            # H +=  w[ii] * Q[ii] # Update H = X.T X w
+            axpy(&n_features, &w[ii], Q_ptr + ii * n_features, &ONE,
+                 H_ptr, &ONE)
+
+        # update the maximum absolute coefficient update
+        d_w_ii = fabs(w[ii] - w_ii)
+        if d_w_ii > d_w_max[0]:
+            d_w_max[0] = d_w_ii
+
+        if fabs(w[ii]) > w_max[0]:
+            w_max[0] = fabs(w[ii])
+
+
+cdef int enet_coordinate_descent_gram(floating[::1] w, floating alpha, floating beta,
                                  floating[:, ::1] Q,
                                  floating[::1] q,
-                                 floating[:] y,
-                                 floating[:] H,
-                                 floating[:] XtA,
-                                 int max_iter, floating tol, bint positive) nogil:
+                                 floating[::1] y,
+                                 floating[::1] H,
+                                 floating[::1] XtA,
+                                 int[::1] coordinates,
+                                 int max_iter, floating tol, bint positive,
+                                 bint screen) nogil:
     """Cython version of the coordinate descent algorithm
         for Elastic-Net regression
 
@@ -285,6 +776,21 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
         which amount to the Elastic-Net problem when:
         Q = X^T X (Gram matrix)
         q = X^T y
+
+        The duality gap is computed (in O(n_features) as H = Q w is
+        maintained) when the largest coordinate update of a pass is below
+        tol (relatively to the largest coordinate), and iterations stop when
+        it is below tol * ||y||^2.
+
+        If screen, Q, q and y must come from the same problem (y^T y being
+        the squared norm of the target), so that the gap bounds the
+        suboptimality: it is then computed after every pass and used to
+        discard coordinates that are provably zero at the optimum (gap safe
+        screening rules, Fercoq et al., 2015), which are skipped in the
+        following passes. This does not hold for subsampled or averaged Gram
+        matrices and Dx. coordinates is a scratch buffer of size
+        n_features.
+        Return the number of passes performed.
     """
 
     # fused types version of BLAS functions
@@ -309,24 +815,26 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
 
 
     cdef floating tmp
-    cdef floating w_ii, mw_ii
-    cdef floating d_w_max
-    cdef floating w_max
-    cdef floating d_w_ii
+    cdef floating mw_ii
     cdef floating q_dot_w
     cdef floating w_norm2
+    cdef floating d_w_max
+    cdef floating w_max
     cdef floating gap = tol + 1.0
     cdef floating d_w_tol = tol
     cdef floating dual_norm_XtA
-    cdef int ii
+    cdef floating radius
+    cdef int ii, jj, f_iter
     cdef int n_iter = 0
-    cdef int f_iter
+    cdef int n_active = 0
 
     cdef floating* w_ptr = <floating*>&w[0]
     cdef floating* Q_ptr = &Q[0, 0]
     cdef floating* q_ptr = <floating*>&q[0]
     cdef floating* H_ptr = &H[0]
     cdef floating* XtA_ptr = &XtA[0]
+    # Non-screened coordinates
+    cdef int* active = &coordinates[0]
     cdef floating one = 1
     cdef floating zero = 0
 
@@ -349,80 +857,79 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
 
     XtA[:] = 0
 
-    for n_iter in range(max_iter):
-        w_max = 0.0
-        d_w_max = 0.0
-        for f_iter in range(n_features):  # Loop over coordinates
-            ii = f_iter
-
-            if Q[ii, ii] == 0.0:
-                continue
-
-            w_ii = w[ii]  # Store previous value
-            if w_ii != 0.0:
-                # H -= w_ii * Q[ii]
-                mw_ii = -w[ii]
-                axpy(&n_features, &mw_ii, Q_ptr + ii * n_features, &ONE,
-                     H_ptr, &ONE)
-
-            tmp = q[ii] - H[ii]
-
-            if positive and tmp < 0:
-                w[ii] = 0.0
-            else:
-                w[ii] = fsign(tmp) * fmax(fabs(tmp) - alpha, 0) \
-                    / (Q[ii, ii] + beta)
-
-            if w[ii] != 0.0:
-                # H +=  w[ii] * Q[ii] # Update H = X.T X w
-                axpy(&n_features, &w[ii], Q_ptr + ii * n_features, &ONE,
-                     H_ptr, &ONE)
-
-            # update the maximum absolute coefficient update
-            d_w_ii = fabs(w[ii] - w_ii)
-            if d_w_ii > d_w_max:
-                d_w_max = d_w_ii
-
-            if fabs(w[ii]) > w_max:
-                w_max = fabs(w[ii])
-
-        if w_max == 0.0 or d_w_max / w_max < d_w_tol or n_iter == max_iter - 1:
-            # the biggest coordinate update of this iteration was smaller than
-            # the tolerance: check the duality gap as ultimate stopping
-            # criterion
-
-            # q_dot_w = np.dot(w, q)
-            q_dot_w = dot(&n_features, w_ptr, &ONE, q_ptr, &ONE)
-
-            for ii in range(n_features):
-                XtA[ii] = q[ii] - H[ii] - beta * w[ii]
-            if positive:
-                dual_norm_XtA = max(n_features, XtA_ptr)
+    for ii in range(n_features):
+        if Q[ii, ii] != 0.0:
+            active[n_active] = ii
+            n_active += 1
+
+    while n_iter < max_iter:
+        # Pass over non-screened coordinates
+        _cd_sweep(w, alpha, beta, Q, q, H, active, n_active, positive,
+                  &d_w_max, &w_max)
+        n_iter += 1
+
+        if not (screen or w_max == 0.0 or d_w_max / w_max < d_w_tol
+                or n_iter == max_iter):
+            continue
+
+        # Duality gap, cheap to compute as H = Q w is maintained
+
+        # q_dot_w = np.dot(w, q)
+        q_dot_w = dot(&n_features, w_ptr, &ONE, q_ptr, &ONE)
+
+        for ii in range(n_features):
+            XtA[ii] = q[ii] - H[ii] - beta * w[ii]
+        if positive:
+            dual_norm_XtA = max(n_features, XtA_ptr)
+        else:
+            dual_norm_XtA = abs_max(n_features, XtA_ptr)
+
+        # temp = np.sum(w * H)
+        tmp = 0.0
+        for ii in range(n_features):
+            tmp += w[ii] * H[ii]
+        R_norm2 = y_norm2 + tmp - 2.0 * q_dot_w
+
+        # w_norm2 = np.dot(w, w)
+        w_norm2 = dot(&n_features, &w[0], &ONE, &w[0], &ONE)
+
+        if (dual_norm_XtA > alpha):
+            const = alpha / dual_norm_XtA
+            A_norm2 = R_norm2 * (const ** 2)
+            gap = 0.5 * (R_norm2 + A_norm2)
+        else:
+            const = 1.0
+            gap = R_norm2
+
+        # The call to dasum is equivalent to the L1 norm of w
+        gap += (alpha * asum(&n_features, &w[0], &ONE) -
+                const * y_norm2 +  const * q_dot_w +
+                0.5 * beta * (1 + const ** 2) * w_norm2)
+
+        if gap < tol:
+            # return if we reached desired tolerance
+            break
+
+        if not screen:
+            continue
+
+        # Gap safe screening: the dual optimum lies in the ball of radius
+        # sqrt(2 * gap) around the dual point const * residual
+        radius = sqrt(2 * fmax(gap, 0))
+        jj = 0
+        for f_iter in range(n_active):
+            ii = active[f_iter]
+            tmp = const * XtA[ii]
+            if not positive:
+                tmp = fabs(tmp)
+            if tmp + radius * sqrt(Q[ii, ii] + beta) < alpha:
+                if w[ii] != 0.0:
+                    mw_ii = -w[ii]
+                    axpy(&n_features, &mw_ii, Q_ptr + ii * n_features, &ONE,
+                         H_ptr, &ONE)
+                    w[ii] = 0.0
             else:
-                dual_norm_XtA = abs_max(n_features, XtA_ptr)
-
-            # temp = np.sum(w * H)
-            tmp = 0.0
-            for ii in range(n_features):
-                tmp += w[ii] * H[ii]
-            R_norm2 = y_norm2 + tmp - 2.0 * q_dot_w
-
-            # w_norm2 = np.dot(w, w)
-            w_norm2 = dot(&n_features, &w[0], &ONE, &w[0], &ONE)
-
-            if (dual_norm_XtA > alpha):
-                const = alpha / dual_norm_XtA
-                A_norm2 = R_norm2 * (const ** 2)
-                gap = 0.5 * (R_norm2 + A_norm2)
-            else:
-                const = 1.0
-                gap = R_norm2
-
-            # The call to dasum is equivalent to the L1 norm of w
-            gap += (alpha * asum(&n_features, &w[0], &ONE) -
-                    const * y_norm2 +  const * q_dot_w +
-                    0.5 * beta * (1 + const ** 2) * w_norm2)
-
-            if gap < tol:
-                # return if we reached desired tolerance
-                break
\ No newline at end of file
+                active[jj] = ii
+                jj += 1
+        n_active = jj
+    return n_iter
@@ -48,7 +48,8 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
                  mask_strategy='background', mask_args=None,
                  memory=Memory(cachedir=None),
                  memory_level=2,
-                 n_jobs=1, verbose=0, ):
+                 n_jobs=1, verbose=0,
+                 sparse_comp_threshold=0):
         BaseNilearnEstimator.__init__(self,
                                       mask=mask,
                                       smoothing_fwhm=smoothing_fwhm,
@@ -70,6 +71,7 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
         self.transform_batch_size = transform_batch_size
         self.dict_init = dict_init
         self.alpha = alpha
+        self.sparse_comp_threshold = sparse_comp_threshold
 
     def fit(self, imgs=None, y=None, confounds=None):
         if imgs is not None:
@@ -88,7 +90,9 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
             self.coder_ = Coder(dictionary=self.components_,
                                 code_alpha=self.alpha,
                                 code_l1_ratio=0,
-                                n_threads=self.n_jobs).fit()
+                                n_threads=self.n_jobs,
+                                sparse_comp_threshold=
+                                self.sparse_comp_threshold).fit()
 
     def score(self, imgs, confounds=None):
         """
@@ -257,6 +261,23 @@ class fMRIDictFact(fMRICoderMixin):
     verbose: integer, optional
         Indicate the level of verbosity. By default, nothing is printed
 
+    sparse_comp_threshold: float in [0, 1], optional
+        Density of the maps below which products with them use a sparse
+        copy, both when learning and transforming. 0 disables it.
+
+    n_iter_no_change: int or None, optional
+        If not None, learning stops before n_epochs when the surrogate
+        objective of the underlying DictFact has not decreased (relatively)
+        by more than surrogate_tol during n_iter_no_change batches.
+
+    surrogate_tol: float, optional
+        See n_iter_no_change.
+
+    background_callback: boolean, optional
+        If True, callback is called in a background thread, with a snapshot
+        of the underlying DictFact taken at the time of the call, so that
+        scoring does not stall learning.
+
     """
 
     def __init__(self,
@@ -279,7 +300,11 @@ class fMRIDictFact(fMRICoderMixin):
                  mask_strategy='background', mask_args=None,
                  memory=Memory(cachedir=None), memory_level=0,
                  n_jobs=1, verbose=0,
-                 callback=None):
+                 callback=None,
+                 sparse_comp_threshold=0,
+                 n_iter_no_change=None,
+                 surrogate_tol=1e-4,
+                 background_callback=False):
         fMRICoderMixin.__init__(self, n_components=n_components,
                                 alpha=alpha,
                                 dict_init=dict_init,
@@ -298,7 +323,8 @@ class fMRIDictFact(fMRICoderMixin):
                                 memory=memory,
                                 memory_level=memory_level,
                                 n_jobs=n_jobs,
-                                verbose=verbose)
+                                verbose=verbose,
+                                sparse_comp_threshold=sparse_comp_threshold)
         self.n_epochs = n_epochs
         self.batch_size = batch_size
         self.reduction = reduction
@@ -308,6 +334,9 @@ class fMRIDictFact(fMRICoderMixin):
         self.learning_rate = learning_rate
         self.random_state = random_state
         self.callback = callback
+        self.n_iter_no_change = n_iter_no_change
+        self.surrogate_tol = surrogate_tol
+        self.background_callback = background_callback
 
     def fit(self, imgs=None, y=None, confounds=None):
         """Compute the mask and the dictionary maps across subjects
@@ -337,7 +366,8 @@ class fMRIDictFact(fMRICoderMixin):
         self.components_ = self._cache(_compute_components,
                                        func_memory_level=1,
                                        ignore=['n_jobs',
-                                               'verbose'])(
+                                               'verbose',
+                                               'background_callback'])(
             self.masker_, imgs,
             step_size=self.step_size,
             confounds=confounds,
@@ -353,12 +383,18 @@ class fMRIDictFact(fMRICoderMixin):
             verbose=self.verbose,
             random_state=self.random_state,
             callback=self.callback,
-            n_jobs=self.n_jobs)
+            n_jobs=self.n_jobs,
+            sparse_comp_threshold=self.sparse_comp_threshold,
+            n_iter_no_change=self.n_iter_no_change,
+            surrogate_tol=self.surrogate_tol,
+            background_callback=self.background_callback)
         self.components_img_ = self.masker_.inverse_transform(self.components_)
         self.coder_ = Coder(dictionary=self.components_,
                             code_alpha=self.alpha,
                             code_l1_ratio=0,
-                            n_threads=self.n_jobs).fit()
+                            n_threads=self.n_jobs,
+                            sparse_comp_threshold=
+                            self.sparse_comp_threshold).fit()
         return self
 
 
@@ -373,7 +409,8 @@ class fMRICoder(fMRICoderMixin):
                  mask_strategy='background', mask_args=None,
                  memory=Memory(cachedir=None),
                  memory_level=2,
-                 n_jobs=1, verbose=0, ):
+                 n_jobs=1, verbose=0,
+                 sparse_comp_threshold=0):
         self.dictionary = dictionary
         fMRICoderMixin.__init__(self,
                                 n_components=None,
@@ -394,7 +431,8 @@ class fMRICoder(fMRICoderMixin):
                                 memory=memory,
                                 memory_level=memory_level,
                                 n_jobs=n_jobs,
-                                verbose=verbose)
+                                verbose=verbose,
+                                sparse_comp_threshold=sparse_comp_threshold)
 
 
 def _check_dict_init(dict_init, mask_img, n_components=None):
@@ -430,13 +468,19 @@ def _compute_components(masker,
                         verbose=0,
                         random_state=None,
                         callback=None,
-                        n_jobs=1):
+                        n_jobs=1,
+                        sparse_comp_threshold=0,
+                        n_iter_no_change=None,
+                        surrogate_tol=1e-4,
+                        background_callback=False):
     methods = {'masked': {'G_agg': 'masked', 'Dx_agg': 'masked'},
                'dictionary only': {'G_agg': 'full', 'Dx_agg': 'full'},
                'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
                # 1st epoch parameters
                'average': {'G_agg': 'average', 'Dx_agg': 'average'},
-               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
+               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'},
+               # reduction chosen by DictFact.reduction_controller_
+               'adaptive': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
 
     masker._check_fitted()
     dict_init = _check_dict_init(dict_init, mask_img=masker.mask_img_,
@@ -445,6 +489,7 @@ def _compute_components(masker,
     if dict_init is not None:
         n_components = dict_init.shape[0]
     random_state = check_random_state(random_state)
+    adaptive_reduction = method == 'adaptive'
     if method == 'sgd':
         optimizer = 'sgd'
         G_agg = 'full'
@@ -484,6 +529,10 @@ def _compute_components(masker,
                          batch_size=batch_size,
                          random_state=random_state,
                          n_threads=n_jobs,
+                         sparse_comp_threshold=sparse_comp_threshold,
+                         adaptive_reduction=adaptive_reduction,
+                         n_iter_no_change=n_iter_no_change,
+                         surrogate_tol=surrogate_tol,
                          verbose=0)
     dict_fact.prepare(n_samples=n_samples, n_features=n_voxels,
                       X=dict_init, dtype=dtype)
@@ -510,7 +559,11 @@ def _compute_components(masker,
                 if (verbose and verbose_iter_ and
                             current_n_records >= verbose_iter_[0]):
                     print('Record %i' % current_n_records)
-                    if callback is not None:
+                    if callback is not None and background_callback:
+                        dict_fact._background(callback, masker,
+                                              dict_fact._snapshot(),
+                                              cpu_time, io_time)
+                    elif callback is not None:
                         callback(masker, dict_fact, cpu_time, io_time)
                     verbose_iter_ = verbose_iter_[1:]
 
@@ -532,6 +585,13 @@ def _compute_components(masker,
                                       sample_indices=sample_indices)
                 current_n_records += 1
                 cpu_time += time.perf_counter() - t0
+                if dict_fact.converged_:
+                    break
+            if dict_fact.converged_:
+                if verbose:
+                    print('Converged at record %i' % current_n_records)
+                break
+    dict_fact.join_callbacks()
     components = _flip(dict_fact.components_)
     return components
 
@@ -593,6 +653,7 @@ class rfMRIDictionaryScorer:
         self.info = info
 
     def __call__(self, masker, dict_fact, cpu_time, io_time):
+        snapshot_time = getattr(dict_fact, 'snapshot_time_', None)
         test_time = time.perf_counter()
         if not hasattr(self, 'data'):
             self.data = masker.transform(self.test_imgs,
@@ -600,8 +661,11 @@ class rfMRIDictionaryScorer:
         scores = np.array([dict_fact.score(data) for data in self.data])
         len_imgs = np.array([data.shape[0] for data in self.data])
         score = np.sum(scores * len_imgs) / np.sum(len_imgs)
-        self.test_time += time.perf_counter() - test_time
-        this_time = time.perf_counter() - self.start_time - self.test_time
+        if snapshot_time is None:
+            self.test_time += time.perf_counter() - test_time
+            snapshot_time = time.perf_counter()
+        # Scoring in background does not stall learning
+        this_time = snapshot_time - self.start_time - self.test_time
         self.score.append(score)
         self.time.append(this_time)
         self.cpu_time.append(cpu_time)
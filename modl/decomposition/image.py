@@ -1,7 +1,10 @@
+import copy
 from math import sqrt
 
 import time
 
+import numpy as np
+
 from modl.feature_extraction.image import LazyCleanPatchExtractor
 from modl.input_data.image import scale_patches
 from sklearn.base import BaseEstimator
@@ -16,7 +19,9 @@ class ImageDictFact(BaseEstimator):
                'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
                # 1st epoch parameters
                'average': {'G_agg': 'average', 'Dx_agg': 'average'},
-               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
+               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'},
+               # reduction chosen by DictFact.reduction_controller_
+               'adaptive': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
 
     settings = {'dictionary learning': {'comp_l1_ratio': 0,
                                         'code_l1_ratio': 1,
@@ -47,8 +52,10 @@ class ImageDictFact(BaseEstimator):
                  max_patches=None,
                  verbose=0,
                  n_threads=1,
+                 background_callback=False,
                  ):
         self.n_threads = n_threads
+        self.background_callback = background_callback
         self.step_size = step_size
         self.verbose = verbose
         self.callback = callback
@@ -111,7 +118,11 @@ class ImageDictFact(BaseEstimator):
                                    tol=1e-2,
                                    callback=self._callback,
                                    verbose=self.verbose,
-                                   n_threads=self.n_threads)
+                                   n_threads=self.n_threads,
+                                   adaptive_reduction=
+                                   self.method == 'adaptive',
+                                   background_callback=
+                                   self.background_callback)
 
         if self.verbose:
             print('Preparing patch extraction')
@@ -130,6 +141,7 @@ class ImageDictFact(BaseEstimator):
         init_patches = _flatten_patches(init_patches, with_std=with_std,
                                         with_mean=with_mean, copy=False)
         self.dict_fact_.prepare(n_samples=n_patches, X=init_patches)
+        permutation = np.arange(n_patches)
         for i in range(self.n_epochs):
             if self.verbose:
                 print('Epoch %i' % (i + 1))
@@ -137,7 +149,6 @@ class ImageDictFact(BaseEstimator):
                 if self.verbose:
                     print('Shuffling dataset')
                 permutation = self.dict_fact_.shuffle()
-                patch_extractor.shuffle(permutation)
             buffers = gen_batches(n_patches, buffer_size)
             if self.method == 'gram' and i == 4:
                 self.dict_fact_.set_params(G_agg='full', Dx_agg='average')
@@ -146,10 +157,13 @@ class ImageDictFact(BaseEstimator):
                 self.dict_fact_.set_params(reduction=reduction)
             for j, buffer in enumerate(buffers):
                 buffer_size = buffer.stop - buffer.start
-                patches = patch_extractor.partial_transform(batch=buffer)
+                these_indices = permutation[buffer]
+                patches = patch_extractor.partial_transform(
+                    batch=these_indices)
                 patches = _flatten_patches(patches, with_mean=with_mean,
                                            with_std=with_std, copy=False)
-                self.dict_fact_.partial_fit(patches, buffer)
+                self.dict_fact_.partial_fit(patches, these_indices)
+        self.dict_fact_.join_callbacks()
         return self
 
     def transform(self, patches):
@@ -178,6 +192,11 @@ class ImageDictFact(BaseEstimator):
         # Property for callback purpose
         return self.dict_fact_.time_
 
+    @property
+    def snapshot_time_(self):
+        # Property for callback purpose
+        return getattr(self.dict_fact_, 'snapshot_time_', None)
+
     @property
     def components_(self):
         # Property for callback purpose
@@ -185,9 +204,15 @@ class ImageDictFact(BaseEstimator):
         return self.dict_fact_.components_.reshape(
             components_shape)
 
-    def _callback(self, *args):
+    def _callback(self, dict_fact):
         if self.callback is not None:
-            self.callback(self)
+            if dict_fact is not self.dict_fact_:
+                # Snapshot scored in background
+                estimator = copy.copy(self)
+                estimator.dict_fact_ = dict_fact
+            else:
+                estimator = self
+            self.callback(estimator)
 
 
 def _flatten_patches(patches, with_mean=True,
@@ -201,7 +226,7 @@ def _flatten_patches(patches, with_mean=True,
 
 class DictionaryScorer:
     def __init__(self, test_data, info=None):
-        self.start_time = time.clock()
+        self.start_time = time.perf_counter()
         self.test_data = test_data
         self.test_time = 0
         self.time = []
@@ -211,10 +236,14 @@ class DictionaryScorer:
         self.info = info
 
     def __call__(self, dict_fact):
-        test_time = time.clock()
+        snapshot_time = getattr(dict_fact, 'snapshot_time_', None)
+        test_time = time.perf_counter()
         score = dict_fact.score(self.test_data)
-        self.test_time += time.clock() - test_time
-        this_time = time.clock() - self.start_time - self.test_time
+        if snapshot_time is None:
+            self.test_time += time.perf_counter() - test_time
+            snapshot_time = time.perf_counter()
+        # Scoring in background does not stall learning
+        this_time = snapshot_time - self.start_time - self.test_time
         self.time.append(this_time)
         self.score.append(score)
         self.iter.append(dict_fact.n_iter_)
@@ -0,0 +1,665 @@
+"""
+Data-parallel fitting of DictFact over worker processes.
+
+Samples are split in shards, one per worker. Codes and per-sample
+statistics (Dx_average_, G_average_, sample_n_iter_) are held in shared
+memory, in which each worker updates the rows of its shard. They are copied
+back to the coordinator once workers are done.
+
+In synchronous mode (fit_data_parallel), workers compute codes against the
+dictionary published by the coordinator. They send back the contributions
+of their batch to the sufficient statistics C_ and B_, which the
+coordinator merges to update the dictionary.
+
+In asynchronous mode (fit_asynchronous), workers share the dictionary and
+C_ and B_, and update them without locks (Hogwild), each on the feature
+subsets drawn by its own Sampler.
+"""
+import multiprocessing
+import queue
+import time
+import traceback
+from abc import ABC, abstractmethod
+
+import numpy as np
+from sklearn.utils import check_random_state, gen_batches
+from sklearn.utils.extmath import safe_sparse_dot
+
+from .dict_fact_fast import _batch_weight
+from ..utils.math.enet import enet_norm_rows, enet_projection_rows
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+class Transport(ABC):
+    """
+    Communication between the coordinator and the workers of a data-parallel
+    DictFact. The coordinator updates the dictionary arrays in place and
+    sends tasks, workers read the dictionary, compute their statistics and
+    send them back. Workers update the per-sample statistics of their shard
+    in place. Implementations may span processes or nodes.
+    """
+
+    @abstractmethod
+    def start(self, n_workers, n_samples, n_components, n_features, dtype,
+              asynchronous=False, sample_stats=None):
+        """Allocate buffers, before workers are started. sample_stats maps
+        the names of per-sample statistics to the (shape, dtype) of their
+        rows"""
+
+    @abstractmethod
+    def dictionary(self):
+        """Return (components, G, code) arrays, shared by the coordinator
+        and the workers. code has shape (n_samples, n_components)"""
+
+    @abstractmethod
+    def sample_statistics(self):
+        """Return a dict mapping the names of per-sample statistics given to
+        start to arrays of n_samples rows, shared by the coordinator and the
+        workers"""
+
+    @abstractmethod
+    def statistics(self):
+        """Return (C, B, comp_norm, n_iter) arrays, shared by the workers
+        in asynchronous mode. n_iter is an int64 array of shape (1, )"""
+
+    @abstractmethod
+    def publish(self):
+        """Make updates of the dictionary visible to workers (coordinator
+        side)"""
+
+    @abstractmethod
+    def send_task(self, worker_id, task):
+        """Send a task to a worker, None to stop it (coordinator side)"""
+
+    @abstractmethod
+    def recv_task(self, worker_id):
+        """Wait for the next task (worker side)"""
+
+    @abstractmethod
+    def send_stats(self, worker_id, batch_size, CtC, BtX):
+        """Send the statistics of a batch (worker side). CtC and BtX are
+        None if the batch is empty"""
+
+    @abstractmethod
+    def send_error(self, worker_id, message):
+        """Report a failure (worker side)"""
+
+    @abstractmethod
+    def send_done(self, worker_id):
+        """Report the end of work (worker side), once the per-sample
+        statistics of the shard are written"""
+
+    @abstractmethod
+    def poll_done(self, timeout):
+        """Wait at most timeout seconds for a worker to finish (coordinator
+        side). Return its id, or None if no worker finished"""
+
+    @abstractmethod
+    def recv_stats(self, timeout):
+        """Wait at most timeout seconds for the statistics of a worker
+        (coordinator side). Return None if no statistics were received.
+
+        Returns
+        -------
+        worker_id: int
+        batch_size: int
+        CtC: ndarray, shape = (n_components, n_components)
+        BtX: ndarray, shape = (n_components, n_features)
+            Sums over the batch of code.T.dot(code) and code.T.dot(X), valid
+            until the next task is sent to the worker. Not to be read if
+            batch_size is 0
+        """
+
+    def close(self):
+        """Release resources (coordinator side)"""
+        pass
+
+
+class SharedMemoryTransport(Transport):
+    """
+    Transport between processes of a single machine. Arrays are kept in
+    multiprocessing.shared_memory blocks, so that the dictionary is shared
+    without copy and each worker writes its statistics in its own block.
+    Only control messages go through queues.
+    """
+
+    def __init__(self, context=None):
+        if shared_memory is None:
+            raise ImportError('SharedMemoryTransport requires '
+                              'multiprocessing.shared_memory (Python >= 3.8)')
+        if context is None:
+            context = multiprocessing.get_context()
+        self.context = context
+
+    def start(self, n_workers, n_samples, n_components, n_features, dtype,
+              asynchronous=False, sample_stats=None):
+        dtype = np.dtype(dtype)
+        self._layout = {'components': ((n_components, n_features), dtype),
+                        'G': ((n_components, n_components), dtype),
+                        'code': ((n_samples, n_components), dtype)}
+        self._sample_stats = []
+        if sample_stats is not None:
+            for name, (shape, this_dtype) in sample_stats.items():
+                self._layout[name] = ((n_samples, ) + tuple(shape),
+                                      np.dtype(this_dtype))
+                self._sample_stats.append(name)
+        if asynchronous:
+            self._layout.update(
+                C=((n_components, n_components), dtype),
+                B=((n_components, n_features), dtype),
+                comp_norm=((n_components, ), dtype),
+                n_iter=((1, ), np.dtype(np.int64)))
+        else:
+            for worker_id in range(n_workers):
+                self._layout['CtC_%i' % worker_id] = ((n_components,
+                                                       n_components), dtype)
+                self._layout['BtX_%i' % worker_id] = ((n_components,
+                                                       n_features), dtype)
+        self._blocks = {}
+        for name, (shape, this_dtype) in self._layout.items():
+            size = max(int(np.prod(shape)) * this_dtype.itemsize, 1)
+            self._blocks[name] = shared_memory.SharedMemory(create=True,
+                                                            size=size)
+        self._attach()
+        self._task_queues = [self.context.SimpleQueue()
+                             for _ in range(n_workers)]
+        self._result_queue = self.context.Queue()
+
+    def _attach(self):
+        self._arrays = {name: np.ndarray(shape, dtype=this_dtype,
+                                         buffer=self._blocks[name].buf)
+                        for name, (shape, this_dtype)
+                        in self._layout.items()}
+
+    def dictionary(self):
+        return (self._arrays['components'], self._arrays['G'],
+                self._arrays['code'])
+
+    def sample_statistics(self):
+        return {name: self._arrays[name] for name in self._sample_stats}
+
+    def statistics(self):
+        return (self._arrays['C'], self._arrays['B'],
+                self._arrays['comp_norm'], self._arrays['n_iter'])
+
+    def publish(self):
+        # Updates are made in place in shared memory, and workers only read
+        # the dictionary after receiving a task
+        pass
+
+    def send_task(self, worker_id, task):
+        self._task_queues[worker_id].put(task)
+
+    def recv_task(self, worker_id):
+        return self._task_queues[worker_id].get()
+
+    def send_stats(self, worker_id, batch_size, CtC, BtX):
+        if batch_size > 0:
+            self._arrays['CtC_%i' % worker_id][:] = CtC
+            self._arrays['BtX_%i' % worker_id][:] = BtX
+        self._result_queue.put((worker_id, batch_size, None))
+
+    def send_error(self, worker_id, message):
+        self._result_queue.put((worker_id, 0, message))
+
+    def send_done(self, worker_id):
+        self._result_queue.put((worker_id, 0, None))
+
+    def _recv(self, timeout):
+        try:
+            worker_id, batch_size, error = \
+                self._result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+        if error is not None:
+            raise RuntimeError('Worker %i failed:\n%s' % (worker_id, error))
+        return worker_id, batch_size
+
+    def recv_stats(self, timeout):
+        worker_id, batch_size = self._recv(timeout)
+        if worker_id is None:
+            return None
+        return (worker_id, batch_size, self._arrays['CtC_%i' % worker_id],
+                self._arrays['BtX_%i' % worker_id])
+
+    def poll_done(self, timeout):
+        worker_id, _ = self._recv(timeout)
+        return worker_id
+
+    def close(self):
+        self._arrays = {}
+        for block in self._blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # Views are still referenced (e.g. by a traceback): the
+                # memory is released when they are collected
+                pass
+            block.unlink()
+        self._blocks = {}
+
+    def __getstate__(self):
+        # Arrays are views of the blocks, rebuilt after unpickling
+        state = dict(self.__dict__)
+        state.pop('_arrays', None)
+        state.pop('context', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._attach()
+
+
+def _get_context():
+    """Fork when available: workers then inherit the shared memory blocks,
+    instead of attaching them by name (which makes the resource tracker of
+    each worker unlink them when it exits, before Python 3.13)"""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _prepare_worker(estimator, transport, code_slice):
+    """Set up estimator to code the samples of its shard against the shared
+    dictionary. The dictionary, G_, code_ and per-sample statistics are
+    views of the arrays of transport"""
+    components, G, code = transport.dictionary()
+    estimator.random_state = check_random_state(estimator.random_state)
+    estimator.components_ = components
+    if estimator.G_agg == 'full':
+        estimator.G_ = G
+    estimator.code_ = code[code_slice]
+    for name, array in transport.sample_statistics().items():
+        setattr(estimator, name, array[code_slice])
+    estimator._init_profile()
+
+
+def _worker(transport, worker_id, estimator, X, code_slice, batch_size,
+            n_epoch_steps):
+    """Code batches of the shard X against the shared dictionary, until a
+    None task is received. Epochs last n_epoch_steps tasks, after the last
+    batch of the shard empty batches are sent"""
+    try:
+        n_samples = X.shape[0]
+        _prepare_worker(estimator, transport, code_slice)
+        # Visit the shard in order first, as DictFact.fit
+        permutation = np.arange(n_samples)
+        step = 0
+        while True:
+            subset = transport.recv_task(worker_id)
+            if subset is None:
+                break
+            if step == n_epoch_steps:
+                permutation = estimator.shuffle(n_samples)
+                step = 0
+            sample_indices = permutation[step * batch_size:
+                                         (step + 1) * batch_size]
+            step += 1
+            if len(sample_indices) == 0:
+                transport.send_stats(worker_id, 0, None, None)
+                continue
+            this_X = X[sample_indices]
+            this_code = estimator._code_batch(this_X, sample_indices, subset)
+            transport.send_stats(worker_id, len(sample_indices),
+                                 this_code.T.dot(this_code),
+                                 safe_sparse_dot(this_code.T, this_X))
+        transport.send_done(worker_id)
+    except Exception:
+        transport.send_error(worker_id, traceback.format_exc())
+    finally:
+        estimator._exit()
+
+
+def _async_worker(transport, worker_id, estimator, X, code_slice):
+    """Fit the shard X, updating the shared dictionary and statistics without
+    synchronization with other workers"""
+    try:
+        C, B, comp_norm, n_iter = transport.statistics()
+        n_samples, n_features = X.shape
+        _prepare_worker(estimator, transport, code_slice)
+        estimator.C_ = C
+        estimator.B_ = B
+        estimator.comp_norm_ = comp_norm
+        estimator._init_update_buffers(n_features, C.dtype)
+        estimator._init_sampler(n_features)
+        estimator.n_iter_ = 0
+        estimator.time_ = 0
+        estimator._init_controller()
+        estimator._init_surrogate()
+        permutation = np.arange(n_samples)
+        for i in range(estimator.n_epochs):
+            if i >= 1:
+                permutation = estimator.shuffle(n_samples)
+            for batch in gen_batches(n_samples, estimator.batch_size):
+                sample_indices = permutation[batch]
+                # The learning rate follows the number of samples seen by all
+                # workers. Concurrent increments may be lost, as other
+                # updates (Hogwild).
+                estimator.n_iter_ = int(n_iter[0])
+                n_iter[0] += len(sample_indices)
+                estimator._single_batch_fit(X[sample_indices],
+                                            sample_indices)
+        transport.send_done(worker_id)
+    except Exception:
+        transport.send_error(worker_id, traceback.format_exc())
+    finally:
+        estimator._exit()
+
+
+def fit_asynchronous(estimator, X, transport=None, poll_interval=0.01):
+    """
+    Fit a prepared DictFact on X with estimator.n_jobs worker processes,
+    without synchronization.
+
+    Each worker runs the single-process algorithm on its shard of X, with its
+    own Sampler, on a dictionary, C_ and B_ held in shared memory, which it
+    updates without locks. As the dictionary update only touches the columns
+    of the drawn subset, updates of different workers rarely conflict for
+    large reductions (subset_order='block' makes subsets contiguous runs of
+    features, which overlap less). The coordinator calls callback as
+    samples are seen. Lost updates may let atoms drift out of the
+    constraint ball: they are finally projected back, and comp_norm_ and G_
+    recomputed.
+
+    Parameters
+    ----------
+    estimator: DictFact
+        Prepared estimator, with optimizer='variational'
+    X: ndarray or CSR matrix, shape = (n_samples, n_features)
+    transport: Transport, optional
+        Defaults to a SharedMemoryTransport
+    poll_interval: float
+        Time (in seconds) between checks of progress by the coordinator
+
+    Returns
+    -------
+    estimator
+    """
+    n_samples, n_features = X.shape
+    n_jobs = min(estimator.n_jobs, n_samples)
+    if transport is None:
+        transport = SharedMemoryTransport(_get_context())
+    transport.start(n_jobs, n_samples, estimator.n_components, n_features,
+                    estimator.components_.dtype, asynchronous=True,
+                    sample_stats=_sample_stats_layout(estimator))
+    bounds = np.linspace(0, n_samples, n_jobs + 1).astype('int')
+    workers = []
+    try:
+        _share_dictionary(estimator, transport)
+        _share_statistics(estimator, transport)
+        _share_sample_stats(estimator, transport)
+        worker_params = estimator.get_params()
+        worker_params.update(n_jobs=1, n_threads=1, verbose=0, callback=None,
+                             dict_init=None, trace_file=None,
+                             sparse_comp_threshold=0,
+                             adaptive_reduction=False,
+                             adaptive_batch_size=False,
+                             n_iter_no_change=None)
+        for worker_id in range(n_jobs):
+            shard = slice(bounds[worker_id], bounds[worker_id + 1])
+            worker_params['random_state'] = estimator.random_state.randint(
+                np.iinfo(np.int32).max)
+            worker_estimator = estimator.__class__(**worker_params)
+            worker = transport.context.Process(
+                target=_async_worker,
+                args=(transport, worker_id, worker_estimator, X[shard],
+                      shard))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        n_iter = transport.statistics()[3]
+        n_running = n_jobs
+        t0 = time.perf_counter()
+        while n_running > 0:
+            if _poll_done(transport, workers, poll_interval):
+                n_running -= 1
+            estimator.n_iter_ = int(n_iter[0])
+            estimator.time_ = time.perf_counter() - t0
+            estimator._check_verbose()
+            if estimator._batch_times:
+                estimator._record_batch_times(0)
+        estimator.n_iter_ = int(n_iter[0])
+        _gather_sample_stats(estimator, transport)
+    except BaseException:
+        # Remaining workers would otherwise run until the end of their shard
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+        _unshare_dictionary(estimator, transport)
+        _unshare_statistics(estimator)
+        transport.close()
+    _restore_constraints(estimator)
+    return estimator
+
+
+def fit_data_parallel(estimator, X, transport=None, poll_interval=0.01):
+    """
+    Fit a prepared DictFact on X with estimator.n_jobs worker processes.
+
+    At each step, every worker codes a batch of estimator.batch_size rows of
+    its shard of X on the same feature subset, and the coordinator merges
+    their contributions to C_ and B_ with the _batch_weight schedule of the
+    whole step before updating the dictionary. Epochs last as many steps as
+    the largest shard needs: workers with smaller shards send empty batches
+    at the end of epochs, so that all samples are seen once per epoch.
+
+    Parameters
+    ----------
+    estimator: DictFact
+        Prepared estimator
+    X: ndarray or CSR matrix, shape = (n_samples, n_features)
+    transport: Transport, optional
+        Defaults to a SharedMemoryTransport
+    poll_interval: float
+        Time (in seconds) between checks that workers are alive, while
+        waiting for their statistics
+
+    Returns
+    -------
+    estimator
+    """
+    n_samples, n_features = X.shape
+    n_jobs = min(estimator.n_jobs, n_samples)
+    if transport is None:
+        transport = SharedMemoryTransport(_get_context())
+    transport.start(n_jobs, n_samples, estimator.n_components, n_features,
+                    estimator.components_.dtype,
+                    sample_stats=_sample_stats_layout(estimator))
+    bounds = np.linspace(0, n_samples, n_jobs + 1).astype('int')
+    n_epoch_steps = int(np.ceil(np.max(np.diff(bounds))
+                                / estimator.batch_size))
+    workers = []
+    try:
+        _share_dictionary(estimator, transport)
+        _share_sample_stats(estimator, transport)
+        worker_params = estimator.get_params()
+        worker_params.update(n_jobs=1, n_threads=1, verbose=0, callback=None,
+                             dict_init=None, trace_file=None,
+                             sparse_comp_threshold=0,
+                             adaptive_reduction=False,
+                             adaptive_batch_size=False,
+                             n_iter_no_change=None)
+        for worker_id in range(n_jobs):
+            shard = slice(bounds[worker_id], bounds[worker_id + 1])
+            worker_params['random_state'] = estimator.random_state.randint(
+                np.iinfo(np.int32).max)
+            worker_estimator = estimator.__class__(**worker_params)
+            worker = transport.context.Process(
+                target=_worker,
+                args=(transport, worker_id, worker_estimator, X[shard],
+                      shard, estimator.batch_size, n_epoch_steps))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for _ in range(estimator.n_epochs * n_epoch_steps):
+            _coordinate_step(estimator, transport, workers, poll_interval)
+        for worker_id in range(n_jobs):
+            transport.send_task(worker_id, None)
+        n_running = n_jobs
+        while n_running > 0:
+            if _poll_done(transport, workers, poll_interval):
+                n_running -= 1
+        _gather_sample_stats(estimator, transport)
+    except BaseException:
+        # Workers may be waiting for a task or a dead worker
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+        _unshare_dictionary(estimator, transport)
+        transport.close()
+    return estimator
+
+
+def _share_dictionary(estimator, transport):
+    """Move the dictionary of estimator to the arrays of transport"""
+    components, G, code = transport.dictionary()
+    components[:] = estimator.components_
+    estimator.components_ = components
+    if estimator.G_agg == 'full':
+        G[:] = estimator.G_
+        estimator.G_ = G
+    code[:] = 1
+    estimator.code_ = code
+
+
+def _sample_stats_layout(estimator):
+    """(shape, dtype) of the rows of the per-sample statistics of
+    estimator"""
+    names = ['sample_n_iter_', 'Dx_average_']
+    if estimator.G_agg == 'average':
+        names.append('G_average_')
+    return {name: (getattr(estimator, name).shape[1:],
+                   getattr(estimator, name).dtype) for name in names}
+
+
+def _share_sample_stats(estimator, transport):
+    """Copy the per-sample statistics of estimator to the arrays of
+    transport. They stay in place in estimator (G_average_ may be
+    memory-mapped), and are copied back by _gather_sample_stats"""
+    for name, array in transport.sample_statistics().items():
+        array[:] = getattr(estimator, name)
+
+
+def _gather_sample_stats(estimator, transport):
+    """Copy the per-sample statistics updated by workers to estimator"""
+    for name, array in transport.sample_statistics().items():
+        getattr(estimator, name)[:] = array
+
+
+def _share_statistics(estimator, transport):
+    """Move the statistics of estimator to the arrays of transport"""
+    C, B, comp_norm, n_iter = transport.statistics()
+    C[:] = estimator.C_
+    estimator.C_ = C
+    B[:] = estimator.B_
+    estimator.B_ = B
+    comp_norm[:] = estimator.comp_norm_
+    estimator.comp_norm_ = comp_norm
+    n_iter[0] = estimator.n_iter_
+
+
+def _unshare_statistics(estimator):
+    """Copy the statistics of estimator out of shared arrays"""
+    estimator.C_ = np.array(estimator.C_)
+    estimator.B_ = np.array(estimator.B_)
+    estimator.comp_norm_ = np.array(estimator.comp_norm_)
+
+
+def _restore_constraints(estimator):
+    """Project atoms back on the elastic-net ball and recompute comp_norm_,
+    after unsynchronized updates"""
+    l1_ratio = estimator.comp_l1_ratio
+    components = np.empty_like(estimator.components_)
+    # Atoms within the ball are left unchanged
+    enet_projection_rows(estimator.components_, components, 1, l1_ratio,
+                         estimator.n_threads,
+                         estimator.comp_projection == 'condat')
+    estimator.components_ = components
+    estimator.comp_norm_[:] = 1 - enet_norm_rows(components, l1_ratio,
+                                                 estimator.n_threads)
+    if estimator.G_agg == 'full':
+        estimator.G_ = components.dot(components.T)
+
+
+def _unshare_dictionary(estimator, transport):
+    """Copy the dictionary of estimator out of the arrays of transport"""
+    estimator.components_ = np.array(estimator.components_)
+    if estimator.G_agg == 'full':
+        estimator.G_ = np.array(estimator.G_)
+    estimator.code_ = np.array(estimator.code_)
+
+
+def _poll_done(transport, workers, poll_interval):
+    """Wait at most poll_interval seconds for a worker to finish. Return
+    whether a worker finished"""
+    worker_id = transport.poll_done(poll_interval)
+    if worker_id is None:
+        if any(worker.exitcode not in (None, 0) for worker in workers):
+            raise RuntimeError('A worker exited unexpectedly')
+        return False
+    return True
+
+
+def _coordinate_step(estimator, transport, workers, poll_interval):
+    """Have each worker code a batch, merge their statistics and update the
+    dictionary"""
+    n_jobs = len(workers)
+    n_components, n_features = estimator.components_.shape
+    dtype = estimator.components_.dtype
+    estimator._check_verbose()
+    t0 = time.perf_counter()
+    subset = estimator._draw_subset()
+    t_code = time.perf_counter()
+    if not isinstance(subset, slice):
+        # Memory-view from the Sampler
+        subset = np.asarray(subset)
+    transport.publish()
+    for worker_id in range(n_jobs):
+        transport.send_task(worker_id, subset)
+    batch_size = 0
+    CtC = np.zeros((n_components, n_components), dtype=dtype)
+    BtX = np.zeros((n_components, n_features), dtype=dtype)
+    n_received = 0
+    while n_received < n_jobs:
+        stats = transport.recv_stats(poll_interval)
+        if stats is None:
+            # Workers only exit when stopped
+            if not all(worker.is_alive() for worker in workers):
+                raise RuntimeError('A worker exited unexpectedly')
+            continue
+        _, this_batch_size, this_CtC, this_BtX = stats
+        n_received += 1
+        if this_batch_size == 0:
+            continue
+        batch_size += this_batch_size
+        CtC += this_CtC
+        BtX += this_BtX
+    estimator._add_time('code', t_code)
+
+    t_stats = time.perf_counter()
+    estimator.n_iter_ += batch_size
+    w = _batch_weight(estimator.n_iter_, batch_size,
+                      estimator.learning_rate, 0)
+    if estimator.optimizer == 'variational':
+        estimator.C_ *= 1 - w
+        estimator.C_ += w * CtC / batch_size
+        estimator.B_ *= 1 - w
+        estimator.B_ += w * BtX / batch_size
+    else:
+        estimator.C_ = CtC / batch_size
+        estimator.B_ = BtX / batch_size
+    estimator.gradient_[:, subset] = estimator.B_[:, subset]
+    estimator._add_time('stats', t_stats)
+    estimator._update_dict(subset, w)
+    estimator.time_ += time.perf_counter() - t0
+    estimator._record_batch_times(batch_size)
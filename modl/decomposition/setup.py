@@ -1,17 +1,30 @@
+import sys
 from distutils.extension import Extension
 
 import numpy
 
 
 def configuration(parent_package='', top_path=None):
-    from numpy.distutils.misc_util import Configuration
+    from numpy.distutils.misc_util import Configuration, get_info
 
     config = Configuration('decomposition', parent_package, top_path)
 
+    # npy_half conversions, for reduced precision storage
+    npymath_info = get_info('npymath')
+
+    if sys.platform == 'win32':
+        openmp_args = ['/openmp']
+    else:
+        openmp_args = ['-fopenmp']
+
     extensions = [
         Extension('modl.decomposition.dict_fact_fast',
                   sources=['modl/decomposition/dict_fact_fast.pyx'],
                   include_dirs=[numpy.get_include()],
+                  libraries=npymath_info['libraries'],
+                  library_dirs=npymath_info['library_dirs'],
+                  extra_compile_args=openmp_args,
+                  extra_link_args=openmp_args,
                   ),
         Extension('modl.decomposition.recsys_fast',
                   sources=['modl/decomposition/recsys_fast.pyx'],
@@ -1,10 +1,23 @@
 # Author: Arthur Mensch
 
+import json
+import multiprocessing
+import os
+import signal
+import sys
 import numpy as np
 import pytest
-from modl.decomposition.dict_fact import DictFact
+import scipy.linalg
+import scipy.sparse as sp
+from modl.decomposition.controller import ReductionController
+from modl.decomposition.dict_fact import DictFact, Coder
+from modl.decomposition.dict_fact_fast import _update_dict_variational, \
+    _enet_regression_single_gram, _enet_regression_batched, \
+    _enet_regression_multi_gram, _enet_regression_multi_gram_average
+from modl.decomposition.parallel import Transport
+from modl.utils.math.enet import enet_norm, enet_projection, enet_scale
 from numpy import linalg
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 from sklearn.linear_model import cd_fast
 from sklearn.utils import check_random_state
 
@@ -200,3 +213,822 @@ def enet_regression_single_gram_(G, Dx, X, code, code_l1_ratio, code_alpha,
                 random_state,
                 False, code_pos)
     return code
+
+
+@pytest.mark.parametrize("subset_order", ['sorted', 'block'])
+def test_dict_mf_subset_order(subset_order):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-4,
+                       n_epochs=2,
+                       comp_l1_ratio=0,
+                       random_state=rng_global, reduction=2,
+                       subset_order=subset_order)
+    dict_mf.fit(X)
+    P = dict_mf.transform(X)
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert (rel_error < 0.02)
+
+
+def test_dict_mf_sorted_subset():
+    # Sorting masks should not change the factorization
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    components = []
+    for subset_order in ['random', 'sorted']:
+        dict_mf = DictFact(n_components=4,
+                           code_alpha=1e-4,
+                           n_epochs=2,
+                           comp_l1_ratio=0,
+                           random_state=0, reduction=2,
+                           subset_order=subset_order)
+        dict_mf.fit(X)
+        components.append(dict_mf.components_)
+    assert_array_almost_equal(components[0], components[1])
+
+
+def update_dict_variational_(components, gradient, C, comp_norm,
+                             subset, order, l1_ratio, positive):
+    ger, = scipy.linalg.get_blas_funcs(('ger',), (C, components))
+    len_subset = subset.shape[0]
+    components_subset = components[:, subset]
+    atom_temp = np.zeros(len_subset, dtype=components.dtype)
+    gradient_subset = gradient[:, subset]
+    gradient_subset -= C.dot(components_subset)
+    for k in order:
+        subset_norm = enet_norm(components_subset[k], l1_ratio)
+        comp_norm[k] += subset_norm
+        gradient_subset = ger(1.0, C[k], components_subset[k],
+                              a=gradient_subset, overwrite_a=True)
+        if C[k, k] > 1e-20:
+            components_subset[k] = gradient_subset[k] / C[k, k]
+        if positive:
+            components_subset[components_subset < 0] = 0
+        enet_projection(components_subset[k], atom_temp, comp_norm[k],
+                        l1_ratio)
+        components_subset[k] = atom_temp
+        subset_norm = enet_norm(components_subset[k], l1_ratio)
+        comp_norm[k] -= subset_norm
+        gradient_subset = ger(-1.0, C[k], components_subset[k],
+                              a=gradient_subset, overwrite_a=True)
+    components[:, subset] = components_subset
+    return components
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("l1_ratio", [0, 0.5, 1])
+@pytest.mark.parametrize("positive", [False, True])
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_update_dict_variational(dtype, l1_ratio, positive, n_threads):
+    rng = check_random_state(0)
+    n_components, n_features, n_samples = 5, 30, 20
+    code = rng.randn(n_samples, n_components)
+    X = rng.randn(n_samples, n_features)
+    components = rng.randn(n_components, n_features)
+    if positive:
+        components = np.abs(components)
+    for k in range(n_components):
+        enet_scale(components[k], l1_ratio=l1_ratio, radius=1)
+    components = components.astype(dtype)
+    C = code.T.dot(code).astype(dtype)
+    B = code.T.dot(X).astype(dtype)
+    gradient = np.asfortranarray(B)
+    subset = np.sort(rng.permutation(n_features)[:10])
+    order = rng.permutation(n_components)
+    comp_norm = np.zeros(n_components, dtype=dtype)
+
+    components_ref = update_dict_variational_(
+        components.copy(), gradient.copy(order='F'), C, comp_norm.copy(),
+        subset, order, l1_ratio, positive)
+    _update_dict_variational(components, gradient, C, comp_norm,
+                             subset, order, l1_ratio, positive, n_threads)
+    decimal = 4 if dtype == np.float32 else 7
+    assert_array_almost_equal(components, components_ref, decimal=decimal)
+
+
+@pytest.mark.parametrize("optimizer", ['variational', 'sgd'])
+def test_dict_mf_comp_projection(optimizer):
+    X, Q = generate_synthetic(n_samples=200)
+    components = []
+    for comp_projection in ['quickselect', 'condat']:
+        dict_mf = DictFact(n_components=4, code_alpha=1e-2, comp_l1_ratio=0.5,
+                           optimizer=optimizer, random_state=0, reduction=2,
+                           comp_projection=comp_projection)
+        dict_mf.fit(X)
+        components.append(dict_mf.components_)
+    assert_array_almost_equal(components[0], components[1])
+    dict_mf.set_params(comp_projection='bisection')
+    with pytest.raises(ValueError):
+        dict_mf.fit(X)
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("optimizer", ['variational', 'sgd'])
+def test_dict_mf_sparse_components(solver, optimizer):
+    X, Q = generate_synthetic(n_samples=200)
+    results = []
+    for sparse_comp_threshold in [0, 1]:
+        dict_mf = DictFact(n_components=4, code_alpha=1, comp_l1_ratio=1,
+                           G_agg=solver_dict[solver]['G_agg'],
+                           Dx_agg=solver_dict[solver]['Dx_agg'],
+                           optimizer=optimizer,
+                           random_state=0, reduction=2,
+                           sparse_comp_threshold=sparse_comp_threshold)
+        dict_mf.fit(X)
+        results.append((dict_mf.components_, dict_mf.transform(X)))
+    assert sp.issparse(dict_mf.components_sparse_)
+    assert_array_almost_equal(dict_mf.components_sparse_.toarray(),
+                              dict_mf.components_)
+    assert_array_equal(dict_mf.comp_nnz_,
+                       np.count_nonzero(dict_mf.components_, axis=0))
+    assert_array_almost_equal(results[0][0], results[1][0])
+    assert_array_almost_equal(results[0][1], results[1][1])
+
+
+def test_coder_sparse_components():
+    X, Q = generate_synthetic(n_samples=100)
+    Q[np.abs(Q) < np.median(np.abs(Q))] = 0
+    code = Coder(Q, code_alpha=1e-1).fit().transform(X)
+    coder = Coder(Q, code_alpha=1e-1, sparse_comp_threshold=0.6).fit()
+    assert_array_almost_equal(code, coder.transform(X))
+    assert sp.issparse(coder.components_sparse_)
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+def test_dict_mf_n_threads(solver, code_l1_ratio):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    codes = []
+    for n_threads in [1, 2]:
+        dict_mf = DictFact(n_components=4,
+                           code_alpha=1e-2,
+                           code_l1_ratio=code_l1_ratio,
+                           n_epochs=1,
+                           G_agg=solver_dict[solver]['G_agg'],
+                           Dx_agg=solver_dict[solver]['Dx_agg'],
+                           random_state=0, reduction=2,
+                           n_threads=n_threads)
+        dict_mf.prepare(X=X)
+        dict_mf.partial_fit(X[:100], sample_indices=np.arange(100))
+        codes.append(dict_mf.transform(X))
+    assert_array_almost_equal(codes[0], codes[1])
+
+
+@pytest.mark.parametrize("code_pos", [False, True])
+def test_enet_regression_batched(code_pos):
+    rng = check_random_state(0)
+    n_samples, n_components, n_features = 30, 10, 40
+    components = rng.randn(n_components, n_features)
+    X = rng.randn(n_samples, n_features)
+    G = components.dot(components.T)
+    Dx = X.dot(components.T)
+    sample_indices = np.arange(n_samples)
+    code_cd = np.zeros((n_samples, n_components))
+    code_batched = np.zeros((n_samples, n_components))
+    _enet_regression_single_gram(G, Dx.copy(), X, code_cd, sample_indices,
+                                 0.9, 1., code_pos, 1e-8, 1000)
+    _enet_regression_batched(G, Dx.copy(), X, code_batched, sample_indices,
+                             0.9, 1., code_pos, 1e-8, 1000)
+    assert_array_almost_equal(code_cd, code_batched, decimal=4)
+
+
+def test_dict_mf_batched_solver():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-4,
+                       n_epochs=2,
+                       comp_l1_ratio=0,
+                       random_state=rng_global, reduction=2,
+                       code_solver='batched')
+    dict_mf.fit(X)
+    P = dict_mf.transform(X)
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert (rel_error < 0.02)
+
+
+@pytest.mark.parametrize("code_pos", [False, True])
+@pytest.mark.parametrize("code_alpha", [0.1, 10])
+def test_enet_regression_screening(code_pos, code_alpha):
+    # Gap safe screening and the duality gap checked after every pass
+    # should not change the solution
+    rng = check_random_state(0)
+    n_samples, n_components, n_features = 10, 100, 200
+    components = rng.randn(n_components, n_features)
+    X = rng.randn(n_samples, n_features)
+    G = components.dot(components.T)
+    Dx = X.dot(components.T)
+    code = np.zeros((n_samples, n_components))
+    code_ref = np.zeros((n_samples, n_components))
+    _enet_regression_single_gram(G, Dx, X, code, np.arange(n_samples),
+                                 0.9, code_alpha, code_pos, 1e-12, 10000,
+                                 screen=True)
+    random_state = check_random_state(0)
+    for i in range(n_samples):
+        cd_fast.enet_coordinate_descent_gram(
+            code_ref[i], code_alpha * 0.9, code_alpha * 0.1,
+            G, Dx[i], X[i], 10000, 1e-12, random_state, False, code_pos)
+    assert_array_almost_equal(code, code_ref)
+
+
+def test_enet_regression_subsampled():
+    # Subsampled G and Dx do not match the norm of X: the solver should
+    # not rely on the duality gap to stop or screen coordinates
+    rng = check_random_state(0)
+    n_samples, n_components, n_features, reduction = 5, 50, 400, 8
+    components = rng.randn(n_components, n_features)
+    components /= np.sqrt(np.sum(components ** 2, axis=1))[:, np.newaxis]
+    X = rng.randn(n_samples, n_components).dot(components)
+    subset = rng.permutation(n_features)[:n_features // reduction]
+    # Samples with most of their energy on the subset
+    X[:, np.setdiff1d(np.arange(n_features), subset)] *= 0.1
+    components_subset = components[:, subset]
+    G = components_subset.dot(components_subset.T) * reduction
+    Dx = X[:, subset].dot(components_subset.T) * reduction
+    code = np.zeros((n_samples, n_components))
+    code_ref = np.zeros((n_samples, n_components))
+    _enet_regression_single_gram(G, Dx, X, code, np.arange(n_samples),
+                                 1, 0.3, False, 1e-10, 10000)
+    random_state = check_random_state(0)
+    for i in range(n_samples):
+        cd_fast.enet_coordinate_descent_gram(
+            code_ref[i], 0.3, 0, G, Dx[i], X[i], 10000, 1e-14,
+            random_state, False, False)
+    assert_array_almost_equal(code, code_ref)
+
+
+def test_transform_warm_start():
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-1, n_epochs=1,
+                       random_state=0, tol=1e-8, max_iter=1000)
+    dict_mf.fit(X)
+    code = dict_mf.transform(X)
+    code_warm = dict_mf.transform(X, code_init=code)
+    assert_array_almost_equal(code, code_warm, decimal=4)
+    code_warm = dict_mf.transform(X[10:20], sample_ids=np.arange(10, 20))
+    assert_array_almost_equal(code[10:20], code_warm, decimal=4)
+    with pytest.raises(ValueError):
+        dict_mf.transform(X, code_init=code[:10])
+    with pytest.raises(ValueError):
+        dict_mf.transform(X, sample_ids=np.arange(10))
+
+
+def test_enet_regression_warm_start_n_iter():
+    rng = check_random_state(0)
+    n_samples, n_components, n_features = 10, 20, 40
+    components = rng.randn(n_components, n_features)
+    X = rng.randn(n_samples, n_features)
+    G = components.dot(components.T)
+    Dx = X.dot(components.T)
+    sample_indices = np.arange(n_samples)
+    code = np.ones((n_samples, n_components))
+    n_iter = np.zeros(n_samples, dtype='i')
+    _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                 1, 1, False, 1e-6, 1000, 1, n_iter)
+    assert np.all(n_iter > 1)
+    _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                 1, 1, False, 1e-6, 1000, 1, n_iter)
+    assert_array_equal(n_iter, 1)
+
+
+def test_coder_cache():
+    X, Q = generate_synthetic(n_features=20, n_samples=10)
+    coder = Coder(Q, code_alpha=1e-1, tol=1e-8, max_iter=1000,
+                  cache_size=5)
+    code = coder.transform(X)
+    assert len(coder.code_cache_) == 0
+    code_cached = coder.transform(X, sample_ids=['a%i' % i
+                                                 for i in range(10)])
+    assert_array_almost_equal(code, code_cached)
+    assert list(coder.code_cache_.keys()) == ['a%i' % i
+                                              for i in range(5, 10)]
+    assert_array_equal(coder.code_cache_['a7'], code_cached[7])
+    # Hit moves 'a5' to the most recently used position
+    coder.transform(X[5:6], sample_ids=['a5'])
+    coder.transform(X[:1], sample_ids=['b0'])
+    assert list(coder.code_cache_.keys()) == ['a7', 'a8', 'a9', 'a5', 'b0']
+    assert_array_almost_equal(coder.score(X, sample_ids=range(10)),
+                              coder.score(X))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_coder_ridge_factor(dtype):
+    X, Q = generate_synthetic(n_features=20, n_samples=10)
+    X, Q = X.astype(dtype), Q.astype(dtype)
+    coder = Coder(Q, code_alpha=1, code_l1_ratio=0).fit()
+    factor = coder.ridge_factor_
+    code = coder.transform(X)
+    assert code.dtype == dtype
+    G = Q.dot(Q.T)
+    code_ref = np.empty_like(code)
+    _enet_regression_single_gram(G, X.dot(Q.T), X, code_ref, np.arange(10),
+                                 0, 1, False, 1e-2, 100)
+    assert_array_almost_equal(code, code_ref, decimal=4)
+    coder.transform(X)
+    assert coder.ridge_factor_ is factor
+    # Factorization is recomputed when code_alpha or components_ change
+    coder.code_alpha = 2
+    code = coder.transform(X)
+    assert coder.ridge_factor_ is not factor
+    assert_array_almost_equal(code, Coder(Q, code_alpha=2,
+                                          code_l1_ratio=0).transform(X),
+                              decimal=4)
+    coder.components_ = 2 * Q
+    code = coder.transform(X)
+    assert_array_almost_equal(code, Coder(2 * Q, code_alpha=2,
+                                          code_l1_ratio=0).transform(X),
+                              decimal=4)
+
+
+def test_transform_memory_budget(tmpdir):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-1, n_epochs=1,
+                       random_state=0)
+    dict_mf.fit(X)
+    code = dict_mf.transform(X)
+    score = dict_mf.score(X)
+
+    filename = str(tmpdir.join('X.npy'))
+    np.save(filename, X)
+    X_mmap = np.load(filename, mmap_mode='r')
+    out = np.lib.format.open_memmap(str(tmpdir.join('code.npy')),
+                                    mode='w+', dtype=code.dtype,
+                                    shape=code.shape)
+    # 2 kB: chunks of 5 rows
+    code_chunked = dict_mf.transform(X_mmap, out=out, memory_budget=2e-3)
+    assert code_chunked is out
+    assert_array_almost_equal(code, code_chunked)
+    assert_array_almost_equal(score, dict_mf.score(X_mmap,
+                                                   memory_budget=2e-3))
+    with pytest.raises(ValueError):
+        dict_mf.transform(X, out=out[:10])
+
+
+def test_dict_mf_epoch_index_map():
+    # Statistics stay indexed by sample across epochs
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    X_copy = X.copy()
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=3,
+                       G_agg='full', Dx_agg='full', random_state=0,
+                       learning_rate=0.9)
+    dict_mf.fit(X)
+    assert_array_equal(X, X_copy)
+    assert_array_equal(dict_mf.labels_, np.arange(100))
+    code = dict_mf.transform(X)
+    error = np.sum((dict_mf.code_ - code) ** 2) / np.sum(code ** 2)
+    assert error < 0.1
+
+
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+@pytest.mark.parametrize("G_average_storage", ['full', 'packed', 'half'])
+def test_multi_gram_average(code_l1_ratio, G_average_storage):
+    rng = check_random_state(0)
+    batch_size, n_components, n_features = 10, 6, 20
+    X = rng.randn(batch_size, n_features)
+    components = rng.randn(batch_size, n_components, n_features)
+    G_average = np.einsum('ikj,ilj->ikl', components, components)
+    Dx = np.ascontiguousarray(np.einsum('ij,ikj->ik', X, components))
+    G = G_average[0, ::-1, ::-1].copy()
+    w_sample = rng.uniform(size=batch_size)
+    triu = np.triu_indices(n_components)
+    if G_average_storage == 'full':
+        G_stored = G_average.reshape((batch_size, -1)).copy()
+    else:
+        G_stored = np.ascontiguousarray(G_average[:, triu[0], triu[1]])
+    if G_average_storage == 'half':
+        G_stored = G_stored.astype(np.float16)
+
+    indices = np.arange(batch_size)
+    G_average *= 1 - w_sample[:, np.newaxis, np.newaxis]
+    G_average += w_sample[:, np.newaxis, np.newaxis] * G
+    if G_average_storage == 'full':
+        G_expected = G_average.reshape((batch_size, -1)).copy()
+    else:
+        G_expected = G_average[:, triu[0], triu[1]]
+    code = np.zeros((batch_size, n_components))
+    _enet_regression_multi_gram(G_average, Dx, X, code, indices,
+                                code_l1_ratio, 0.1, False, 1e-8, 1000)
+
+    code_fused = np.zeros((batch_size, n_components))
+    packed = G_average_storage != 'full'
+    if G_average_storage == 'half':
+        buffer = G_stored.view(np.uint16)
+    else:
+        buffer = G_stored
+    _enet_regression_multi_gram_average(buffer, packed, G, w_sample, Dx, X,
+                                        code_fused, indices, code_l1_ratio,
+                                        0.1, False, 1e-8, 1000)
+    decimal = 1 if G_average_storage == 'half' else 6
+    assert_array_almost_equal(G_stored, G_expected, decimal=decimal)
+    assert_array_almost_equal(code, code_fused, decimal=decimal)
+
+
+@pytest.mark.parametrize("G_average_storage", ['packed', 'half'])
+def test_dict_mf_G_average_storage(G_average_storage):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    components = []
+    for storage in ['full', G_average_storage]:
+        dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=2,
+                           G_agg='average', Dx_agg='average',
+                           G_average_storage=storage, random_state=0,
+                           reduction=2)
+        dict_mf.fit(X)
+        components.append(dict_mf.components_)
+    if G_average_storage == 'half':
+        assert dict_mf.G_average_.dtype == np.float16
+        assert_array_almost_equal(components[0], components[1], decimal=1)
+    else:
+        assert_array_almost_equal(components[0], components[1])
+    assert dict_mf.G_average_.shape == (100, 10)
+
+
+@pytest.mark.parametrize("solver", solvers)
+def test_dict_mf_sparse_input(solver):
+    X, Q = generate_sparse_synthetic(n_samples=100, square_size=6)
+    rng = check_random_state(0)
+    X[rng.uniform(size=X.shape) < 0.7] = 0
+    results = []
+    for this_X in [X, sp.csr_matrix(X)]:
+        dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=2,
+                           G_agg=solver_dict[solver]['G_agg'],
+                           Dx_agg=solver_dict[solver]['Dx_agg'],
+                           random_state=0, reduction=2)
+        dict_mf.fit(this_X)
+        results.append((dict_mf.components_, dict_mf.transform(this_X),
+                        dict_mf.score(this_X)))
+    assert_array_almost_equal(results[0][0], results[1][0])
+    assert_array_almost_equal(results[0][1], results[1][1])
+    assert_array_almost_equal(results[0][2], results[1][2])
+
+
+@pytest.mark.parametrize("solver", solvers)
+def test_dict_mf_streaming(solver):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    components = []
+    for sample_capacity in [None, 100]:
+        dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=2,
+                           G_agg=solver_dict[solver]['G_agg'],
+                           Dx_agg=solver_dict[solver]['Dx_agg'],
+                           sample_capacity=sample_capacity,
+                           random_state=0, reduction=2)
+        dict_mf.fit(X)
+        components.append(dict_mf.components_)
+    assert_array_almost_equal(components[0], components[1])
+
+
+def test_dict_mf_streaming_eviction():
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', sample_capacity=30, batch_size=10,
+                       random_state=0, reduction=2)
+    dict_mf.prepare(n_features=20)
+    assert dict_mf.code_.shape[0] == 10
+    sample_ids = ['sample_%i' % i for i in range(100)]
+    dict_mf.partial_fit(X[:20], sample_indices=sample_ids[:20])
+    assert dict_mf.code_.shape[0] == 20
+    assert dict_mf.G_average_.shape[0] == 20
+    dict_mf.partial_fit(X, sample_indices=sample_ids)
+    assert dict_mf.code_.shape[0] == 30
+    assert dict_mf.G_average_.shape[0] == 30
+    assert list(dict_mf.sample_slots_) == sample_ids[70:]
+    # Seen again: moved to the end, not reset
+    slot = dict_mf.sample_slots_['sample_70']
+    dict_mf.partial_fit(X[70:71], sample_indices=sample_ids[70:71])
+    assert list(dict_mf.sample_slots_)[-1] == 'sample_70'
+    assert dict_mf.sample_n_iter_[slot] == 2
+    # Evicted samples start afresh
+    dict_mf.partial_fit(X[:1], sample_indices=sample_ids[:1])
+    assert 'sample_71' not in dict_mf.sample_slots_
+    assert dict_mf.sample_n_iter_[dict_mf.sample_slots_['sample_0']] == 1
+    code = dict_mf.transform(X[:2], sample_ids=sample_ids[:2])
+    assert code.shape == (2, 4)
+    with pytest.raises(ValueError):
+        dict_mf.partial_fit(X)
+
+
+def test_dict_mf_streaming_batch_slots():
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', sample_capacity=10, batch_size=10,
+                       random_state=0, reduction=2)
+    dict_mf.prepare(n_features=20)
+    sample_ids = ['sample_%i' % i for i in range(20)]
+    dict_mf.partial_fit(X[:10], sample_indices=sample_ids[:10])
+    # Half seen, half new: new samples never take rows of the batch
+    slots = dict_mf._get_slots(sample_ids[5:15])
+    assert len(np.unique(slots)) == 10
+    slots = dict_mf._get_slots(sample_ids[5:15] + sample_ids[5:6])
+    assert slots[-1] == slots[0]
+    with pytest.raises(ValueError):
+        dict_mf._get_slots(sample_ids[:11])
+    # The controller may choose batches of 2 * batch_size
+    dict_mf = DictFact(n_components=4, sample_capacity=15, batch_size=10,
+                       adaptive_batch_size=True)
+    with pytest.raises(ValueError):
+        dict_mf.prepare(n_features=20)
+
+
+@pytest.mark.parametrize("mmap_mode", ['c', 'r+', None])
+def test_dict_mf_checkpoint(tmpdir, mmap_mode):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    path = str(tmpdir.join('checkpoint'))
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', random_state=0, reduction=2,
+                       n_iter_no_change=10)
+    dict_mf.prepare(X=X)
+    dict_mf.partial_fit(X, sample_indices=np.arange(100))
+    dict_mf.save_checkpoint(path)
+    # Incremental checkpoint
+    dict_mf.partial_fit(X[:30], sample_indices=np.arange(30))
+    dict_mf.save_checkpoint(path)
+
+    restored = DictFact.load_checkpoint(path, mmap_mode=mmap_mode)
+    for name in ['components_', 'code_', 'Dx_average_', 'G_average_',
+                 'B_', 'C_', 'sample_n_iter_']:
+        assert_array_equal(getattr(dict_mf, name), getattr(restored, name))
+    assert restored.n_iter_ == dict_mf.n_iter_
+
+    for estimator in [dict_mf, restored]:
+        estimator.partial_fit(X[50:], sample_indices=np.arange(50, 100))
+    assert_array_equal(dict_mf.components_, restored.components_)
+    assert_array_equal(dict_mf.code_, restored.code_)
+    assert restored.surrogate_ == dict_mf.surrogate_
+    restored.save_checkpoint(path)
+    restored = DictFact.load_checkpoint(path)
+    assert_array_equal(dict_mf.components_, restored.components_)
+    assert_array_equal(dict_mf.G_average_, restored.G_average_)
+
+
+def test_dict_mf_checkpoint_interrupted(tmpdir, monkeypatch):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    path = str(tmpdir.join('checkpoint'))
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', random_state=0, reduction=2)
+    dict_mf.prepare(X=X)
+    for start in [0, 50]:
+        dict_mf.partial_fit(X[start:start + 50],
+                            sample_indices=np.arange(start, start + 50))
+        dict_mf.save_checkpoint(path)
+    components = dict_mf.components_.copy()
+    G_average = dict_mf.G_average_.copy()
+    dict_mf.partial_fit(X[:50], sample_indices=np.arange(50))
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    # Interrupted before the manifest is replaced, after writing the
+    # files, incrementally for per-sample statistics
+    monkeypatch.setattr(json, 'dump', crash)
+    with pytest.raises(KeyboardInterrupt):
+        dict_mf.save_checkpoint(path)
+    monkeypatch.undo()
+    restored = DictFact.load_checkpoint(path)
+    assert_array_equal(restored.components_, components)
+    assert_array_equal(restored.G_average_, G_average)
+    dict_mf.save_checkpoint(path)
+    restored = DictFact.load_checkpoint(path)
+    assert_array_equal(restored.components_, dict_mf.components_)
+    assert_array_equal(restored.G_average_, dict_mf.G_average_)
+
+
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_dict_mf_profile(tmpdir, n_threads):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    trace_file = str(tmpdir.join('trace.jsonl'))
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', random_state=0, reduction=2,
+                       batch_size=10, n_threads=n_threads,
+                       trace_file=trace_file)
+    dict_mf.fit(X)
+    dict_mf._exit()
+    n_batches = 10
+    for phase in ['subset', 'Dx_G', 'code', 'stats', 'dict']:
+        profile = dict_mf.profile_[phase]
+        assert profile['count'] == n_batches
+        assert profile['total'] > 0
+        assert profile['histogram'].sum() == n_batches
+    assert dict_mf.profile_['callback']['count'] == 0
+    with open(trace_file, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == n_batches
+    assert records[-1]['n_iter'] == 100
+    assert_array_almost_equal(sum(record['code'] for record in records),
+                              dict_mf.profile_['code']['total'])
+
+
+@pytest.mark.parametrize("optimizer", ['variational', 'sgd'])
+@pytest.mark.parametrize("reduction", [1, 2])
+def test_dict_mf_early_stopping(optimizer, reduction):
+    X, Q = generate_synthetic(n_features=20, n_samples=400)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, random_state=0,
+                       optimizer=optimizer, reduction=reduction, n_epochs=50,
+                       n_iter_no_change=20, surrogate_tol=1e-2)
+    dict_mf.fit(X)
+    assert dict_mf.converged_
+    assert dict_mf.n_iter_ < 50 * 400
+    assert len(dict_mf.surrogate_history_) == 21
+    # Per-sample objective with the codes of the last visit of samples
+    code = dict_mf.code_
+    objective = np.mean(np.sum((X - code.dot(dict_mf.components_)) ** 2,
+                               axis=1) / 2
+                        + 1e-2 * np.sum(np.abs(code), axis=1))
+    assert dict_mf.surrogate_ > objective
+    assert dict_mf.surrogate_ < 3 * objective
+    # Not tracked without early stopping
+    dict_mf.set_params(n_iter_no_change=None)
+    dict_mf.fit(X)
+    assert dict_mf.surrogate_ == 0
+
+
+@pytest.mark.parametrize("solver", ['masked', 'full'])
+def test_dict_mf_background_callback(solver):
+    X, Q = generate_synthetic(n_samples=200)
+    records = []
+
+    def callback(est):
+        records.append((est.n_iter_, est.components_.copy(), est.score(X),
+                        est))
+
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, random_state=0,
+                       G_agg=solver_dict[solver]['G_agg'],
+                       Dx_agg=solver_dict[solver]['Dx_agg'],
+                       batch_size=10, n_epochs=2, verbose=5,
+                       callback=callback, background_callback=True)
+    dict_mf.fit(X)
+    assert len(records) == 5
+    n_iters = [n_iter for n_iter, _, _, _ in records]
+    assert n_iters == sorted(n_iters)
+    for n_iter, components, score, snapshot in records:
+        assert snapshot is not dict_mf
+        assert snapshot.components_ is not dict_mf.components_
+        assert_array_equal(snapshot.components_, components)
+        assert snapshot.snapshot_time_ > 0
+    # Scores are computed with the dictionary of the snapshot
+    assert records[-1][2] >= dict_mf.score(X)
+    assert not hasattr(dict_mf, 'snapshot_time_')
+
+    def failing_callback(est):
+        raise RuntimeError('callback failure')
+
+    dict_mf.set_params(callback=failing_callback)
+    with pytest.raises(RuntimeError):
+        dict_mf.fit(X)
+
+
+def test_reduction_controller():
+    controller = ReductionController(8, 10, adapt_batch_size=True, window=2,
+                                     n_exploit=3)
+    assert len(controller.candidates_) == 12
+    assert controller.candidates_[0] == (8, 10)
+    # Rate is largest for reduction 2 and batch size 20
+    for i in range(2 * len(controller.candidates_)):
+        decrease = 1. / (1 + abs(controller.reduction - 2)) \
+                   * controller.batch_size
+        controller.record(i, decrease, 0.5, 0.5, 0)
+    assert len(controller.choices_) == 1
+    assert controller.reduction == 2
+    assert controller.batch_size == 20
+    for i in range(2 * 3):
+        controller.record(i, 0, 0.5, 0.5, 0)
+    # New exploration cycle
+    assert controller.candidates_[0] == (controller.reduction,
+                                         controller.batch_size)
+    assert [record['phase'] for record in controller.history_] \
+           == ['explore'] * 12 + ['exploit'] * 3
+
+
+@pytest.mark.parametrize("adaptive_batch_size", [False, True])
+def test_dict_mf_adaptive_reduction(tmpdir, adaptive_batch_size):
+    X, Q = generate_synthetic(n_features=20, n_samples=100)
+    trace_file = str(tmpdir.join('trace.jsonl'))
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, random_state=0,
+                       reduction=4, n_epochs=8, trace_file=trace_file,
+                       adaptive_reduction=True,
+                       adaptive_batch_size=adaptive_batch_size)
+    dict_mf.fit(X)
+    assert dict_mf.n_iter_ == 800
+    controller = dict_mf.reduction_controller_
+    assert len(controller.choices_) >= 1
+    for record in controller.history_:
+        assert (record['reduction'],
+                record['batch_size']) in controller.candidates_
+        assert record['decrease'] >= -1e-8
+    with open(trace_file, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert {record['reduction'] for record in records} \
+           <= {reduction for reduction, _ in controller.candidates_}
+    assert sum(record['batch_size'] for record in records) == 800
+
+    dict_mf.set_params(optimizer='sgd')
+    with pytest.raises(ValueError):
+        dict_mf.fit(X)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='requires multiprocessing.shared_memory')
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("sparse", [False, True])
+def test_dict_mf_n_jobs(solver, sparse):
+    X, Q = generate_synthetic(n_samples=400)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-4, n_epochs=5,
+                       G_agg=solver_dict[solver]['G_agg'],
+                       Dx_agg=solver_dict[solver]['Dx_agg'],
+                       random_state=0, batch_size=5, n_jobs=2)
+    dict_mf.fit(sp.csr_matrix(X) if sparse else X)
+    assert dict_mf.code_.shape == (400, 4)
+    assert dict_mf.n_iter_ == 400 * 5
+    assert not isinstance(dict_mf.components_.base, memoryview)
+    P = dict_mf.transform(X)
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert rel_error < 0.02
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='requires multiprocessing.shared_memory')
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_dict_mf_n_jobs_sample_stats(tmpdir, asynchronous):
+    # Shards of 100 and 101 samples
+    X, Q = generate_synthetic(n_samples=201)
+    path = str(tmpdir.join('checkpoint'))
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, G_agg='average',
+                       Dx_agg='average', random_state=0, reduction=2,
+                       batch_size=10, n_jobs=2, n_epochs=2,
+                       asynchronous=asynchronous)
+    dict_mf.fit(X)
+    # Per-sample statistics are gathered from workers
+    for name in ['code_', 'Dx_average_', 'G_average_', 'sample_n_iter_']:
+        assert getattr(dict_mf, name).shape[0] == 201
+    # Samples of the smaller shard are not visited more often
+    assert_array_equal(dict_mf.sample_n_iter_, 2)
+    if not asynchronous:
+        assert dict_mf.n_iter_ == 2 * 201
+    assert np.all(np.any(dict_mf.Dx_average_ != 0, axis=1))
+    assert np.all(np.any(dict_mf.G_average_.reshape(201, -1) != 0, axis=1))
+
+    dict_mf.partial_fit(X[:10], sample_indices=np.arange(190, 200))
+    assert_array_equal(dict_mf.sample_n_iter_[190:200], 3)
+    dict_mf.save_checkpoint(path)
+    restored = DictFact.load_checkpoint(path)
+    for name in ['components_', 'code_', 'Dx_average_', 'G_average_',
+                 'sample_n_iter_']:
+        assert_array_equal(getattr(dict_mf, name), getattr(restored, name))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='requires multiprocessing.shared_memory')
+def test_dict_mf_n_jobs_dead_worker():
+    X, Q = generate_synthetic(n_samples=400)
+
+    def kill_worker(est):
+        os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, random_state=0,
+                       batch_size=5, n_jobs=2, verbose=2,
+                       callback=kill_worker)
+    with pytest.raises(RuntimeError):
+        dict_mf.fit(X)
+
+
+def test_transport_abstract():
+    with pytest.raises(TypeError):
+        Transport()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='requires multiprocessing.shared_memory')
+@pytest.mark.parametrize("solver", solvers)
+def test_dict_mf_asynchronous(solver):
+    X, Q = generate_synthetic(n_samples=400)
+    n_iters = []
+    dict_mf = DictFact(n_components=4, code_alpha=1e-4, n_epochs=5,
+                       G_agg=solver_dict[solver]['G_agg'],
+                       Dx_agg=solver_dict[solver]['Dx_agg'],
+                       random_state=0, batch_size=5, n_jobs=2,
+                       asynchronous=True, verbose=5,
+                       callback=lambda est: n_iters.append(est.n_iter_))
+    dict_mf.fit(X)
+    assert dict_mf.code_.shape == (400, 4)
+    # Concurrent increments of the sample counter may be lost
+    assert 0 < dict_mf.n_iter_ <= 400 * 5
+    assert n_iters == sorted(n_iters)
+    for k in range(4):
+        assert enet_norm(dict_mf.components_[k], 0) <= 1 + 1e-6
+        assert_array_almost_equal(dict_mf.comp_norm_[k],
+                                  1 - enet_norm(dict_mf.components_[k], 0))
+    P = dict_mf.transform(X)
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert rel_error < 0.02
+
+    dict_mf.set_params(optimizer='sgd')
+    with pytest.raises(ValueError):
+        dict_mf.fit(X)
@@ -10,7 +10,11 @@ from cython cimport floating
 cpdef floating enet_norm(floating[:] v, floating l1_ratio) nogil
 
 cpdef void enet_projection(floating[:] v, floating[:] out, floating radius,
-                             floating l1_ratio) nogil
+                           floating l1_ratio, bint condat=*) nogil
+
+cdef void _enet_projection_parallel(floating[:] v, floating[:] out,
+                                    floating radius, floating l1_ratio,
+                                    int n_threads, bint condat) nogil
 
 cpdef void enet_scale(floating[:] X,
                               floating l1_ratio, floating radius=*) nogil
@@ -9,10 +9,23 @@
 
 J. Mairal, F. Bach, J. Ponce, G. Sapiro, 2009: Online dictionary learning
 for sparse coding (http://www.di.ens.fr/sierra/pdfs/icml09.pdf)
+
+L. Condat, 2016: Fast projection onto the simplex and the l1 ball
+(https://doi.org/10.1007/s10107-015-0946-6)
 """
 from libc.math cimport sqrt, fabs
+from libc.stdlib cimport malloc, free
 
 from cython cimport floating
+from cython.parallel cimport prange
+
+import numpy as np
+
+cdef enum:
+    # Number of bins of the histogram of entries in enet_projection_parallel
+    N_BINS = 1024
+    # Below this size, enet_projection_parallel falls back to enet_projection
+    PARALLEL_MIN_SIZE = 16384
 
 cdef inline floating positive(floating a) nogil:
     if a > 0:
@@ -28,33 +41,169 @@ cdef inline floating sign(floating a) nogil:
         return -1.
 
 
-cdef inline void swap(floating[:] b, unsigned int i, unsigned int j,
-                      floating * buf) nogil:
-    buf[0] = b[i]
+cdef inline void swap(floating* b, unsigned int i, unsigned int j) nogil:
+    cdef floating buf = b[i]
     b[i] = b[j]
-    b[j] = buf[0]
-    return
+    b[j] = buf
+
+
+cdef inline floating _phi(floating a, floating gamma) nogil:
+    """Contribution of an entry of magnitude a to the scaled norm"""
+    return a * (1 + gamma / 2 * a)
+
+
+cdef void _select(floating* a, unsigned int size, floating gamma,
+                  floating radius, floating* s, unsigned int* rho) nogil:
+    """Find the entries of a[:size] above the projection threshold, by
+    quickselect. On entry, s and rho hold the scaled norm and number of
+    entries known to be above the threshold, and larger than all entries of
+    a. They are updated in place. a is reordered"""
+    cdef unsigned int i
+    cdef unsigned int pivot
+    cdef unsigned int drho
+    cdef unsigned int start_U = 0
+    cdef unsigned int size_U = size
+    cdef floating ds
+    while size_U > 0:
+        pivot = start_U + size_U / 2
+        # Putting pivot at the beginning
+        swap(a, pivot, start_U)
+        pivot = start_U
+        drho = 1
+        ds = _phi(a[pivot], gamma)
+        # Ordering : [pivot, >=, <], using Lobato quicksort
+        for i in range(start_U + 1, start_U + size_U):
+            if a[i] >= a[pivot]:
+                ds += _phi(a[i], gamma)
+                swap(a, i, start_U + drho)
+                drho += 1
+        if s[0] + ds - (rho[0] + drho) * _phi(a[pivot], gamma) \
+                < radius * (1 + gamma * a[pivot]) ** 2:
+            # U <- L : [<]
+            start_U += drho
+            size_U -= drho
+            rho[0] += drho
+            s[0] += ds
+        else:
+            # U <- G \ k : [>=]
+            start_U += 1
+            size_U = drho - 1
+
+
+cdef void _condat(floating* a, unsigned int size, floating gamma,
+                  floating radius, floating* s, unsigned int* rho) nogil:
+    """Find the entries of a[:size] above the projection threshold, with
+    Condat's algorithm, extended to the elastic-net ball. Same contract as
+    _select.
+
+    The threshold computed from any set of entries is a lower bound of the
+    projection threshold, so that entries below it can be discarded.
+    Candidates are kept at the beginning of a: discarded candidates first,
+    then the current set."""
+    cdef floating s0 = s[0]
+    cdef unsigned int rho0 = rho[0]
+    cdef unsigned int n_waiting = 0
+    cdef unsigned int n_current = 0
+    cdef unsigned int i, w
+    cdef floating y, l, l_new, l_restart, s_new
+    cdef bint changed = True
+    if size == 0:
+        return
+    if rho0 > 0:
+        l = _threshold(s0, rho0, gamma, radius)
+    else:
+        # Below all entries
+        l = -1
+    # Single pass, restarting the current set from y if the threshold of
+    # y alone is higher
+    for i in range(size):
+        y = a[i]
+        if y > l:
+            s_new = s[0] + _phi(y, gamma)
+            l_new = _threshold(s_new, rho[0] + 1, gamma, radius)
+            l_restart = _threshold(s0 + _phi(y, gamma), rho0 + 1, gamma,
+                                   radius)
+            if l_new > l_restart:
+                a[n_waiting + n_current] = y
+                n_current += 1
+                s[0] = s_new
+                rho[0] += 1
+                l = l_new
+            else:
+                n_waiting += n_current
+                a[n_waiting] = y
+                n_current = 1
+                s[0] = s0 + _phi(y, gamma)
+                rho[0] = rho0 + 1
+                l = l_restart
+    # Add the discarded candidates above the threshold
+    w = 0
+    for i in range(n_waiting):
+        y = a[i]
+        if y > l:
+            s[0] += _phi(y, gamma)
+            rho[0] += 1
+            l = _threshold(s[0], rho[0], gamma, radius)
+            a[w] = y
+            w += 1
+    for i in range(n_waiting, n_waiting + n_current):
+        a[w] = a[i]
+        w += 1
+    n_current = w
+    # Remove candidates below the threshold, until none is left
+    while changed:
+        changed = False
+        w = 0
+        for i in range(n_current):
+            y = a[i]
+            if y <= l:
+                s[0] -= _phi(y, gamma)
+                rho[0] -= 1
+                l = _threshold(s[0], rho[0], gamma, radius)
+                changed = True
+            else:
+                a[w] = y
+                w += 1
+        n_current = w
+
+
+cdef inline floating _threshold(floating s, unsigned int rho, floating gamma,
+                                floating radius) nogil:
+    """Soft-thresholding level, given the scaled norm s of the rho entries
+    above it"""
+    cdef floating a, d, c
+    if gamma != 0:
+        a = gamma ** 2 * radius + gamma * rho * 0.5
+        d = 2 * radius * gamma + rho
+        c = radius - s
+        return (-d + sqrt(d ** 2 - 4 * a * c)) / (2 * a)
+    else:
+        return (s - radius) / rho
+
+
+cdef inline floating* _workspace(floating[:] out) nogil:
+    """Contiguous buffer of the size of out: out itself if it is contiguous.
+    Should be freed if different from &out[0]"""
+    if out.strides[0] == sizeof(floating):
+        return &out[0]
+    return <floating*> malloc(out.shape[0] * sizeof(floating))
 
 
 cpdef void enet_projection(floating[:] v, floating[:] out, floating radius,
-                             floating l1_ratio) nogil:
+                           floating l1_ratio, bint condat=False) nogil:
+    """Projection of v on the elastic-net ball of given radius, in out.
+
+    The threshold is found by quickselect, or by Condat's algorithm if
+    condat is True, which is faster for large vectors"""
     cdef unsigned int m = v.shape[0]
     cdef unsigned int i
     cdef unsigned int j
-    cdef unsigned int size_U
-    cdef unsigned int start_U
-    cdef floating buf = 0
     cdef floating gamma
-    cdef unsigned int pivot
     cdef unsigned int rho
-    cdef unsigned int drho
     cdef floating s
-    cdef floating ds
-    cdef floating a
-    cdef floating d
-    cdef floating c
     cdef floating l
     cdef floating norm = 0
+    cdef floating* work
     if radius == 0:
         out[:] = 0
         return
@@ -74,55 +223,176 @@ cpdef void enet_projection(floating[:] v, floating[:] out, floating radius,
         gamma = 2 / l1_ratio - 2
         radius /= l1_ratio
         # Preparing data
+        work = _workspace(out)
         for j in range(m):
-            out[j] = fabs(v[j])
-            norm += out[j] * (1 + gamma / 2 * out[j])
+            work[j] = fabs(v[j])
+            norm += _phi(work[j], gamma)
         if norm <= radius:
             out[:] = v[:]
         else:
             # s and rho computation
             s = 0
             rho = 0
-            start_U = 0
-            size_U = m
-            while size_U > 0:
-                pivot = start_U + size_U / 2
-                # Putting pivot at the beginning
-                swap(out, pivot, start_U, &buf)
-                pivot = start_U
-                drho = 1
-                ds = out[pivot] * (1 + gamma / 2 * out[pivot])
-                # Ordering : [pivot, >=, <], using Lobato quicksort
-                for i in range(start_U + 1, start_U + size_U):
-                    if out[i] >= out[pivot]:
-                        ds += out[i] * (1 + gamma / 2 * out[i])
-                        swap(out, i, start_U + drho, &buf)
-                        drho += 1
-                if s + ds - (rho + drho) * (1 + gamma / 2 * out[pivot])\
-                        * out[pivot] < radius * (1 + gamma * out[pivot]) ** 2:
-                    # U <- L : [<]
-                    start_U += drho
-                    size_U -= drho
-                    rho += drho
-                    s += ds
-                else:
-                    # U <- G \ k : [>=]
-                    start_U += 1
-                    size_U = drho - 1
+            if condat:
+                _condat(work, m, gamma, radius, &s, &rho)
+            else:
+                _select(work, m, gamma, radius, &s, &rho)
 
             # Projection
-            if gamma != 0:
-                a = gamma ** 2 * radius + gamma * rho * 0.5
-                d = 2 * radius * gamma + rho
-                c = radius - s
-                l = (-d + sqrt(d ** 2 - 4 * a * c)) / (2 * a)
-            else:
-                l = (s - radius) / rho
+            l = _threshold(s, rho, gamma, radius)
             for i in range(m):
                 out[i] = sign(v[i]) * positive(fabs(v[i]) - l) / (1 + l * gamma)
+        if work != &out[0]:
+            free(work)
     return
 
 
+def enet_projection_parallel(floating[:] v, floating[:] out,
+                             floating radius, floating l1_ratio,
+                             int n_threads=1, bint condat=False):
+    """Projection on the elastic-net ball, as enet_projection, with the
+    threshold search split over n_threads.
+
+    A histogram of |v| (one per chunk of v) locates the bin holding the
+    threshold in a parallel pass. The entries of this bin are gathered in
+    out, and the threshold search of enet_projection runs on them only.
+    Vectors shorter than PARALLEL_MIN_SIZE are projected sequentially.
+    """
+    with nogil:
+        _enet_projection_parallel(v, out, radius, l1_ratio, n_threads,
+                                  condat)
+
+
+cdef void _enet_projection_parallel(floating[:] v, floating[:] out,
+                                    floating radius, floating l1_ratio,
+                                    int n_threads, bint condat) nogil:
+    """enet_projection_parallel, to be called without the GIL"""
+    cdef int m = v.shape[0]
+    cdef int n_chunks = n_threads
+    cdef int chunk_size
+    cdef int c, i, b, j, k, start, stop
+    cdef floating gamma, a, width, e, norm, a_max, s, l
+    cdef floating sum_b
+    cdef unsigned int rho, count_b, n_candidates
+    cdef floating* chunk_norm
+    cdef floating* chunk_max
+    cdef floating* sums
+    cdef unsigned int* counts
+    cdef unsigned int* offsets
+    cdef floating* work = NULL
+
+    if n_threads <= 1 or m < PARALLEL_MIN_SIZE:
+        enet_projection(v, out, radius, l1_ratio, condat)
+        return
+    if radius == 0:
+        out[:] = 0
+        return
+    if l1_ratio == 0:
+        gamma = 0
+    else:
+        # Scaling by 1 / l1_ratio
+        gamma = 2 / l1_ratio - 2
+        radius /= l1_ratio
+    chunk_size = (m + n_chunks - 1) / n_chunks
+
+    chunk_norm = <floating*> malloc(n_chunks * sizeof(floating))
+    chunk_max = <floating*> malloc(n_chunks * sizeof(floating))
+    sums = <floating*> malloc(n_chunks * N_BINS * sizeof(floating))
+    counts = <unsigned int*> malloc(n_chunks * N_BINS * sizeof(unsigned int))
+    offsets = <unsigned int*> malloc(n_chunks * sizeof(unsigned int))
+
+    for c in prange(n_chunks, num_threads=n_threads, schedule='static'):
+        chunk_norm[c] = 0
+        chunk_max[c] = 0
+        start = c * chunk_size
+        stop = min(start + chunk_size, m)
+        for i in range(start, stop):
+            a = fabs(v[i])
+            if l1_ratio == 0:
+                chunk_norm[c] += a * a
+            else:
+                chunk_norm[c] += _phi(a, gamma)
+            if a > chunk_max[c]:
+                chunk_max[c] = a
+    norm = 0
+    a_max = 0
+    for c in range(n_chunks):
+        norm += chunk_norm[c]
+        if chunk_max[c] > a_max:
+            a_max = chunk_max[c]
+
+    if norm <= radius:
+        l = 0
+    elif l1_ratio == 0:
+        l = sqrt(norm / radius)
+    else:
+        width = a_max / N_BINS
+        for c in prange(n_chunks, num_threads=n_threads, schedule='static'):
+            for b in range(N_BINS):
+                counts[c * N_BINS + b] = 0
+                sums[c * N_BINS + b] = 0
+            start = c * chunk_size
+            stop = min(start + chunk_size, m)
+            for i in range(start, stop):
+                a = fabs(v[i])
+                b = min(<int> (a / width), N_BINS - 1)
+                counts[c * N_BINS + b] += 1
+                sums[c * N_BINS + b] += _phi(a, gamma)
+        # Scan bins from the top, until the lower edge of a bin is below the
+        # threshold: entries of upper bins are all above it
+        s = 0
+        rho = 0
+        for j in range(N_BINS - 1, -1, -1):
+            count_b = 0
+            sum_b = 0
+            for c in range(n_chunks):
+                count_b += counts[c * N_BINS + j]
+                sum_b += sums[c * N_BINS + j]
+            e = j * width
+            if (s + sum_b - (rho + count_b) * _phi(e, gamma)
+                    >= radius * (1 + gamma * e) ** 2):
+                break
+            s += sum_b
+            rho += count_b
+        # Gather the entries of bin j
+        work = _workspace(out)
+        n_candidates = 0
+        for c in range(n_chunks):
+            offsets[c] = n_candidates
+            n_candidates += counts[c * N_BINS + j]
+        for c in prange(n_chunks, num_threads=n_threads, schedule='static'):
+            start = c * chunk_size
+            stop = min(start + chunk_size, m)
+            k = offsets[c]
+            for i in range(start, stop):
+                a = fabs(v[i])
+                if min(<int> (a / width), N_BINS - 1) == j:
+                    work[k] = a
+                    k = k + 1
+        if condat:
+            _condat(work, n_candidates, gamma, radius, &s, &rho)
+        else:
+            _select(work, n_candidates, gamma, radius, &s, &rho)
+        l = _threshold(s, rho, gamma, radius)
+
+    for i in prange(m, num_threads=n_threads, schedule='static'):
+        if norm <= radius:
+            out[i] = v[i]
+        elif l1_ratio == 0:
+            out[i] = v[i] / l
+        else:
+            out[i] = (sign(v[i]) * positive(fabs(v[i]) - l)
+                      / (1 + l * gamma))
+
+    free(chunk_norm)
+    free(chunk_max)
+    free(sums)
+    free(counts)
+    free(offsets)
+    if work != NULL and work != &out[0]:
+        free(work)
+
+
 cpdef floating enet_norm(floating[:] v, floating l1_ratio) nogil:
     """Returns the elastic net norm of a vector
 
@@ -166,4 +436,55 @@ cpdef void enet_scale(floating[:] X,
     elif l1_norm != 0:
         S = radius / l1_norm
     for j in range(n_features):
-        X[j] *= S
\ No newline at end of file
+        X[j] *= S
+
+
+def _row_radius(radius, int n_rows, dtype):
+    """Per-row radii, from a scalar or an array"""
+    return np.array(np.broadcast_to(radius, (n_rows, )), dtype=dtype)
+
+
+def enet_norm_rows(floating[:, :] X, floating l1_ratio, int n_threads=1):
+    """Elastic-net norms of the rows of X, computed in parallel over rows
+
+    Returns
+    -------
+    norms: ndarray, shape (n_rows, )
+    """
+    cdef int n_rows = X.shape[0]
+    cdef int i
+    cdef floating[:] norms
+    norms = np.empty(n_rows, dtype=np.float32 if floating is float
+                     else np.float64)
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+            norms[i] = enet_norm(X[i], l1_ratio)
+    return np.asarray(norms)
+
+
+def enet_scale_rows(floating[:, :] X, floating l1_ratio, radius=1,
+                    int n_threads=1):
+    """Scale in place each row of X to the elastic-net sphere of given radius
+    (float or array of shape (n_rows, )), in parallel over rows"""
+    cdef int n_rows = X.shape[0]
+    cdef int i
+    cdef floating[:] radii = _row_radius(
+        radius, n_rows, np.float32 if floating is float else np.float64)
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+            enet_scale(X[i], l1_ratio, radii[i])
+
+
+def enet_projection_rows(floating[:, :] V, floating[:, :] out, radius,
+                         floating l1_ratio, int n_threads=1,
+                         bint condat=False):
+    """Project each row of V on the elastic-net ball of given radius (float or
+    array of shape (n_rows, )) into out, in parallel over rows. out should
+    not overlap V"""
+    cdef int n_rows = V.shape[0]
+    cdef int i
+    cdef floating[:] radii = _row_radius(
+        radius, n_rows, np.float32 if floating is float else np.float64)
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+            enet_projection(V[i], out[i], radii[i], l1_ratio, condat)
@@ -1,3 +1,4 @@
+import sys
 from distutils.extension import Extension
 
 import numpy
@@ -8,9 +9,16 @@ def configuration(parent_package='', top_path=None):
 
     config = Configuration('math', parent_package, top_path)
 
+    if sys.platform == 'win32':
+        openmp_args = ['/openmp']
+    else:
+        openmp_args = ['-fopenmp']
+
     extensions = [Extension('modl.utils.math.enet',
                             sources=['modl/utils/math/enet.pyx'],
                             include_dirs=[numpy.get_include()],
+                            extra_compile_args=openmp_args,
+                            extra_link_args=openmp_args,
                             ),
                   ]
     config.ext_modules += extensions
@@ -2,11 +2,14 @@
 # License: BSD 3 clause
 
 import numpy as np
+import pytest
 from numpy import sqrt
 from numpy.testing import assert_array_almost_equal, assert_almost_equal
 from sklearn.utils import check_random_state
 
-from modl.utils.math.enet import enet_norm, enet_projection, enet_scale
+from modl.utils.math.enet import enet_norm, enet_projection, enet_scale, \
+    enet_projection_parallel, enet_norm_rows, enet_projection_rows, \
+    enet_scale_rows
 
 
 def _enet_norm_for_projection(v, gamma):
@@ -119,6 +122,38 @@ def test_enet_projection():
     assert_array_almost_equal(c, b, 4)
 
 
+def test_enet_projection_parallel():
+    random_state = check_random_state(0)
+    for l1_ratio in [0., 0.15, 1.]:
+        for radius in [0.1, 1, 1e6]:
+            a = random_state.randn(20000)
+            b = np.zeros(20000)
+            c = np.zeros(20000)
+            enet_projection(a, b, radius, l1_ratio)
+            enet_projection_parallel(a, c, radius, l1_ratio, 3)
+            assert_array_almost_equal(c, b)
+
+
+@pytest.mark.parametrize("l1_ratio", [0., 0.1, 0.5, 0.9, 1.])
+@pytest.mark.parametrize("size", [100, 10000, 1000000])
+def test_enet_projection_condat(l1_ratio, size):
+    random_state = check_random_state(0)
+    a = random_state.randn(size)
+    # Ties and zeros
+    a[::3] = 0
+    a[1::3] = np.round(a[1::3], 1)
+    for radius in [0.1, 1, 1e6]:
+        b = np.zeros(size)
+        c = np.zeros(size)
+        enet_projection(a, b, radius, l1_ratio)
+        enet_projection(a, c, radius, l1_ratio, True)
+        assert_array_almost_equal(c, b)
+    c = np.zeros(size)
+    enet_projection_parallel(a, c, 1, l1_ratio, 3, True)
+    enet_projection(a, b, 1, l1_ratio)
+    assert_array_almost_equal(c, b)
+
+
 def test_fast_enet_l2_ball():
     random_state = check_random_state(0)
     norms = np.zeros(10)
@@ -154,3 +189,38 @@ def test_enet_scale():
             enet_scale(a, l1_ratio, r)
             norm = enet_norm(a, l1_ratio)
         assert_almost_equal(norm, r)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("n_threads", [1, 2])
+@pytest.mark.parametrize("condat", [False, True])
+def test_enet_rows(dtype, n_threads, condat):
+    random_state = check_random_state(0)
+    V = random_state.randn(5, 100).astype(dtype)
+    radius = random_state.uniform(0.5, 2, size=5).astype(dtype)
+    l1_ratio = 0.5
+    norms = enet_norm_rows(V, l1_ratio, n_threads)
+    assert norms.dtype == dtype
+    for i in range(5):
+        assert_almost_equal(norms[i], enet_norm(V[i], l1_ratio), 4)
+
+    out = np.empty_like(V)
+    enet_projection_rows(V, out, radius, l1_ratio, n_threads, condat)
+    for i in range(5):
+        b = np.empty_like(V[i])
+        enet_projection(V[i], b, radius[i], l1_ratio)
+        assert_array_almost_equal(out[i], b, 5)
+    enet_projection_rows(V, out, 1, l1_ratio, n_threads, condat)
+    assert_array_almost_equal(enet_norm_rows(out, l1_ratio), np.ones(5), 4)
+
+    # Strided rows
+    V_F = np.asfortranarray(V)
+    out = np.empty_like(V_F)
+    enet_projection_rows(V_F, out, radius, l1_ratio, n_threads, condat)
+    for i in range(5):
+        b = np.empty_like(V[i])
+        enet_projection(V[i], b, radius[i], l1_ratio)
+        assert_array_almost_equal(out[i], b, 5)
+
+    enet_scale_rows(V, l1_ratio, radius, n_threads)
+    assert_array_almost_equal(enet_norm_rows(V, l1_ratio), radius, 4)
@@ -74,6 +74,38 @@ cdef class RandomState:
         else:
             raise ValueError("Wrong seed")
 
+    def get_state(self):
+        """
+        Return the internal state of the generator, unlike pickling that
+        restores the initial seed.
+
+        Returns
+        -------
+        state: tuple (key, pos, has_gauss, gauss)
+            key is an array of 624 unsigned integers
+        """
+        cdef int i
+        key = np.empty(624, dtype=np.uint64)
+        for i in range(624):
+            key[i] = self.internal_state.key[i]
+        return (key, self.internal_state.pos,
+                self.internal_state.has_gauss, self.internal_state.gauss)
+
+    def set_state(self, state):
+        """
+        Set the internal state of the generator, as returned by get_state.
+        """
+        cdef int i
+        key, pos, has_gauss, gauss = state
+        key = np.asarray(key, dtype=np.uint64)
+        if key.shape != (624, ):
+            raise ValueError('state key should have shape (624, )')
+        for i in range(624):
+            self.internal_state.key[i] = key[i]
+        self.internal_state.pos = pos
+        self.internal_state.has_gauss = has_gauss
+        self.internal_state.gauss = gauss
+
     cpdef long randint(self, unsigned long high):
         return <long>rk_interval(high, self.internal_state)
 
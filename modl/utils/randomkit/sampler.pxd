@@ -4,6 +4,7 @@ cdef class Sampler(object):
     cdef public long range
     cdef public bint rand_size
     cdef public bint replacement
+    cdef public str order
 
     cdef public long[:] box
     cdef public long[:] temp
@@ -12,4 +13,6 @@ cdef class Sampler(object):
 
     cdef public RandomState random_state
 
-    cpdef long[:] yield_subset(self, double reduction)
\ No newline at end of file
+    cdef void _partial_shuffle(self, long len_subset)
+    cdef void _block(self, long len_subset, long[:] out)
+    cpdef long[:] yield_subset(self, double reduction, long[:] out=*)
@@ -5,12 +5,13 @@
 # cython: wraparound=False
 
 from cython cimport view
+from libcpp.algorithm cimport sort
 import numpy as np
 
 cdef class Sampler(object):
     def __init__(self, range, rand_size,
                   replacement,
-                  random_seed):
+                  random_seed, order='random'):
         """
 
         Parameters
@@ -22,14 +23,23 @@ cdef class Sampler(object):
             2: Fixed-size sampling without replacement
             3: Fixed-size sampling
         random_seed
+        order: str in ['random', 'sorted', 'block']
+            'random': subsets are returned in random order
+            'sorted': subsets are returned sorted, for cache-friendly
+            column gathers
+            'block': subsets are (cyclically) contiguous runs of range,
+            returned sorted
 
         Returns
         -------
 
         """
+        if order not in ['random', 'sorted', 'block']:
+            raise ValueError("order should be 'random', 'sorted' or 'block'")
         self.range = <long> range
         self.rand_size = <bint> rand_size
         self.replacement = <bint> replacement
+        self.order = order
         self.random_state = RandomState(seed=<unsigned long> random_seed)
 
         self.box = self.random_state.permutation(self.range)
@@ -38,8 +48,85 @@ cdef class Sampler(object):
         self.lim_inf = 0
 
         self.random_state.shuffle(self.box)
+        if self.order == 'block':
+            self.lim_sup = self.random_state.randint(self.range - 1)
 
-    cpdef long[:] yield_subset(self, double reduction):
+    def get_state(self):
+        """
+        Return the state from which subsets are drawn.
+
+        Returns
+        -------
+        state: tuple (box, lim_inf, lim_sup, random_state_state)
+        """
+        return (np.array(self.box), self.lim_inf, self.lim_sup,
+                self.random_state.get_state())
+
+    def set_state(self, state):
+        """
+        Set the state from which subsets are drawn, as returned by
+        get_state, on a sampler with the same range.
+        """
+        cdef long[:] new_box
+        box, lim_inf, lim_sup, random_state_state = state
+        if len(box) != self.range:
+            raise ValueError('state box should have length %i, got %i'
+                             % (self.range, len(box)))
+        new_box = np.asarray(box, dtype='l')
+        self.box[:] = new_box
+        self.lim_inf = lim_inf
+        self.lim_sup = lim_sup
+        self.random_state.set_state(random_state_state)
+
+    cdef void _partial_shuffle(self, long len_subset):
+        """Draw len_subset positions uniformly at random into
+        box[:len_subset], swapping them with the rest of the box (partial
+        Fisher-Yates). Cost is O(len_subset) and box remains a permutation
+        of range."""
+        cdef long i, j, tmp
+        for i in range(len_subset):
+            j = i + self.random_state.randint(self.range - 1 - i)
+            tmp = self.box[i]
+            self.box[i] = self.box[j]
+            self.box[j] = tmp
+
+    cdef void _block(self, long len_subset, long[:] out):
+        """Write the (cyclic) run of len_subset features starting at lim_sup
+        into out, in increasing order."""
+        cdef long i
+        cdef long start = self.lim_sup
+        cdef long overflow = start + len_subset - self.range
+        if overflow > 0:
+            for i in range(overflow):
+                out[i] = i
+            for i in range(overflow, len_subset):
+                out[i] = start + i - overflow
+            self.lim_sup = overflow
+        else:
+            for i in range(len_subset):
+                out[i] = start + i
+            self.lim_sup = start + len_subset
+            if self.lim_sup == self.range:
+                self.lim_sup = 0
+
+    cpdef long[:] yield_subset(self, double reduction, long[:] out=None):
+        """
+        Draw a subset of range.
+
+        Parameters
+        ----------
+        reduction: float
+            Expected ratio between range and the size of the subset
+        out: long memory-view, shape (>= range / reduction)
+            Preallocated buffer in which to write the subset. If None, a new
+            array is allocated. Its size should be range when rand_size is
+            True.
+
+        Returns
+        -------
+        subset: long memory-view
+            Subset of features, a view of out if provided
+        """
         cdef long remainder
         cdef long len_subset
         if self.rand_size:
@@ -47,8 +134,15 @@ cdef class Sampler(object):
                                                          1. / reduction)
         else:
             len_subset = int(self.range / reduction)
+        if out is None:
+            out = np.empty(len_subset, dtype='l')
+        if self.order == 'block':
+            if self.replacement or len_subset == self.range:
+                self.lim_sup = self.random_state.randint(self.range - 1)
+            self._block(len_subset, out)
+            return out[:len_subset]
         if self.replacement:
-            self.random_state.shuffle(self.box)
+            self._partial_shuffle(len_subset)
             self.lim_inf = 0
             self.lim_sup = len_subset
         else: # Without replacement
@@ -68,4 +162,7 @@ cdef class Sampler(object):
             else:
                 self.lim_inf = 0
                 self.lim_sup = self.range
-        return np.array(self.box[self.lim_inf:self.lim_sup])
\ No newline at end of file
+        out[:len_subset] = self.box[self.lim_inf:self.lim_sup]
+        if self.order == 'sorted' and len_subset > 0:
+            sort(&out[0], &out[0] + len_subset)
+        return out[:len_subset]
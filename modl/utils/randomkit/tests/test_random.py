@@ -45,3 +45,13 @@ def test_random_state_pickle():
     pickle_rs = pickle.loads(pickle_rs)
     pickle_random_integer = pickle_rs.randint(5)
     assert_equal(random_integer, pickle_random_integer)
+
+
+def test_random_state_get_set_state():
+    rs = RandomState(seed=0)
+    rs.randint(5)
+    state = rs.get_state()
+    vals = [rs.randint(100) for t in range(10)]
+    other_rs = RandomState(seed=1)
+    other_rs.set_state(state)
+    assert_array_equal(vals, [other_rs.randint(100) for t in range(10)])
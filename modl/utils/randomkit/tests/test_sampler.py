@@ -8,11 +8,11 @@ def test_sampler():
                       replacement=True,
                       random_seed=0)
     A = sampler.yield_subset(10)
-    assert_array_equal(A, np.array([14, 58, 11, 49, 36, 62, 87,
-                                   45, 72, 47, 48, 13, 98, 97, 25, 93]))
+    assert_array_equal(A, np.array([10, 59, 66, 93, 43, 34, 97, 76,
+                                   7, 55, 67, 39, 82, 83, 33, 65]))
     a = np.mean(np.array([sampler.yield_subset(10).shape[0]
                           for t in range(100)]))
-    assert_equal(a, 10.19)
+    assert_equal(a, 10.58)
 
     # Without replacement, with fixed size
     sampler = Sampler(100, rand_size=False,
@@ -26,7 +26,7 @@ def test_sampler():
                       replacement=True,
                       random_seed=0)
     A = sampler.yield_subset(10)
-    assert_array_equal(A, np.array([6, 55,  1, 25, 87, 49, 69, 63, 13,  8]))
+    assert_array_equal(A, np.array([23, 0, 65, 2, 30, 17, 32, 62, 79, 99]))
     a = np.mean(np.array([sampler.yield_subset(10).shape[0]
                           for t in range(100)]))
     assert_equal(a, 10)
@@ -43,3 +43,75 @@ def test_sampler():
                       random_seed=0)
     A = np.concatenate([sampler.yield_subset(10) for t in range(20)])
     assert_array_equal(np.sort(A[:100]), np.arange(100))
+
+
+def test_sampler_out():
+    sampler = Sampler(100, rand_size=True,
+                      replacement=True,
+                      random_seed=0)
+    out = np.empty(100, dtype='l')
+    A = np.asarray(sampler.yield_subset(10, out))
+    assert_array_equal(A, out[:A.shape[0]])
+    assert_equal(np.unique(A).shape[0], A.shape[0])
+
+    # Same stream with and without buffer
+    sampler = Sampler(100, rand_size=True,
+                      replacement=True,
+                      random_seed=0)
+    B = np.asarray(sampler.yield_subset(10))
+    assert_array_equal(A, B)
+
+    # Partial shuffles should keep the box a permutation
+    for t in range(100):
+        sampler.yield_subset(10, out)
+    assert_array_equal(np.sort(sampler.box), np.arange(100))
+
+
+def test_sampler_sorted():
+    for replacement in [True, False]:
+        sampler = Sampler(100, rand_size=True,
+                          replacement=replacement,
+                          random_seed=0)
+        sorted_sampler = Sampler(100, rand_size=True,
+                                 replacement=replacement,
+                                 random_seed=0, order='sorted')
+        for t in range(20):
+            A = np.asarray(sampler.yield_subset(10))
+            B = np.asarray(sorted_sampler.yield_subset(10))
+            assert_array_equal(np.sort(A), B)
+
+
+def test_sampler_block():
+    sampler = Sampler(100, rand_size=False,
+                      replacement=True,
+                      random_seed=0, order='block')
+    counts = np.zeros(100)
+    for t in range(1000):
+        A = np.asarray(sampler.yield_subset(10))
+        assert_equal(A.shape[0], 10)
+        assert_array_equal(A, np.sort(A))
+        # Contiguous up to wrapping around range
+        assert_equal(np.sum(np.diff(A) != 1) <= 1, True)
+        counts[A] += 1
+    assert_equal(np.all(counts > 0), True)
+
+    # Without replacement, blocks cycle over range
+    sampler = Sampler(100, rand_size=False,
+                      replacement=False,
+                      random_seed=0, order='block')
+    A = np.concatenate([sampler.yield_subset(10) for t in range(10)])
+    assert_array_equal(np.sort(A), np.arange(100))
+
+
+def test_sampler_get_set_state():
+    for replacement in [False, True]:
+        sampler = Sampler(100, rand_size=True, replacement=replacement,
+                          random_seed=0)
+        sampler.yield_subset(3)
+        state = sampler.get_state()
+        A = [np.array(sampler.yield_subset(3)) for t in range(5)]
+        other_sampler = Sampler(100, rand_size=True, replacement=replacement,
+                                random_seed=1)
+        other_sampler.set_state(state)
+        for this_A in A:
+            assert_array_equal(this_A, other_sampler.yield_subset(3))